@@ -0,0 +1,461 @@
+#!/usr/bin/env python3
+import collections
+import json
+import os
+import sqlite3
+import stat
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+import traceback
+from urllib.parse import quote, urlencode
+from urllib.request import urlopen
+
+import yaml
+from charmhelpers.core import hookenv, unitdata
+
+sys.path.append('lib')
+from charms.layer.prometheus import parse_duration, parse_metrics  # noqa
+
+HTTP_TIMEOUT = 30
+READ_CHUNK = 65536
+DEFAULT_DATADIR = '/var/lib/prometheus/metrics'
+CHECKPOINT_FILE = 'heads.db'
+CHECKPOINT_POLL = 5
+# prometheus 1.x default -storage.local.checkpoint-interval, and the time
+# allowed on top of it for the checkpoint to be written
+CHECKPOINT_INTERVAL = 300
+CHECKPOINT_SLACK = 120
+SNAPSHOT_MANIFEST = '.prometheus-snapshot.db'
+DELETED_MEMBER = '.deleted'
+IONICE_CLASSES = {'idle': ['-c', '3'], 'best-effort': ['-c', '2', '-n', '7']}
+PERSISTENCE_METRICS = [
+    'prometheus_local_storage_persistence_urgency_score',
+    'prometheus_local_storage_rushed_mode',
+    'prometheus_local_storage_memory_chunks',
+    'prometheus_local_storage_memory_series',
+    'prometheus_local_storage_chunks_to_persist',
+    'prometheus_local_storage_max_chunks_to_persist',
+]
+
+
+def prometheus_url(path, params=None):
+    port = unitdata.kv().get('prometheus.port') or '9090'
+    url = 'http://localhost:{}{}'.format(port, path)
+    if params:
+        url += '?' + urlencode(params)
+    return url
+
+
+def api_get(path, params=None):
+    """Open a prometheus HTTP API endpoint, returns the response object."""
+    return urlopen(prometheus_url(path, params), timeout=HTTP_TIMEOUT)
+
+
+def query(expr):
+    """Run an instant query, returns a list of (labels, value) tuples.
+
+    Callers aggregate server side (count by, topk) so that responses stay
+    small regardless of the number of series.
+    """
+    with api_get('/api/v1/query', {'query': expr}) as fh:
+        response = json.loads(fh.read().decode('utf-8'))
+    if response.get('status') != 'success':
+        raise RuntimeError('Query {} failed: {}'.format(
+            expr, response.get('error')))
+    return [(r['metric'], float(r['value'][1]))
+            for r in response['data']['result']]
+
+
+def count_array_strings(fh, chunk_size=READ_CHUNK):
+    """Count the strings held in JSON arrays of a response, streaming.
+
+    Used on /api/v1/label/<name>/values, which can return millions of
+    values: only a small parser state is kept, never the values.
+    """
+    count = 0
+    stack = []
+    in_string = escaped = False
+    while True:
+        chunk = fh.read(chunk_size)
+        if not chunk:
+            return count
+        for char in chunk.decode('utf-8', 'replace'):
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif char == '\\':
+                    escaped = True
+                elif char == '"':
+                    in_string = False
+            elif char == '"':
+                in_string = True
+                if stack and stack[-1] == '[':
+                    count += 1
+            elif char in '[{':
+                stack.append(char)
+            elif char in ']}':
+                stack.pop()
+
+
+def label_value_count(label):
+    with api_get('/api/v1/label/{}/values'.format(quote(label))) as fh:
+        return count_array_strings(fh)
+
+
+def self_metrics(names):
+    """Read the given metrics from /metrics line by line."""
+    with api_get('/metrics') as fh:
+        return parse_metrics(fh, names)
+
+
+def metric_selector(name):
+    return '{{__name__="{}"}}'.format(name.replace('"', '\\"'))
+
+
+def cardinality_report(top=10, min_series=10000, label_threshold=1000):
+    """Series cardinality and memory pressure report of the local server.
+    """
+    top_metrics = sorted(
+        ((labels['__name__'], int(value)) for labels, value in query(
+            'topk({}, count by (__name__)({{__name__=~".+"}}))'.format(top))),
+        key=lambda x: (-x[1], x[0]))
+    top_label_sets = sorted(
+        ((labels.get('__name__', ''), labels.get('job', ''), int(value))
+         for labels, value in query(
+             'topk({}, count by (__name__, job)({{__name__=~".+"}}))'.format(
+                 top))),
+        key=lambda x: (-x[2], x[0], x[1]))
+
+    series_by_job = dict(
+        (labels.get('job', ''), int(value)) for labels, value in query(
+            'count by (job)({__name__=~".+"})'))
+    kv = unitdata.kv()
+    rendered_jobs = set(['prometheus'])
+    for key in ('target_jobs', 'scrape_jobs', 'federation_jobs'):
+        rendered_jobs.update(j['job_name'] for j in kv.get(key, []))
+    jobs = []
+    for job in sorted(series_by_job, key=lambda j: -series_by_job[j]):
+        jobs.append({'job': job, 'series': series_by_job[job],
+                     'charm-rendered': job in rendered_jobs})
+
+    # per-label cardinality of the biggest metrics, from one sample series
+    label_cardinality = {}
+    suggestions = {}
+    for name, series in top_metrics:
+        selector = metric_selector(name)
+        sample = query('topk(1, {})'.format(selector))
+        labels = sorted(label for label in (sample[0][0] if sample else {})
+                        if label not in ('__name__', 'job', 'instance'))
+        for label in labels:
+            values = query('count(count by ({})({}))'.format(
+                label, selector))
+            distinct = int(values[0][1]) if values else 0
+            label_cardinality[(name, label)] = distinct
+            rule = {'regex': label, 'action': 'labeldrop'}
+            if (distinct >= label_threshold and
+                    rule not in suggestions.get('all-jobs', [])):
+                suggestions.setdefault('all-jobs', []).append(rule)
+        if series >= min_series:
+            job = [j for n, j, _ in top_label_sets if n == name]
+            suggestions.setdefault(job[0] if job else 'all-jobs', []).append(
+                {'source_labels': ['__name__'], 'regex': name,
+                 'action': 'drop'})
+    top_labels = sorted(label_cardinality.items(),
+                        key=lambda x: (-x[1], x[0]))[:top]
+    label_values = sorted(
+        ((label, label_value_count(label))
+         for label in set(label for (_, label) in label_cardinality)),
+        key=lambda x: (-x[1], x[0]))[:top]
+
+    report = {
+        'top-metrics': [{'name': n, 'series': s} for n, s in top_metrics],
+        'top-label-sets': [{'name': n, 'job': j, 'series': s}
+                           for n, j, s in top_label_sets],
+        'top-labels': [{'name': n, 'label': label, 'distinct-values': c}
+                       for (n, label), c in top_labels],
+        'label-values': [{'label': label, 'distinct-values': c}
+                         for label, c in label_values],
+        'jobs': jobs,
+        'persistence': self_metrics(PERSISTENCE_METRICS),
+    }
+    if suggestions:
+        # ready to use as the metric-relabel-configs option
+        report['suggested-metric-relabel-configs'] = yaml.safe_dump(
+            suggestions, default_flow_style=None)
+    return report
+
+
+def flatten(value, prefix=''):
+    """Flatten nested results into action-set keys.
+
+    action-set keys only allow lowercase letters, digits and hyphens, so
+    lists are numbered from 1 and metric names are kept as values.
+    """
+    if isinstance(value, dict):
+        items = value.items()
+    elif isinstance(value, list):
+        items = ((str(i), v) for i, v in enumerate(value, 1))
+    else:
+        return {prefix: str(value)}
+    flat = {}
+    for key, item in items:
+        if isinstance(value, dict) and not isinstance(item, (dict, list)):
+            # values keyed by metric names, e.g. persistence metrics
+            key = key.lower().replace('_', '-').replace(':', '-')
+        flat.update(flatten(item, '{}.{}'.format(prefix, key)
+                            if prefix else key))
+    return flat
+
+
+def cardinality_report_action():
+    params = hookenv.action_get()
+    report = cardinality_report(
+        top=params.get('top', 10),
+        min_series=params.get('min-series', 10000),
+        label_threshold=params.get('label-threshold', 1000))
+    hookenv.action_set(flatten(report))
+
+
+def data_dir():
+    return unitdata.kv().get('storage-path') or DEFAULT_DATADIR
+
+
+class RateLimiter(object):
+    """Sleep as needed to keep the average rate under rate bytes/s."""
+    def __init__(self, rate, clock=time.time, sleep=time.sleep):
+        self.rate = rate
+        self.clock = clock
+        self.sleep = sleep
+        self.start = None
+        self.total = 0
+
+    def consume(self, nbytes):
+        if not self.rate:
+            return
+        now = self.clock()
+        if self.start is None:
+            self.start = now
+        self.total += nbytes
+        ahead = float(self.total) / self.rate - (now - self.start)
+        if ahead > 0:
+            self.sleep(ahead)
+
+
+class ThrottledFile(object):
+    """File object wrapper counting and rate limiting reads and writes."""
+    def __init__(self, fh, limiter):
+        self.fh = fh
+        self.limiter = limiter
+        self.count = 0
+
+    def read(self, size=-1):
+        data = self.fh.read(size)
+        self.count += len(data)
+        self.limiter.consume(len(data))
+        return data
+
+    def write(self, data):
+        self.limiter.consume(len(data))
+        self.count += len(data)
+        return self.fh.write(data)
+
+
+class Manifest(object):
+    """Size and mtime of the files in the last snapshot.
+
+    Kept in sqlite next to the snapshots, so that memory use doesn't grow
+    with the number of series files.
+    """
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS files ('
+                          'path TEXT PRIMARY KEY, size INTEGER, '
+                          'mtime REAL, seen INTEGER)')
+        self.conn.execute('UPDATE files SET seen = 0')
+
+    def reset(self):
+        self.conn.execute('DELETE FROM files')
+
+    def changed(self, path, size, mtime):
+        """Whether a file changed since it was last recorded."""
+        row = self.conn.execute('SELECT size, mtime FROM files WHERE path = ?',
+                                (path,)).fetchone()
+        return row is None or tuple(row) != (size, mtime)
+
+    def record(self, path, size, mtime):
+        """Record a file as present in the snapshot."""
+        self.conn.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, 1)',
+                          (path, size, mtime))
+
+    def deleted(self):
+        return (row[0] for row in self.conn.execute(
+            'SELECT path FROM files WHERE seen = 0 ORDER BY path'))
+
+    def commit(self):
+        self.conn.execute('DELETE FROM files WHERE seen = 0')
+        self.conn.commit()
+        self.conn.close()
+
+    def rollback(self):
+        self.conn.rollback()
+        self.conn.close()
+
+
+def lower_io_priority(io_class='idle'):
+    os.nice(10)
+    try:
+        subprocess.check_call(['ionice'] + IONICE_CLASSES[io_class] +
+                              ['-p', str(os.getpid())])
+    except (OSError, subprocess.CalledProcessError) as e:
+        hookenv.log('Could not lower I/O priority: {}'.format(e),
+                    hookenv.WARNING)
+
+
+def checkpoint_timeout():
+    """Default checkpoint wait, from the configured checkpoint interval."""
+    args = unitdata.kv().get('runtime_args') or {}
+    interval = args.get('-storage.local.checkpoint-interval')
+    try:
+        seconds = parse_duration(interval) if interval else CHECKPOINT_INTERVAL
+    except ValueError:
+        seconds = CHECKPOINT_INTERVAL
+    return int(seconds) + CHECKPOINT_SLACK
+
+
+def wait_for_checkpoint(datadir, since, timeout):
+    """Wait for prometheus to write a checkpoint (heads.db) after since.
+
+    Prometheus 1.x has no API to request one, it checkpoints every
+    -storage.local.checkpoint-interval or when too many series are dirty.
+    """
+    path = os.path.join(datadir, CHECKPOINT_FILE)
+    deadline = time.time() + timeout
+    while True:
+        try:
+            if os.stat(path).st_mtime >= since:
+                return True
+        except OSError:
+            pass
+        if time.time() >= deadline:
+            return False
+        time.sleep(CHECKPOINT_POLL)
+
+
+def snapshot(datadir, target, incremental=False, read_rate=0, write_rate=0):
+    """Stream datadir as a gzipped tar to target, returns statistics.
+
+    Incremental snapshots only hold the files that changed since the last
+    snapshot written to the same directory, and a .deleted member listing
+    the files that are gone. Restore the last full snapshot, then the
+    incremental ones in order.
+    """
+    manifest = Manifest(os.path.join(
+        os.path.dirname(os.path.abspath(target)), SNAPSHOT_MANIFEST))
+    if not incremental:
+        manifest.reset()
+    stats = collections.Counter()
+    read_limiter = RateLimiter(read_rate)
+    partial = target + '.partial'
+    try:
+        with open(partial, 'wb') as raw:
+            out = ThrottledFile(raw, RateLimiter(write_rate))
+            with tarfile.open(fileobj=out, mode='w|gz') as tar:
+                for dirpath, dirnames, filenames in os.walk(datadir):
+                    dirnames.sort()
+                    for fname in sorted(filenames):
+                        path = os.path.join(dirpath, fname)
+                        arcname = os.path.relpath(path, datadir)
+                        try:
+                            st = os.lstat(path)
+                        except OSError:
+                            continue  # purged meanwhile
+                        if not stat.S_ISREG(st.st_mode):
+                            continue
+                        if (not manifest.changed(arcname, st.st_size,
+                                                 st.st_mtime) and
+                                fname != CHECKPOINT_FILE):
+                            manifest.record(arcname, st.st_size, st.st_mtime)
+                            stats['skipped'] += 1
+                            continue
+                        try:
+                            fh = open(path, 'rb')
+                        except (IOError, OSError):
+                            continue
+                        with fh:
+                            st = os.fstat(fh.fileno())
+                            info = tarfile.TarInfo(arcname)
+                            info.size = st.st_size
+                            info.mtime = st.st_mtime
+                            info.mode = stat.S_IMODE(st.st_mode)
+                            reader = ThrottledFile(fh, read_limiter)
+                            tar.addfile(info, reader)
+                        manifest.record(arcname, info.size, info.mtime)
+                        stats['files'] += 1
+                        stats['bytes-read'] += reader.count
+                        # tarfile remembers every member, don't let it
+                        tar.members = []
+                with tempfile.TemporaryFile() as deleted:
+                    for path in manifest.deleted():
+                        deleted.write(path.encode('utf-8') + b'\n')
+                        stats['deleted'] += 1
+                    info = tarfile.TarInfo(DELETED_MEMBER)
+                    info.size = deleted.tell()
+                    info.mtime = time.time()
+                    deleted.seek(0)
+                    tar.addfile(info, deleted)
+        os.rename(partial, target)
+    except BaseException:
+        manifest.rollback()
+        if os.path.exists(partial):
+            os.unlink(partial)
+        raise
+    manifest.commit()
+    stats['bytes-written'] = out.count
+    return dict(stats)
+
+
+def snapshot_action():
+    params = hookenv.action_get()
+    datadir = data_dir()
+    start = time.time()
+    lower_io_priority(params.get('io-class', 'idle'))
+    timeout = params.get('checkpoint-timeout')
+    if timeout is None:
+        timeout = checkpoint_timeout()
+    if timeout and not wait_for_checkpoint(datadir, start, timeout):
+        raise RuntimeError('Prometheus wrote no checkpoint within {}s'.format(
+            timeout))
+    mib = 1024 * 1024
+    stats = snapshot(datadir, params['target'],
+                     incremental=params.get('incremental', False),
+                     read_rate=params.get('max-read-mb', 20) * mib,
+                     write_rate=params.get('max-write-mb', 0) * mib)
+    stats['target'] = params['target']
+    stats['seconds'] = round(time.time() - start, 1)
+    hookenv.action_set(flatten(stats))
+
+
+ACTIONS = {
+    'cardinality-report': cardinality_report_action,
+    'snapshot': snapshot_action,
+}
+
+
+def main(args):
+    action_name = os.path.basename(args[0])
+    try:
+        action = ACTIONS[action_name]
+    except KeyError:
+        return 'Action {} undefined'.format(action_name)
+    try:
+        action()
+    except Exception as e:
+        hookenv.log(traceback.format_exc(), hookenv.ERROR)
+        hookenv.action_fail(str(e))
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
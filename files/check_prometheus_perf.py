@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+"""Nagios check of prometheus ingestion and query performance.
+
+Reads the local server's own telemetry from /metrics, and the query API for
+per-job scrape durations and skipped scrapes, so that each check is one or
+two small HTTP requests and can run every minute. Checks:
+
+  persistence  persistence urgency score, and chunks waiting to be persisted
+               as a fraction of -storage.local.max-chunks-to-persist
+  ingestion    rushed mode, and scrapes skipped because ingestion was
+               throttled or the job's sample_limit was exceeded
+  scrape       per job scrape duration as a fraction of its scrape interval
+  rules        rule evaluation duration as a fraction of evaluation_interval
+  query        99th percentile query evaluation time, in seconds
+
+The scrape and rules checks read prometheus.yml, they need python3-yaml.
+"""
+import argparse
+import json
+import re
+import sys
+from urllib.parse import urlencode
+from urllib.request import urlopen
+
+OK, WARNING, CRITICAL, UNKNOWN = range(4)
+STATUS = ('OK', 'WARNING', 'CRITICAL', 'UNKNOWN')
+# default (warning, critical) thresholds per check
+THRESHOLDS = {
+    'persistence': (0.7, 0.9),
+    'ingestion': (1, 10),
+    'scrape': (0.5, 0.8),
+    'rules': (0.5, 0.8),
+    'query': (5, 20),
+}
+DURATION_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600, 'd': 86400,
+                  'w': 604800, 'y': 31536000}
+SAMPLE_RE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(.*)\})?\s+(\S+)')
+LABEL_RE = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\]|\\.)*)"')
+
+
+class CheckError(Exception):
+    pass
+
+
+def parse_duration(value):
+    match = re.match(r'^(\d+)(ms|[smhdwy])$', str(value))
+    if not match:
+        raise CheckError('Invalid duration {}'.format(value))
+    return int(match.group(1)) * DURATION_UNITS[match.group(2)]
+
+
+def get(url, timeout):
+    try:
+        with urlopen(url, timeout=timeout) as fh:
+            return fh.read().decode('utf-8')
+    except (IOError, OSError, ValueError) as e:
+        raise CheckError('Could not fetch {}: {}'.format(url, e))
+
+
+def parse_metrics(text):
+    """[(name, {label: value}, float)] from the text exposition format."""
+    samples = []
+    for line in text.splitlines():
+        match = SAMPLE_RE.match(line)
+        if not match:
+            continue
+        try:
+            value = float(match.group(3))
+        except ValueError:
+            continue
+        labels = dict(LABEL_RE.findall(match.group(2) or ''))
+        samples.append((match.group(1), labels, value))
+    return samples
+
+
+class Prometheus(object):
+    def __init__(self, port, timeout):
+        self.url = 'http://localhost:{}'.format(port)
+        self.timeout = timeout
+        self._metrics = None
+
+    def metrics(self, name, **labels):
+        """Samples of a metric in /metrics, as [(labels, value)]."""
+        if self._metrics is None:
+            self._metrics = parse_metrics(get(self.url + '/metrics',
+                                              self.timeout))
+        return [(sample_labels, value)
+                for metric, sample_labels, value in self._metrics
+                if metric == name and all(sample_labels.get(k) == v
+                                          for k, v in labels.items())]
+
+    def metric(self, name, **labels):
+        samples = self.metrics(name, **labels)
+        return samples[0][1] if samples else None
+
+    def query(self, expr):
+        """Instant query, as [(labels, value)]."""
+        response = json.loads(get('{}/api/v1/query?{}'.format(
+            self.url, urlencode({'query': expr})), self.timeout))
+        if response.get('status') != 'success':
+            raise CheckError('Query {} failed: {}'.format(
+                expr, response.get('error')))
+        return [(r['metric'], float(r['value'][1]))
+                for r in response['data']['result']]
+
+
+def evaluate(values, warn, crit):
+    """Nagios status of (label, value) pairs against the thresholds."""
+    status = OK
+    for _, value in values:
+        if value >= crit:
+            status = CRITICAL
+        elif value >= warn:
+            status = max(status, WARNING)
+    return status
+
+
+def check_persistence(prom, args):
+    values = []
+    urgency = prom.metric('prometheus_local_storage_persistence_urgency_score')
+    if urgency is None:
+        return OK, 'No local storage metrics (prometheus 2.x)', []
+    values.append(('persistence_urgency', urgency))
+    to_persist = prom.metric('prometheus_local_storage_chunks_to_persist')
+    max_to_persist = (
+        prom.metric('prometheus_local_storage_max_chunks_to_persist') or
+        args.max_chunks_to_persist)
+    if to_persist is not None and max_to_persist:
+        values.append(('chunks_to_persist_ratio',
+                       to_persist / max_to_persist))
+    return evaluate(values, args.warning, args.critical), '', values
+
+
+def check_ingestion(prom, args):
+    values = []
+    window = '[{}]'.format(args.window)
+    for name, metric in (
+            ('skipped_scrapes', 'prometheus_target_skipped_scrapes_total'),
+            ('sample_limit_exceeded',
+             'prometheus_target_scrapes_exceeded_sample_limit_total')):
+        result = prom.query('sum(increase({}{}))'.format(metric, window))
+        values.append((name, result[0][1] if result else 0))
+    status = evaluate(values, args.warning, args.critical)
+    message = ''
+    if prom.metric('prometheus_local_storage_rushed_mode'):
+        status = max(status, WARNING)
+        message = 'Storage in rushed mode'
+    urgency = prom.metric('prometheus_local_storage_persistence_urgency_score')
+    if urgency is not None and urgency >= 1:
+        status = CRITICAL
+        message = 'Ingestion throttled'
+    return status, message, values
+
+
+def load_config(path):
+    import yaml
+    try:
+        with open(path) as fh:
+            return yaml.safe_load(fh) or {}
+    except (IOError, OSError, yaml.YAMLError) as e:
+        raise CheckError('Could not read {}: {}'.format(path, e))
+
+
+def check_scrape(prom, args):
+    config = load_config(args.config)
+    default = (config.get('global') or {}).get('scrape_interval', '1m')
+    intervals = dict(
+        (job['job_name'], parse_duration(job.get('scrape_interval', default)))
+        for job in config.get('scrape_configs') or [])
+    values = []
+    for labels, duration in prom.query(
+            'max by (job) (scrape_duration_seconds)'):
+        job = labels.get('job')
+        if job in intervals:
+            values.append((job, duration / intervals[job]))
+    return evaluate(values, args.warning, args.critical), '', sorted(values)
+
+
+def check_rules(prom, args):
+    values = []
+    # prometheus 2.x, per rule group
+    for labels, duration in prom.metrics(
+            'prometheus_rule_group_last_duration_seconds'):
+        interval = prom.metric('prometheus_rule_group_interval_seconds',
+                               rule_group=labels.get('rule_group'))
+        if interval:
+            values.append((labels.get('rule_group'), duration / interval))
+    # prometheus 1.x, all rules at once
+    duration = prom.metric('prometheus_evaluator_duration_seconds',
+                           quantile='0.99')
+    if duration is not None:
+        config = load_config(args.config)
+        interval = parse_duration((config.get('global') or {}).get(
+            'evaluation_interval', '1m'))
+        values.append(('evaluation', duration / interval))
+    return evaluate(values, args.warning, args.critical), '', values
+
+
+def check_query(prom, args):
+    values = [(labels.get('slice'), value) for labels, value in prom.metrics(
+        'prometheus_engine_query_duration_seconds', quantile='0.99')
+        if value == value]  # NaN when there were no queries
+    return evaluate(values, args.warning, args.critical), '', sorted(values)
+
+
+CHECKS = {
+    'persistence': check_persistence,
+    'ingestion': check_ingestion,
+    'scrape': check_scrape,
+    'rules': check_rules,
+    'query': check_query,
+}
+
+
+def run(argv=None):
+    """Run a check, returns (status, output)."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('check', choices=sorted(CHECKS))
+    parser.add_argument('-w', '--warning', type=float)
+    parser.add_argument('-c', '--critical', type=float)
+    parser.add_argument('--port', default='9090')
+    parser.add_argument('--config', default='/etc/prometheus/prometheus.yml')
+    parser.add_argument('--max-chunks-to-persist', type=float,
+                        help='used when the server does not export it')
+    parser.add_argument('--window', default='5m',
+                        help='range of the skipped scrapes increase')
+    parser.add_argument('--timeout', type=float, default=10)
+    args = parser.parse_args(argv)
+    warning, critical = THRESHOLDS[args.check]
+    if args.warning is None:
+        args.warning = warning
+    if args.critical is None:
+        args.critical = critical
+    try:
+        status, message, values = CHECKS[args.check](
+            Prometheus(args.port, args.timeout), args)
+    except CheckError as e:
+        return UNKNOWN, 'UNKNOWN: {}'.format(e)
+    over = ['{}={:.4g}'.format(name, value) for name, value in values
+            if value >= args.warning]
+    details = [d for d in [message] + over if d]
+    output = '{}: {}'.format(STATUS[status], ', '.join(details) or
+                             '{} within thresholds'.format(args.check))
+    if values:
+        output += ' | ' + ' '.join(
+            "'{}'={:.6g};{:g};{:g}".format(name, value, args.warning,
+                                           args.critical)
+            for name, value in values)
+    return status, output
+
+
+def main(argv=None):
+    status, output = run(argv)
+    print(output)
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
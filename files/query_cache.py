@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+"""Step-aligned query_range caching proxy in front of prometheus.
+
+Range queries are split into buckets of --bucket-steps evaluation steps,
+aligned to multiples of the step. Completed buckets are cached in a bounded
+LRU (memory, spilling to disk), only the newest, still open bucket is
+evaluated by prometheus on every dashboard refresh. Concurrent identical
+upstream requests are merged into one. Everything else is passed through.
+"""
+import argparse
+import collections
+import hashlib
+import json
+import math
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.error import HTTPError, URLError
+from urllib.parse import parse_qs, urlencode, urlparse
+from urllib.request import Request, urlopen
+
+QUERY_RANGE = '/api/v1/query_range'
+METRICS_PATH = '/query-cache/metrics'
+READ_CHUNK = 65536
+DURATION_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600, 'd': 86400,
+                  'w': 604800, 'y': 31536000}
+
+
+class UpstreamError(Exception):
+    def __init__(self, status, body):
+        super(UpstreamError, self).__init__('prometheus returned {}'.format(
+            status))
+        self.status = status
+        self.body = body
+
+
+def unavailable(error):
+    """UpstreamError for an unreachable prometheus, e.g. while restarting."""
+    body = json.dumps({'status': 'error', 'errorType': 'unavailable',
+                       'error': 'prometheus unreachable: {}'.format(
+                           getattr(error, 'reason', error))})
+    return UpstreamError(503, body.encode('utf-8'))
+
+
+def parse_duration(value):
+    """Seconds from a float or a prometheus duration (e.g. '15s')."""
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    match = re.match(r'^(\d+)(ms|[smhdwy])$', value)
+    if not match:
+        raise ValueError('Invalid duration {}'.format(value))
+    return int(match.group(1)) * DURATION_UNITS[match.group(2)]
+
+
+class LRUCache(object):
+    """Bytes cache bounded in memory, evicted entries spill to disk.
+
+    Disk entries survive restarts, the least recently written ones are
+    dropped once max_disk bytes are used.
+    """
+    def __init__(self, max_memory, max_disk=0, disk_dir=None):
+        self.max_memory = max_memory
+        self.max_disk = max_disk if disk_dir else 0
+        self.disk_dir = disk_dir
+        self.memory = collections.OrderedDict()
+        self.memory_bytes = 0
+        self.disk = collections.OrderedDict()
+        self.disk_bytes = 0
+        self.lock = threading.Lock()
+        if self.max_disk:
+            if not os.path.isdir(disk_dir):
+                os.makedirs(disk_dir)
+            paths = [os.path.join(disk_dir, f) for f in os.listdir(disk_dir)
+                     if not f.startswith('.')]
+            for path in sorted(paths, key=os.path.getmtime):
+                self.disk[os.path.basename(path)] = os.path.getsize(path)
+                self.disk_bytes += self.disk[os.path.basename(path)]
+            self._trim_disk()
+
+    @staticmethod
+    def _fname(key):
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                return self.memory[key]
+            fname = self._fname(key)
+            if fname not in self.disk:
+                return None
+            path = os.path.join(self.disk_dir, fname)
+            try:
+                with open(path, 'rb') as fh:
+                    value = fh.read()
+            except (IOError, OSError):
+                self.disk_bytes -= self.disk.pop(fname)
+                return None
+            # promote, so that hot entries stay in memory
+            self.disk_bytes -= self.disk.pop(fname)
+            os.unlink(path)
+            self._put_memory(key, value)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            if key in self.memory:
+                self.memory_bytes -= len(self.memory.pop(key))
+            self._put_memory(key, value)
+
+    def _put_memory(self, key, value):
+        self.memory[key] = value
+        self.memory_bytes += len(value)
+        while self.memory_bytes > self.max_memory and self.memory:
+            old_key, old_value = self.memory.popitem(last=False)
+            self.memory_bytes -= len(old_value)
+            self._spill(old_key, old_value)
+
+    def _spill(self, key, value):
+        if not self.max_disk or len(value) > self.max_disk:
+            return
+        fname = self._fname(key)
+        fd, tmp_path = tempfile.mkstemp(dir=self.disk_dir, prefix='.tmp-')
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(value)
+        os.rename(tmp_path, os.path.join(self.disk_dir, fname))
+        self.disk_bytes -= self.disk.pop(fname, 0)
+        self.disk[fname] = len(value)
+        self.disk_bytes += len(value)
+        self._trim_disk()
+
+    def _trim_disk(self):
+        while self.disk_bytes > self.max_disk and self.disk:
+            fname, size = self.disk.popitem(last=False)
+            self.disk_bytes -= size
+            try:
+                os.unlink(os.path.join(self.disk_dir, fname))
+            except (IOError, OSError):
+                pass
+
+
+class SingleFlight(object):
+    """Merge concurrent calls with the same key into one."""
+    Call = collections.namedtuple('Call', 'event outcome')
+
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+        self.merged = 0
+
+    def do(self, key, fn):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = self.Call(threading.Event(), [])
+            else:
+                self.merged += 1
+        if not leader:
+            call.event.wait()
+        else:
+            try:
+                call.outcome.append((True, fn()))
+            except Exception as e:
+                call.outcome.append((False, e))
+            finally:
+                with self.lock:
+                    del self.calls[key]
+                call.event.set()
+        ok, value = call.outcome[0]
+        if not ok:
+            raise value
+        return value
+
+
+class QueryCache(object):
+    def __init__(self, upstream, cache, bucket_steps=120, settle=60,
+                 timeout=120, clock=time.time):
+        self.upstream = upstream.rstrip('/')
+        self.cache = cache
+        self.bucket_steps = bucket_steps
+        self.settle = settle
+        self.timeout = timeout
+        self.clock = clock
+        self.flights = SingleFlight()
+        self.stats = collections.Counter()
+
+    def fetch(self, query, start, end, step):
+        """Run a range query upstream, returns the matrix result list."""
+        params = urlencode([('query', query),
+                            ('start', '{:.3f}'.format(start)),
+                            ('end', '{:.3f}'.format(end)),
+                            ('step', '{:.3f}'.format(step))])
+
+        def get():
+            self.stats['upstream_requests'] += 1
+            url = '{}{}?{}'.format(self.upstream, QUERY_RANGE, params)
+            try:
+                with urlopen(url, timeout=self.timeout) as fh:
+                    body = fh.read()
+            except HTTPError as e:
+                raise UpstreamError(e.code, e.read())
+            except (URLError, OSError) as e:
+                raise unavailable(e)
+            response = json.loads(body.decode('utf-8'))
+            if (response.get('status') != 'success' or
+                    response['data'].get('resultType') != 'matrix'):
+                raise UpstreamError(422, body)
+            return response['data']['result']
+        return self.flights.do(params, get)
+
+    def bucket(self, query, step, index):
+        """Result of a completed bucket, from the cache if possible."""
+        key = json.dumps([query, step, index])
+        cached = self.cache.get(key)
+        if cached is not None:
+            self.stats['hits'] += 1
+            return json.loads(cached.decode('utf-8'))
+        self.stats['misses'] += 1
+        width = step * self.bucket_steps
+        result = self.fetch(query, index * width,
+                            (index + 1) * width - step, step)
+        self.cache.put(key, json.dumps(result).encode('utf-8'))
+        return result
+
+    def query_range(self, query, start, end, step):
+        """Evaluate a range query at multiples of step, bucket by bucket."""
+        first = math.ceil(start / step) * step
+        width = step * self.bucket_steps
+        complete_before = self.clock() - self.settle
+        series = collections.OrderedDict()
+        if first <= end:
+            for index in range(int(first // width), int(end // width) + 1):
+                bucket_end = (index + 1) * width - step
+                if bucket_end <= complete_before:
+                    result = self.bucket(query, step, index)
+                else:
+                    # still open, only this part is evaluated every time
+                    self.stats['open_buckets'] += 1
+                    result = self.fetch(query, max(first, index * width),
+                                        min(end, bucket_end), step)
+                for s in result:
+                    key = json.dumps(s['metric'], sort_keys=True)
+                    merged = series.setdefault(
+                        key, {'metric': s['metric'], 'values': []})
+                    merged['values'].extend(v for v in s['values']
+                                            if first <= v[0] <= end)
+        return {'status': 'success', 'data': {
+            'resultType': 'matrix',
+            'result': [s for s in series.values() if s['values']]}}
+
+    def metrics(self):
+        lines = ['prometheus_query_cache_{}_total {}'.format(k, v)
+                 for k, v in sorted(self.stats.items())]
+        lines.append('prometheus_query_cache_merged_requests_total {}'.format(
+            self.flights.merged))
+        lines.append('prometheus_query_cache_memory_bytes {}'.format(
+            self.cache.memory_bytes))
+        lines.append('prometheus_query_cache_disk_bytes {}'.format(
+            self.cache.disk_bytes))
+        return '\n'.join(lines) + '\n'
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def make_server(address, query_cache):
+    class Handler(BaseHTTPRequestHandler):
+        def send_body(self, status, body, content_type='application/json'):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def request_body(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            return self.rfile.read(length) if length else b''
+
+        def handle_request(self):
+            url = urlparse(self.path)
+            body = self.request_body()
+            if url.path == METRICS_PATH:
+                self.send_body(200, query_cache.metrics().encode('utf-8'),
+                               'text/plain; version=0.0.4')
+                return
+            if url.path == QUERY_RANGE:
+                params = parse_qs(url.query)
+                params.update(parse_qs(body.decode('utf-8')))
+                try:
+                    args = (params['query'][0],
+                            float(params['start'][0]),
+                            float(params['end'][0]),
+                            parse_duration(params['step'][0]))
+                except (KeyError, ValueError):
+                    # e.g. RFC3339 times, let prometheus deal with them
+                    args = None
+                if args and args[3] > 0:
+                    try:
+                        response = query_cache.query_range(*args)
+                    except UpstreamError as e:
+                        self.send_body(e.status, e.body)
+                        return
+                    self.send_body(200, json.dumps(response).encode('utf-8'))
+                    return
+            self.proxy(body)
+
+        def proxy(self, body):
+            headers = {}
+            if self.headers.get('Content-Type'):
+                headers['Content-Type'] = self.headers['Content-Type']
+            request = Request(query_cache.upstream + self.path,
+                              data=body if self.command == 'POST' else None,
+                              headers=headers, method=self.command)
+            try:
+                response = urlopen(request, timeout=query_cache.timeout)
+            except HTTPError as e:
+                response = e
+            except (URLError, OSError) as e:
+                error = unavailable(e)
+                self.send_body(error.status, error.body)
+                return
+            with response:
+                self.send_response(response.getcode())
+                for header in ('Content-Type', 'Content-Length',
+                               'Content-Encoding'):
+                    if response.headers.get(header):
+                        self.send_header(header, response.headers[header])
+                self.end_headers()
+                while True:
+                    chunk = response.read(READ_CHUNK)
+                    if not chunk:
+                        break
+                    self.wfile.write(chunk)
+
+        do_GET = do_POST = handle_request
+
+        def log_message(self, *args):
+            pass
+
+    return ThreadingHTTPServer(address, Handler)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--listen', default=':9091',
+                        help='[host]:port to listen on')
+    parser.add_argument('--upstream', default='http://localhost:9090')
+    parser.add_argument('--memory-mb', type=int, default=256)
+    parser.add_argument('--disk-mb', type=int, default=1024)
+    parser.add_argument('--cache-dir',
+                        default='/var/cache/prometheus-query-cache')
+    parser.add_argument('--bucket-steps', type=int, default=120,
+                        help='evaluation steps per cached bucket')
+    parser.add_argument('--settle', type=float, default=60,
+                        help='seconds before a bucket is considered complete')
+    args = parser.parse_args(argv)
+    host, _, port = args.listen.rpartition(':')
+    cache = LRUCache(args.memory_mb * 1024 * 1024,
+                     args.disk_mb * 1024 * 1024, args.cache_dir)
+    server = make_server((host, int(port)), QueryCache(
+        args.upstream, cache, args.bucket_steps, args.settle))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
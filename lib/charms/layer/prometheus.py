@@ -0,0 +1,49 @@
+"""Helpers shared by the reactive handlers and the actions."""
+import re
+
+DURATION_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600, 'd': 86400,
+                  'w': 604800, 'y': 31536000}
+DURATION_RE = re.compile(r'(\d+(?:\.\d+)?)(ms|[smhdwy])')
+
+
+def parse_duration(value):
+    """Seconds of a prometheus or go duration, e.g. "5m" or "15m0s"."""
+    value = str(value)
+    parts = DURATION_RE.findall(value)
+    if not parts or ''.join(n + u for n, u in parts) != value:
+        raise ValueError('Invalid duration {}'.format(value))
+    return sum(float(n) * DURATION_UNITS[u] for n, u in parts)
+
+
+def parse_metrics(lines, names=None):
+    """{'metric{labels}': float} from text exposition format lines.
+
+    Only metrics whose name is in names are kept, if given.
+    """
+    metrics = {}
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        name, _, value = line.rpartition(' ')
+        if names is not None and name.split('{')[0] not in names:
+            continue
+        try:
+            metrics[name] = float(value)
+        except ValueError:
+            continue
+    return metrics
+
+
+def self_metrics(port, timeout, names=None):
+    """Scrape the local prometheus /metrics endpoint, see parse_metrics().
+
+    Raises IOError/OSError if the server can't be reached.
+    """
+    # slow to import, keep it off the hook startup path
+    from urllib.request import urlopen
+    with urlopen('http://localhost:{}/metrics'.format(port),
+                 timeout=timeout) as fh:
+        return parse_metrics(fh, names)
@@ -1,17 +1,42 @@
+import hashlib
+import importlib
+import json
 import os
 import pwd
+import re
 import subprocess
+import tempfile
+import time
+import yaml
+from contextlib import contextmanager
 
-from charmhelpers import fetch
 from charmhelpers.core import host, hookenv, unitdata
 from charmhelpers.core.templating import render
 from charmhelpers.payload.execd import execd_preinstall
-from charmhelpers.contrib.charmsupport import nrpe
+from charms.layer import prometheus as layer_prometheus
 from charms.reactive import (
     when, when_not, set_state, remove_state, is_state, hook
 )
 from charms.reactive.helpers import any_file_changed, data_changed
 
+
+class LazyModule(object):
+    """Module imported on first use, to keep it off the hook startup path.
+    """
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+# only needed by a few handlers, and slow to import
+fetch = LazyModule('charmhelpers.fetch')
+nrpe = LazyModule('charmhelpers.contrib.charmsupport.nrpe')
+
 SVCNAME = 'prometheus'
 PKGNAMES = ['prometheus']
 PROMETHEUS_YML = '/etc/prometheus/prometheus.yml'
@@ -19,6 +44,161 @@ PROMETHEUS_DEF = '/etc/default/prometheus'
 PROMETHEUS_YML_TMPL = 'prometheus.yml.j2'
 PROMETHEUS_DEF_TMPL = 'etc_default_prometheus.j2'
 CUSTOM_RULES_PATH = '/etc/prometheus/custom.rules'
+TARGETS_DIR = '/etc/prometheus/targets'
+RULES_DIR = '/etc/prometheus/rules'
+PEER_RELATION = 'prometheus-peers'
+JOB_SETTINGS = ('scrape_interval', 'scrape_timeout', 'sample_limit')
+ALL_JOBS = 'all-jobs'
+TARGET_SOURCES = ('static', 'scrape', 'target')
+SOURCE_LABELS = {
+    'static': {'group': 'promoagents-static'},
+    'scrape': {},
+    'target': {'group': 'promoagents-juju'},
+}
+BUILTIN_RULES = [
+    'job:up:avg = avg(up{{job="{job}"}}) by (job)',
+    'job:scrape_duration_seconds:max = '
+    'max(scrape_duration_seconds{{job="{job}"}}) by (job)',
+    'job:scrape_samples_scraped:sum = '
+    'sum(scrape_samples_scraped{{job="{job}"}}) by (job)',
+    'job:http_requests:rate5m = '
+    'sum(rate(http_requests_total{{job="{job}"}}[5m])) by (job)',
+]
+RELOAD_CHECK_TIMEOUT = 30
+# restart grants not released within this many restart-ready-timeouts
+# (at least RESTART_GRANT_MIN seconds each) are revoked by the leader
+RESTART_GRANT_EXPIRY = 3
+RESTART_GRANT_MIN = 60
+READY_POLL_INTERVAL = 5
+# samples ingested since start, in prometheus 1.x and 2.x
+INGESTED_SAMPLES_METRICS = ('prometheus_local_storage_ingested_samples_total',
+                            'prometheus_tsdb_head_samples_appended_total')
+VALIDATED_CACHE = 16
+CHARM_METRICS_DIR = '/var/lib/prometheus/charm-assets'
+CHARM_METRICS_FILE = 'charm.prom'
+# first release taking a comma separated list of -alertmanager.url
+MULTI_ALERTMANAGER_VERSION = (1, 4, 0)
+# first release supporting sample_limit in scrape configs
+SAMPLE_LIMIT_VERSION = (1, 6, 0)
+
+# storage sizing, see storage_sizing()
+CHUNK_RSS_BYTES = 3 * 1024
+SERIES_PER_TARGET = 1000
+DEFAULT_MEMORY_CHUNKS = 1048576
+MIN_MEMORY_CHUNKS = 65536
+DEFAULT_INDEX_CACHE_SIZES = {
+    '-storage.local.index-cache-size.fingerprint-to-metric': 10485760,
+    '-storage.local.index-cache-size.fingerprint-to-timerange': 5242880,
+    '-storage.local.index-cache-size.label-name-to-label-values': 10485760,
+    '-storage.local.index-cache-size.label-pair-to-fingerprints': 20971520,
+}
+# storage performance profiles, readahead is in 512 byte sectors.
+# chunk encoding 2 (varbit) needs prometheus >= 1.0, the packaged one only
+# supports 0 and 1 (see etc_default_prometheus.j2)
+STORAGE_PROFILES = {
+    'hdd': {
+        'readahead': 1024,
+        'flags': {
+            '-storage.local.series-sync-strategy': 'adaptive',
+            '-storage.local.checkpoint-interval': '5m0s',
+            '-storage.local.checkpoint-dirty-series-limit': 5000,
+            '-storage.local.chunk-encoding-version': 1,
+        },
+    },
+    'ssd': {
+        'readahead': 256,
+        'flags': {
+            '-storage.local.series-sync-strategy': 'adaptive',
+            '-storage.local.checkpoint-interval': '15m0s',
+            '-storage.local.checkpoint-dirty-series-limit': 50000,
+            '-storage.local.chunk-encoding-version': 1,
+        },
+    },
+    'nvme': {
+        'readahead': 128,
+        'flags': {
+            '-storage.local.series-sync-strategy': 'adaptive',
+            '-storage.local.checkpoint-interval': '30m0s',
+            '-storage.local.checkpoint-dirty-series-limit': 100000,
+            '-storage.local.chunk-encoding-version': 1,
+        },
+    },
+}
+STORAGE_PROFILE_FLAGS = sorted(STORAGE_PROFILES['hdd']['flags'])
+REMOTE_STORAGE_FLAGS = [
+    '-storage.remote.influxdb-url',
+    '-storage.remote.influxdb.database',
+    '-storage.remote.influxdb.retention-policy',
+    '-storage.remote.opentsdb-url',
+    '-storage.remote.timeout',
+    '-storage.local.retention',
+]
+QUERY_CACHE_SVC = 'prometheus-query-cache'
+QUERY_CACHE_BIN = '/usr/local/bin/prometheus-query-cache'
+QUERY_CACHE_DIR = '/var/cache/prometheus-query-cache'
+QUERY_CACHE_SYSTEMD = '/etc/systemd/system/prometheus-query-cache.service'
+QUERY_CACHE_UPSTART = '/etc/init/prometheus-query-cache.conf'
+# system user the query cache runs as, created if the package has none
+QUERY_CACHE_USER = 'prometheus'
+NAGIOS_PLUGINS_DIR = '/usr/local/lib/nagios/plugins'
+PERF_CHECK = 'check_prometheus_perf'
+# see files/check_prometheus_perf.py
+PERF_CHECKS = [
+    ('persistence', 'Prometheus storage persistence backlog'),
+    ('ingestion', 'Prometheus throttled or rate-limited ingestion'),
+    ('scrape', 'Prometheus scrape duration against scrape interval'),
+    ('rules', 'Prometheus rule evaluation duration against interval'),
+    ('query', 'Prometheus query latency'),
+]
+BLOCK_MOUNT_POINT = '/srv/prometheus'
+BLOCK_MOUNT_OPTIONS = 'noatime,nodiratime'
+# blockdev --setra doesn't survive reboots, udev applies it again
+READAHEAD_UDEV_RULE = '/etc/udev/rules.d/60-prometheus-readahead.rules'
+STORAGE_SIZING_FLAGS = [
+    '-storage.local.memory-chunks',
+    '-storage.local.max-chunks-to-persist',
+] + sorted(DEFAULT_INDEX_CACHE_SIZES)
+
+
+class HookKV(object):
+    """unitdata view which reads and decodes each key once per hook.
+
+    Handlers read the (possibly large) job lists several times per hook.
+    Writes go through to unitdata, which commits them all in a single
+    transaction when the hook exits. Values returned by get() are shared,
+    set() them back after changing them.
+    """
+    _missing = object()
+
+    def __init__(self, store):
+        self.store = store
+        self.values = {}
+
+    def get(self, key, default=None):
+        if key not in self.values:
+            self.values[key] = self.store.get(key, self._missing)
+        value = self.values[key]
+        return default if value is self._missing else value
+
+    def set(self, key, value):
+        self.store.set(key, value)
+        self.values[key] = value
+        return value
+
+    def unset(self, key):
+        self.store.unset(key)
+        self.values[key] = self._missing
+
+
+_hook_kv = None
+
+
+def hook_kv():
+    global _hook_kv
+    store = unitdata.kv()
+    if _hook_kv is None or _hook_kv.store is not store:
+        _hook_kv = HookKV(store)
+    return _hook_kv
 
 
 @when_not('basenode.complete')
@@ -27,16 +207,195 @@ def basenode():
     set_state('basenode.complete')
 
 
+def charm_metrics_enabled():
+    return bool(hookenv.config().get('charm-metrics'))
+
+
+_charm_metrics_store = None
+
+
+def schedule_charm_metrics():
+    """Write the charm's metrics once, when the hook completes."""
+    global _charm_metrics_store
+    store = unitdata.kv()
+    if _charm_metrics_store is not store:
+        _charm_metrics_store = store
+        hookenv.atexit(write_charm_metrics)
+
+
+@contextmanager
+def timed(operation):
+    """Record the duration of operation for the charm's own metrics."""
+    start = time.time()
+    try:
+        yield
+    finally:
+        if charm_metrics_enabled():
+            kv = hook_kv()
+            durations = kv.get('charm_metrics.durations', {})
+            d = durations.setdefault(operation,
+                                     {'count': 0, 'sum': 0.0, 'last': 0.0})
+            d['last'] = time.time() - start
+            d['sum'] += d['last']
+            d['count'] += 1
+            kv.set('charm_metrics.durations', durations)
+            schedule_charm_metrics()
+
+
+def write_charm_metrics():
+    """Write the charm's metrics in the text exposition format.
+
+    The file is served by prometheus itself from -web.user-assets and
+    scraped by the prometheus-charm job.
+    """
+    kv = hook_kv()
+    durations = kv.get('charm_metrics.durations', {})
+    targets = kv.get('charm_metrics.targets', {})
+    lines = [
+        '# HELP prometheus_charm_duration_seconds Duration of charm '
+        'handlers and operations (render, validate, restart, reload).',
+        '# TYPE prometheus_charm_duration_seconds summary',
+    ]
+    for op in sorted(durations):
+        lines.append('prometheus_charm_duration_seconds_sum'
+                     '{{operation="{}"}} {}'.format(op, durations[op]['sum']))
+        lines.append('prometheus_charm_duration_seconds_count'
+                     '{{operation="{}"}} {}'.format(
+                         op, durations[op]['count']))
+    lines.extend([
+        '# HELP prometheus_charm_last_duration_seconds Duration of the last '
+        'run of charm handlers and operations.',
+        '# TYPE prometheus_charm_last_duration_seconds gauge',
+    ])
+    for op in sorted(durations):
+        lines.append('prometheus_charm_last_duration_seconds'
+                     '{{operation="{}"}} {}'.format(op, durations[op]['last']))
+    lines.extend([
+        '# HELP prometheus_charm_configured_targets Number of targets '
+        'configured by the charm per job.',
+        '# TYPE prometheus_charm_configured_targets gauge',
+    ])
+    for job in sorted(targets):
+        lines.append('prometheus_charm_configured_targets{{job="{}"}} {}'
+                     .format(job, targets[job]))
+    restart = kv.get('prometheus.restart') or {}
+    if restart.get('downtime') is not None:
+        lines.extend([
+            '# HELP prometheus_charm_last_restart_downtime_seconds Time '
+            'from stopping prometheus to it being ready again.',
+            '# TYPE prometheus_charm_last_restart_downtime_seconds gauge',
+            'prometheus_charm_last_restart_downtime_seconds {}'.format(
+                restart['downtime']),
+        ])
+    if not os.path.isdir(CHARM_METRICS_DIR):
+        os.makedirs(CHARM_METRICS_DIR)
+    write_atomic(os.path.join(CHARM_METRICS_DIR, CHARM_METRICS_FILE),
+                 '\n'.join(lines) + '\n')
+
+
+def record_configured_targets(config, target_jobs, scrape_jobs):
+    if not charm_metrics_enabled():
+        return
+    targets = {}
+    for job in target_jobs + scrape_jobs:
+        targets[job['job_name']] = count_targets([job])
+    static_targets = get_static_targets(config)
+    if static_targets:
+        targets['static-targets'] = len(static_targets)
+    hook_kv().set('charm_metrics.targets', targets)
+
+
+def update_charm_metrics_args():
+    runtime_args('-web.user-assets',
+                 CHARM_METRICS_DIR if charm_metrics_enabled() else None)
+
+
 def templates_changed(tmpl_list):
     return any_file_changed(['templates/{}'.format(x) for x in tmpl_list])
 
 
+def storage_profile():
+    profile = hookenv.config().get('storage-profile')
+    if profile and profile not in STORAGE_PROFILES:
+        hookenv.log('Unknown storage-profile {}, ignoring'.format(profile),
+                    hookenv.WARNING)
+        return None
+    return STORAGE_PROFILES.get(profile)
+
+
+def prepare_block_device(device):
+    """Create a filesystem on device unless it has one, and mount it.
+
+    Returns the mount point.
+    """
+    fstype = hookenv.config().get('storage-filesystem') or 'ext4'
+    try:
+        existing = subprocess.check_output(
+            ['blkid', '-o', 'value', '-s', 'TYPE', device]).decode().strip()
+    except subprocess.CalledProcessError:
+        existing = None
+    if existing:
+        fstype = existing
+    else:
+        hookenv.log('Creating {} filesystem on {}'.format(fstype, device))
+        subprocess.check_call(['mkfs', '-t', fstype, device])
+    apply_readahead(device)
+    host.mkdir(BLOCK_MOUNT_POINT)
+    if not os.path.ismount(BLOCK_MOUNT_POINT):
+        host.mount(device, BLOCK_MOUNT_POINT, options=BLOCK_MOUNT_OPTIONS,
+                   persist=True, filesystem=fstype)
+    return BLOCK_MOUNT_POINT
+
+
+def apply_readahead(device):
+    """Set the storage profile's readahead on device, now and on boot.
+
+    The udev rule matches the filesystem UUID, device names can change.
+    """
+    readahead = (storage_profile() or {}).get('readahead')
+    kv = hook_kv()
+    if readahead is None:
+        if os.path.exists(READAHEAD_UDEV_RULE):
+            os.unlink(READAHEAD_UDEV_RULE)
+        kv.unset('storage-readahead')
+        return
+    # called on every hook, skip blkid when nothing changed
+    if (kv.get('storage-readahead') == [device, readahead] and
+            os.path.exists(READAHEAD_UDEV_RULE)):
+        return
+    uuid = subprocess.check_output(
+        ['blkid', '-o', 'value', '-s', 'UUID', device]).decode().strip()
+    rule = ('# managed by the prometheus charm, see storage-profile\n'
+            'ACTION=="add|change", SUBSYSTEM=="block", '
+            'ENV{{ID_FS_UUID}}=="{}", '
+            'RUN+="/sbin/blockdev --setra {} $devnode"\n'.format(
+                uuid, readahead))
+    if write_atomic(READAHEAD_UDEV_RULE, rule):
+        subprocess.check_call(['blockdev', '--setra', str(readahead),
+                               device])
+    kv.set('storage-readahead', [device, readahead])
+
+
+def update_storage_profile():
+    flags = dict.fromkeys(STORAGE_PROFILE_FLAGS)
+    flags.update((storage_profile() or {}).get('flags', {}))
+    for flag, value in flags.items():
+        runtime_args(flag, value)
+    device = hook_kv().get('storage-device')
+    if device:
+        apply_readahead(device)
+
+
 # TODO: once there's reactive support for storage hooks, convert off @hook()
 @hook('metrics-{filesystem,block}-storage-attached')
 def configure_storage():
     storage_path = subprocess.check_output(
         ['storage-get', 'location']).decode().strip()
-    kv = unitdata.kv()
+    kv = hook_kv()
+    if hookenv.hook_name().startswith('metrics-block'):
+        # block storage location is the device, not a directory
+        kv.set('storage-device', storage_path)
+        storage_path = prepare_block_device(storage_path)
     kv.set('storage-path', storage_path)
     runtime_args('-storage.local.path', storage_path)
     set_state('storage.configured')
@@ -44,7 +403,7 @@ def configure_storage():
 
 
 def set_datadir_perms():
-    datadir = unitdata.kv().get('storage-path', False)
+    datadir = hook_kv().get('storage-path', False)
     if not datadir:
         # No juju storage attached, use defaults from package
         return
@@ -61,63 +420,478 @@ def install_packages():
     remove_state('prometheus.do-install')
 
 
+def prometheus_version():
+    """(major, minor, patch) of the installed prometheus, None if unknown.
+    """
+    try:
+        output = subprocess.check_output(
+            [SVCNAME, '-version'], stderr=subprocess.STDOUT)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    match = re.search(r'version (\d+)\.(\d+)\.(\d+)',
+                      output.decode('utf-8', 'replace'))
+    return tuple(int(i) for i in match.groups()) if match else None
+
+
 def runtime_args(key=None, value=None):
-    kv = unitdata.kv()
+    kv = hook_kv()
     args = kv.get('runtime_args', {})
-    if key:
-        args.update({key: value})
+    # called for every flag on every hook, only write actual changes
+    if key and args.get(key) != value:
+        args[key] = value
         kv.set('runtime_args', args)
     args_list = ['{} {}'.format(k, v) for k, v in args.items() if v]
     # sorted list is needed to avoid data_changed() false-positives
     return sorted(args_list)
 
 
-def validate_config():
-    subprocess.check_call(['promtool', 'check-config', PROMETHEUS_YML])
+def get_static_targets(config):
+    # transform eg. 'h1:p1 ,  h2:p2' (string), to ['h1:p1', 'h2:p2'] (list)
+    if not config.get('static-targets'):
+        return None
+    return [x.strip() for x in config.get('static-targets', '').split(',')]
 
 
-@when('prometheus.do-reconfig-yml')
-def write_prometheus_config_yml():
-    config = hookenv.config()
-    target_jobs = unitdata.kv().get('target_jobs', [])
-    scrape_jobs = unitdata.kv().get('scrape_jobs', [])
+def group_targets(labelled_targets):
+    """Group (labels, targets) pairs into target groups sharing a label set.
 
-    # transform eg. 'h1:p1 ,  h2:p2' (string), to ['h1:p1', 'h2:p2'] (list)
-    static_targets = None
-    if config.get('static-targets'):
-        static_targets = [x.strip()
-                          for x in config.get('static-targets', '').split(',')]
+    Groups are ordered by label set and targets by address, so that the
+    rendered config only changes when the targets really do.
+    """
+    groups = {}
+    for labels, targets in labelled_targets:
+        key = tuple(sorted((labels or {}).items()))
+        groups.setdefault(key, set()).update(targets)
+    result = []
+    for key in sorted(groups):
+        group = {'targets': sorted(groups[key])}
+        if key:
+            group['labels'] = dict(key)
+        result.append(group)
+    return result
 
-    default_monitor_name = '{}-monitor'.format(hookenv.service_name())
-    options = {
-        'scrape_interval': config['scrape-interval'],
-        'evaluation_interval': config['evaluation-interval'],
-        'static_targets': static_targets,
-        'private_address': hookenv.unit_get('private-address'),
-        'monitor_name': config.get('monitor_name', default_monitor_name),
-        'jobs': target_jobs,
-        'scrape_jobs': scrape_jobs,
+
+def quoted_target_groups(jobs):
+    """Jobs with their target lists as YAML flow sequences, for rendering.
+
+    Quoting thousands of targets one by one in the template is much slower.
+    """
+    def flow(targets):
+        # quote all targets at once, NUL can't be part of an address
+        joined = '\0'.join(targets).replace("'", "''")
+        return "['{}']".format(joined.replace('\0', "', '"))
+
+    result = []
+    for job in jobs:
+        if 'target_groups' in job:
+            job = dict(job, target_groups=[
+                dict(group, targets=flow(group['targets']))
+                for group in job['target_groups']])
+        result.append(job)
+    return result
+
+
+def normalize_jobs(config, target_jobs, scrape_jobs):
+    """Dedupe, sort and group the targets of all sources before rendering.
+
+    A host:port scraped on the same metrics path by several jobs is only
+    kept in the job of the first source listed in target-precedence (the
+    first job by name within a source). Returns {source: jobs}, with jobs
+    sorted by name and holding 'target_groups' instead of 'targets'; jobs
+    left without targets are dropped.
+    """
+    sources = {
+        'static': [{'job_name': 'static-targets',
+                    'targets': get_static_targets(config) or []}],
+        'scrape': scrape_jobs,
+        'target': target_jobs,
     }
+    precedence = [s.strip() for s in
+                  (config.get('target-precedence') or '').split(',')
+                  if s.strip() in sources]
+    seen = {}
+    result = {}
+    for source in precedence + [s for s in TARGET_SOURCES
+                                if s not in precedence]:
+        result[source] = []
+        for job in sorted(sources[source], key=lambda j: j['job_name']):
+            targets = set(job['targets'])
+            if source in precedence:
+                path_seen = seen.setdefault(
+                    job.get('metrics_path') or '/metrics', set())
+                kept = targets - path_seen
+                path_seen.update(kept)
+                if len(kept) < len(targets):
+                    hookenv.log('Dropped {} targets of {} already scraped '
+                                'by another job'.format(
+                                    len(targets) - len(kept),
+                                    job['job_name']))
+                targets = kept
+            if not targets:
+                continue
+            job = {k: v for k, v in job.items() if k != 'targets'}
+            job['target_groups'] = group_targets(
+                [(SOURCE_LABELS[source], targets)])
+            result[source].append(job)
+    return result
 
-    # custom-rules content must be passed verbatim with e.g.
-    #   juju set prometheus custom-rules @my.rules
-    if config.get('custom-rules'):
-        custom_rules = config['custom-rules']
-        with open(CUSTOM_RULES_PATH, 'w') as fh:
-            fh.write(custom_rules)
-        options['custom_rules_file'] = CUSTOM_RULES_PATH
 
-    render(source=PROMETHEUS_YML_TMPL,
-           target=PROMETHEUS_YML,
-           context=options
-           )
-    validate_config()
-    set_state('prometheus.do-restart')
-    remove_state('prometheus.do-reconfig-yml')
+def count_targets(jobs):
+    # stored jobs always list their targets, also in file-sd mode
+    return sum(len(job.get('targets', [])) for job in jobs)
+
+
+def storage_sizing(total_ram, num_targets, ram_percent):
+    """Compute local storage memory flags from RAM and target count.
+
+    Each in-memory chunk costs roughly 3KiB of RSS (1KiB of data plus
+    bookkeeping), so memory-chunks is capped at ram_percent of total_ram.
+    Below that cap it is sized for ~3 chunks per expected series, rounded
+    up to a power of two so that target churn rarely changes the flags (and
+    with them, triggers a restart). Index caches scale with memory-chunks.
+    """
+    budget_chunks = int(total_ram * ram_percent / 100 / CHUNK_RSS_BYTES)
+    demand_chunks = max(num_targets * SERIES_PER_TARGET * 3,
+                        DEFAULT_MEMORY_CHUNKS)
+    demand_chunks = 1 << (demand_chunks - 1).bit_length()
+    memory_chunks = max(min(budget_chunks, demand_chunks), MIN_MEMORY_CHUNKS)
+    scale = float(memory_chunks) / DEFAULT_MEMORY_CHUNKS
+    flags = {
+        '-storage.local.memory-chunks': memory_chunks,
+        '-storage.local.max-chunks-to-persist': memory_chunks // 2,
+    }
+    for flag, default in DEFAULT_INDEX_CACHE_SIZES.items():
+        flags[flag] = int(default * scale)
+    return flags
+
+
+def update_storage_sizing():
+    config = hookenv.config()
+    flags = dict.fromkeys(STORAGE_SIZING_FLAGS)
+    if config.get('storage-auto-sizing'):
+        kv = hook_kv()
+        num_targets = (
+            count_targets(kv.get('target_jobs', [])) +
+            count_targets(kv.get('scrape_jobs', [])) +
+            len(get_static_targets(config) or []))
+        flags.update(storage_sizing(host.get_total_ram(), num_targets,
+                                    config.get('storage-ram-percent') or 50))
+    if config.get('storage-memory-chunks'):
+        memory_chunks = config['storage-memory-chunks']
+        flags['-storage.local.memory-chunks'] = memory_chunks
+        flags['-storage.local.max-chunks-to-persist'] = memory_chunks // 2
+    for flag, value in flags.items():
+        runtime_args(flag, value)
+
+
+def file_hash(path):
+    try:
+        with open(path, 'rb') as fh:
+            return hashlib.sha256(fh.read()).hexdigest()
+    except (IOError, OSError):
+        return None
+
+
+def peer_units():
+    """Sorted list of all prometheus units, including the local one."""
+    units = [hookenv.local_unit()]
+    for rid in hookenv.relation_ids(PEER_RELATION):
+        units.extend(hookenv.related_units(rid))
+    return sorted(set(units), key=lambda u: int(u.split('/')[-1]))
+
+
+def shard_config():
+    """hashmod shards of the relation and static targets this unit scrapes.
+
+    Units are numbered by their position in peer_units(), unit i scrapes
+    shards i to i + shard-replicas - 1 (modulo the number of units). Returns
+    None when sharding is disabled or there's nothing to share with.
+    """
+    config = hookenv.config()
+    if not config.get('sharding'):
+        return None
+    units = hook_kv().get('peer_units') or [hookenv.local_unit()]
+    modulus = len(units)
+    replicas = min(max(config.get('shard-replicas') or 1, 1), modulus)
+    if replicas == modulus:
+        return None
+    index = units.index(hookenv.local_unit())
+    shards = sorted((index + i) % modulus for i in range(replicas))
+    return {'modulus': modulus, 'shards': shards}
+
+
+@hook('{}-relation-{{joined,changed,departed}}'.format(PEER_RELATION))
+def update_peers():
+    hook_kv().set('peer_units', peer_units())
+    set_state('prometheus.do-check-reconfig')
+
+
+def yaml_map_option(name):
+    """Parse a config option holding a YAML map, {} if unset or invalid."""
+    try:
+        value = yaml.safe_load(hookenv.config().get(name) or '')
+    except yaml.YAMLError as e:
+        hookenv.log('Invalid {}: {}'.format(name, e), hookenv.ERROR)
+        return {}
+    if not isinstance(value, dict):
+        return {}
+    return value
+
+
+def job_relabel_rules(job, relabel):
+    """metric_relabel_configs of a job, as flow-style (JSON) YAML strings.
+
+    Rules sent over the relation come first, then the job-specific and
+    all-jobs rules from the metric-relabel-configs option.
+    """
+    rules = job.get('metric_relabel_configs') or []
+    if not isinstance(rules, list):
+        try:
+            rules = json.loads(rules)
+        except ValueError as e:
+            hookenv.log('Invalid metric_relabel_configs sent for job {}, '
+                        'ignoring them: {}'.format(job['job_name'], e),
+                        hookenv.ERROR)
+            rules = []
+        if not isinstance(rules, list):
+            hookenv.log('Invalid metric_relabel_configs sent for job {}, '
+                        'expected a list'.format(job['job_name']),
+                        hookenv.ERROR)
+            rules = []
+    rules = (rules + (relabel.get(job['job_name']) or []) +
+             (relabel.get(ALL_JOBS) or []))
+    return [json.dumps(rule, sort_keys=True) for rule in rules]
+
+
+def apply_job_settings(jobs, sample_limit=True):
+    """Merge job-settings and metric-relabel-configs into the jobs.
+
+    job-settings override the scrape settings jobs got from relations.
+    sample_limit is dropped when prometheus doesn't support it.
+    """
+    settings = yaml_map_option('job-settings')
+    relabel = yaml_map_option('metric-relabel-configs')
+    result = []
+    for job in jobs:
+        job = dict(job)
+        overrides = settings.get(job['job_name']) or {}
+        for key in JOB_SETTINGS:
+            if overrides.get(key):
+                job[key] = overrides[key]
+        if job.get('sample_limit') and not sample_limit:
+            hookenv.log('Ignoring sample_limit of job {}, it needs prometheus '
+                        '>= {}'.format(job['job_name'], '.'.join(
+                            map(str, SAMPLE_LIMIT_VERSION))), hookenv.WARNING)
+            del job['sample_limit']
+        job['metric_relabel_configs'] = job_relabel_rules(job, relabel)
+        result.append(job)
+    return result
+
+
+def rule_files_of(path):
+    try:
+        with open(path) as fh:
+            return (yaml.safe_load(fh) or {}).get('rule_files') or []
+    except (IOError, OSError, yaml.YAMLError, AttributeError):
+        return []
+
+
+def config_digest(path=None):
+    """Hash of a config file and the rule files it loads."""
+    path = path or PROMETHEUS_YML
+    digest = hashlib.sha256()
+    for fname in [path] + rule_files_of(path):
+        digest.update((file_hash(fname) or '').encode())
+    return digest.hexdigest()
+
+
+def record_loaded_config():
+    """Remember the config prometheus runs with, after a reload or restart.
+    """
+    hook_kv().set('prometheus.loaded-digest', config_digest())
+
+
+def validate_config(path=None):
+    """Run promtool check-rules and check-config, caching successes.
+
+    The cache key covers the config file and the rule files it loads.
+    """
+    path = path or PROMETHEUS_YML
+    rule_files = rule_files_of(path)
+    digest = config_digest(path)
+    kv = hook_kv()
+    validated = kv.get('prometheus.validated', [])
+    if digest in validated:
+        return
+    if rule_files:
+        subprocess.check_call(['promtool', 'check-rules'] + rule_files)
+    subprocess.check_call(['promtool', 'check-config', path])
+    kv.set('prometheus.validated', (validated + [digest])[-VALIDATED_CACHE:])
+
+
+def rules_valid(path):
+    try:
+        subprocess.check_call(['promtool', 'check-rules', path])
+    except subprocess.CalledProcessError:
+        return False
+    return True
+
+
+def builtin_rules(jobs):
+    lines = []
+    for job in jobs:
+        job_name = job['job_name'].replace('"', '\\"')
+        lines.extend(rule.format(job=job_name) for rule in BUILTIN_RULES)
+    return '\n'.join(lines) + '\n'
+
+
+def read_file(path):
+    try:
+        with open(path) as fh:
+            return fh.read()
+    except (IOError, OSError):
+        return None
+
+
+def restore_files(previous):
+    """Put back files saved by path in previous, None removes them."""
+    for path, content in previous.items():
+        if content is not None:
+            write_atomic(path, content)
+        elif os.path.exists(path):
+            os.unlink(path)
+
+
+def write_rule_files(config, target_jobs, scrape_jobs, previous):
+    """Write all managed rule files under RULES_DIR.
+
+    These are the built-in per job recording rules, the rule-files option
+    and rules published over the scrape relation. Returns the sorted list of
+    rule files prometheus.yml should load and whether any of them changed.
+    The former content of changed files is saved in previous, see
+    restore_files().
+    """
+    if not os.path.isdir(RULES_DIR):
+        os.makedirs(RULES_DIR)
+    contents = {}
+    if config.get('builtin-recording-rules'):
+        contents['builtin-jobs.rules'] = builtin_rules(
+            target_jobs + scrape_jobs)
+    for name, content in yaml_map_option('rule-files').items():
+        contents['config-{}.rules'.format(
+            re.sub(r'[^\w.-]', '_', name))] = content
+    relation_rules = {}
+    for job in scrape_jobs:
+        if job.get('rules'):
+            fname = 'relation-{}.rules'.format(
+                re.sub(r'[^\w.-]', '_', job['job_name']))
+            contents[fname] = relation_rules[fname] = job['rules']
+    changed = False
+    paths = []
+    for fname, content in sorted(contents.items()):
+        path = os.path.join(RULES_DIR, fname)
+        previous.setdefault(path, read_file(path))
+        file_changed = write_atomic(path, content)
+        if fname in relation_rules and file_changed and not rules_valid(path):
+            hookenv.log('Ignoring invalid rules from the scrape relation: '
+                        '{}'.format(fname), hookenv.WARNING)
+            os.unlink(path)
+            continue
+        changed = changed or file_changed
+        paths.append(path)
+    for fname in os.listdir(RULES_DIR):
+        if fname.endswith('.rules') and fname not in contents:
+            path = os.path.join(RULES_DIR, fname)
+            previous.setdefault(path, read_file(path))
+            os.unlink(path)
+            changed = True
+    return paths, changed
+
+
+@when('prometheus.do-reconfig-yml')
+def write_prometheus_config_yml():
+    with timed('write_prometheus_config_yml'):
+        config = hookenv.config()
+        target_jobs = hook_kv().get('target_jobs', [])
+        scrape_jobs = hook_kv().get('scrape_jobs', [])
+        jobs = rendered_jobs(config)
+        # job-settings can override the federation-scrape-interval
+        federation_jobs = [
+            dict(job, target_groups=group_targets([(None, job['targets'])]),
+                 scrape_interval=config.get('federation-scrape-interval') or
+                 config['scrape-interval'])
+            for job in hook_kv().get('federation_jobs', [])]
+
+        sample_limit = (
+            (prometheus_version() or (0,)) >= SAMPLE_LIMIT_VERSION)
+        default_monitor_name = '{}-monitor'.format(hookenv.service_name())
+        options = {
+            'scrape_interval': config['scrape-interval'],
+            'evaluation_interval': config['evaluation-interval'],
+            'private_address': hookenv.unit_get('private-address'),
+            'port': config.get('port', '9090'),
+            'monitor_name': config.get('monitor_name', default_monitor_name),
+            'jobs': quoted_target_groups(
+                apply_job_settings(jobs['target'], sample_limit)),
+            'scrape_jobs': quoted_target_groups(
+                apply_job_settings(jobs['scrape'], sample_limit)),
+            'static_jobs': quoted_target_groups(
+                apply_job_settings(jobs['static'], sample_limit)),
+            'shard': shard_config(),
+            'federation_jobs': quoted_target_groups(
+                apply_job_settings(federation_jobs, sample_limit)),
+            'charm_metrics_path': (
+                '/user/{}'.format(CHARM_METRICS_FILE)
+                if charm_metrics_enabled() else None),
+        }
+
+        record_configured_targets(config, target_jobs, scrape_jobs)
+        # rule files are written in place for promtool to check them with
+        # the new config, and restored if it rejects them
+        previous = {}
+        rule_files, rules_changed = write_rule_files(config, target_jobs,
+                                                     scrape_jobs, previous)
+        # custom-rules content must be passed verbatim with e.g.
+        #   juju set prometheus custom-rules @my.rules
+        if config.get('custom-rules'):
+            custom_rules = config['custom-rules']
+            previous[CUSTOM_RULES_PATH] = read_file(CUSTOM_RULES_PATH)
+            if write_atomic(CUSTOM_RULES_PATH, custom_rules):
+                rules_changed = True
+            rule_files.insert(0, CUSTOM_RULES_PATH)
+        options['rule_files'] = rule_files
+
+        # render to a temp file, so that prometheus never sees a half-written
+        # or invalid config, and identical output skips validation and reload
+        new_yml = PROMETHEUS_YML + '.new'
+        with timed('render'):
+            render(source=PROMETHEUS_YML_TMPL,
+                   target=new_yml,
+                   context=options
+                   )
+        remove_state('prometheus.do-reconfig-yml')
+        # compare with what prometheus loaded, not with the file on disk:
+        # a failed hook leaves the new file in place but forgets the reload
+        if (not rules_changed and config_digest(new_yml) ==
+                hook_kv().get('prometheus.loaded-digest')):
+            hookenv.log('{} unchanged'.format(PROMETHEUS_YML))
+            os.unlink(new_yml)
+            return
+        try:
+            with timed('validate'):
+                validate_config(new_yml)
+        except subprocess.CalledProcessError:
+            os.unlink(new_yml)
+            restore_files(previous)
+            raise
+        os.rename(new_yml, PROMETHEUS_YML)
+        # prometheus.yml changes can be picked up with a reload (SIGHUP),
+        # runtime args changes (see write_prometheus_config_def) need a restart
+        set_state('prometheus.do-reload')
 
 
 def check_ports(new_port):
-    kv = unitdata.kv()
+    kv = hook_kv()
     if kv.get('prometheus.port') != new_port:
         hookenv.open_port(new_port)
         if kv.get('prometheus.port'):  # Dont try to close non existing ports
@@ -127,27 +901,34 @@ def check_ports(new_port):
 
 @when('prometheus.do-reconfig-def')
 def write_prometheus_config_def():
-    config = hookenv.config()
-    port = config.get('port', '9090')
-    check_ports(port)
-    if config.get('external_url', False):
-        vars = {
-            'private_address': hookenv.unit_get('private-address'),
-            'public_address': hookenv.unit_get('public-address'),
-            # prometheus default:
-            'port': port,
-        }
-        runtime_args('-web.external-url',
-                     config['external_url'].format(**vars))
-    args = runtime_args()
-    hookenv.log('runtime_args: {}'.format(args))
-    if args:
-        render(source=PROMETHEUS_DEF_TMPL,
-               target=PROMETHEUS_DEF,
-               context={'args': args},
-               )
-    set_state('prometheus.do-restart')
-    remove_state('prometheus.do-reconfig-def')
+    with timed('write_prometheus_config_def'):
+        config = hookenv.config()
+        port = config.get('port', '9090')
+        check_ports(port)
+        if config.get('external_url', False):
+            vars = {
+                'private_address': hookenv.unit_get('private-address'),
+                'public_address': hookenv.unit_get('public-address'),
+                # prometheus default:
+                'port': port,
+            }
+            runtime_args('-web.external-url',
+                         config['external_url'].format(**vars))
+        args = runtime_args()
+        hookenv.log('runtime_args: {}'.format(args))
+        if args:
+            render(source=PROMETHEUS_DEF_TMPL,
+                   target=PROMETHEUS_DEF,
+                   context={'args': args},
+                   )
+        # only runtime args changes need a restart, see restart_prometheus
+        if (not is_state('prometheus.started') or
+                file_hash(PROMETHEUS_DEF) !=
+                hook_kv().get('prometheus.def-hash')):
+            set_state('prometheus.do-restart')
+        else:
+            hookenv.log('{} unchanged'.format(PROMETHEUS_DEF))
+        remove_state('prometheus.do-reconfig-def')
 
 
 @when_not('prometheus.started')
@@ -166,116 +947,749 @@ def check_config():
     set_state('prometheus.do-check-reconfig')
 
 
+def desired_state_digest(config, *parts):
+    """Hash everything prometheus.yml and /etc/default/prometheus derive from.
+    """
+    digest = hashlib.sha256(json.dumps(
+        [dict(config)] + list(parts), sort_keys=True).encode())
+    for tmpl in (PROMETHEUS_YML_TMPL, PROMETHEUS_DEF_TMPL):
+        try:
+            with open('templates/{}'.format(tmpl), 'rb') as fh:
+                digest.update(fh.read())
+        except (IOError, OSError):
+            pass
+    return digest.hexdigest()
+
+
+def reconfig_deferred(kv):
+    """Whether a reconfig must wait for reconfig-min-interval to pass.
+
+    Deferred reconfigs are picked up by update-status, or by the first hook
+    after the interval has passed.
+    """
+    min_interval = hookenv.config().get('reconfig-min-interval')
+    if not min_interval or hookenv.hook_name() == 'update-status':
+        return False
+    return time.time() - kv.get('prometheus.last-apply', 0) < min_interval
+
+
 @when('prometheus.do-check-reconfig')
 def check_reconfig_prometheus():
-    config = hookenv.config()
-    target_jobs = unitdata.kv().get('target_jobs', [])
-    scrape_jobs = unitdata.kv().get('scrape_jobs', [])
-    args = runtime_args()
-    install_opts = ('install_sources', 'install_keys')
-    if any(config.changed(opt) for opt in install_opts):
-        set_state('prometheus.do-install')
-    if data_changed('prometheus.config', config):
-        set_state('prometheus.do-reconfig-yml')
-        set_state('prometheus.do-reconfig-def')
-    if any((
-        data_changed('prometheus.target_jobs', target_jobs),
-        templates_changed([PROMETHEUS_YML_TMPL]),
-    )):
-        set_state('prometheus.do-reconfig-yml')
-    if any((
-        data_changed('prometheus.scrape_jobs', scrape_jobs),
-        templates_changed([PROMETHEUS_YML_TMPL]),
-    )):
-        set_state('prometheus.do-reconfig-yml')
-    if any((
-        data_changed('prometheus.args', args),
-        templates_changed([PROMETHEUS_DEF_TMPL]),
-    )):
-        set_state('prometheus.do-reconfig-def')
-    remove_state('prometheus.do-check-reconfig')
+    with timed('check_reconfig_prometheus'):
+        config = hookenv.config()
+        kv = hook_kv()
+        jobs = rendered_jobs(config)
+        target_jobs = jobs['target']
+        scrape_jobs = jobs['scrape']
+        federation_jobs = kv.get('federation_jobs', [])
+        update_storage_sizing()
+        update_storage_profile()
+        update_charm_metrics_args()
+        args = runtime_args()
+        install_opts = ('install_sources', 'install_keys')
+        if any(config.changed(opt) for opt in install_opts):
+            set_state('prometheus.do-install')
+        remove_state('prometheus.do-check-reconfig')
+        # Coalesce relation-change storms: apply each desired state at most
+        # once, and optionally no more than once per reconfig-min-interval
+        shard = shard_config()
+        digest = desired_state_digest(config, target_jobs, scrape_jobs, args,
+                                      shard, federation_jobs)
+        if digest == kv.get('prometheus.applied-digest'):
+            remove_state('prometheus.reconfig-deferred')
+            return
+        if reconfig_deferred(kv):
+            if not is_state('prometheus.reconfig-deferred'):
+                hookenv.log('Deferring reconfig, reconfig-min-interval not '
+                            'reached')
+                set_state('prometheus.reconfig-deferred')
+            return
+        remove_state('prometheus.reconfig-deferred')
+        yml_tmpl_changed = templates_changed([PROMETHEUS_YML_TMPL])
+        def_tmpl_changed = templates_changed([PROMETHEUS_DEF_TMPL])
+        if data_changed('prometheus.config', config):
+            set_state('prometheus.do-reconfig-yml')
+        # the other options end up in runtime args (see args below)
+        def_options = [config.get('port'), config.get('external_url')]
+        if data_changed('prometheus.def-options', def_options):
+            set_state('prometheus.do-reconfig-def')
+        if any((
+            data_changed('prometheus.target_jobs', target_jobs),
+            data_changed('prometheus.scrape_jobs', scrape_jobs),
+            data_changed('prometheus.shard', shard),
+            data_changed('prometheus.federation_jobs', federation_jobs),
+            yml_tmpl_changed,
+        )):
+            set_state('prometheus.do-reconfig-yml')
+        if any((
+            data_changed('prometheus.args', args),
+            def_tmpl_changed,
+        )):
+            set_state('prometheus.do-reconfig-def')
+        kv.set('prometheus.applied-digest', digest)
+        kv.set('prometheus.last-apply', time.time())
 
 
 @when('prometheus.do-restart')
 def restart_prometheus():
-    if not host.service_running(SVCNAME):
-        hookenv.log('Starting {}...'.format(SVCNAME))
-        host.service_start(SVCNAME)
-    else:
-        hookenv.log('Restarting {}, config file changed...'.format(SVCNAME))
-        host.service_restart(SVCNAME)
-    hookenv.status_set('active', 'Ready')
+    running = host.service_running(SVCNAME)
+    if running and not acquire_restart_lock():
+        hookenv.status_set('waiting', 'Waiting for peers to restart')
+        return
+    remove_state('prometheus.ready')
+    with timed('restart'):
+        stopped = time.time()
+        if not running:
+            hookenv.log('Starting {}...'.format(SVCNAME))
+            host.service_start(SVCNAME)
+        else:
+            wait_for_checkpoint()
+            hookenv.log('Restarting {}, config file changed...'.format(
+                SVCNAME))
+            stopped = time.time()
+            host.service_restart(SVCNAME)
+    kv = hook_kv()
+    kv.set('prometheus.restart', {'stopped': stopped})
+    kv.set('prometheus.def-hash', file_hash(PROMETHEUS_DEF))
+    record_loaded_config()
     set_state('prometheus.started')
     remove_state('prometheus.do-restart')
+    # a restart also loads the latest prometheus.yml
+    remove_state('prometheus.do-reload')
+    check_ready(hookenv.config().get('restart-ready-timeout') or 0)
+
+
+def wait_for_checkpoint(timeout=RELOAD_CHECK_TIMEOUT):
+    """Let a running checkpoint finish before stopping prometheus.
+
+    Shutdown then only writes a small final checkpoint, within the init
+    system's stop timeout, and the next start loads it without crash
+    recovery.
+    """
+    deadline = time.time() + timeout
+    while True:
+        metrics = get_self_metrics()
+        if not metrics or not metrics.get(
+                'prometheus_local_storage_checkpointing'):
+            return
+        if time.time() >= deadline:
+            hookenv.log('Checkpoint still running, restarting anyway',
+                        hookenv.WARNING)
+            return
+        hookenv.status_set('maintenance', 'Waiting for checkpoint to finish')
+        time.sleep(1)
+
+
+def wait_for_ready(since, timeout):
+    """Wait for prometheus to load its storage and ingest samples again.
+
+    Prometheus only serves HTTP once its storage is loaded, samples being
+    ingested tell that scraping has resumed. Progress goes to the status.
+    """
+    deadline = time.time() + timeout
+    while True:
+        metrics = get_self_metrics()
+        if metrics is None:
+            message = 'Waiting for storage to load'
+        elif any(metrics.get(m) for m in INGESTED_SAMPLES_METRICS):
+            return metrics
+        else:
+            message = 'Waiting for scraping to resume'
+        hookenv.status_set('maintenance', '{} ({}s)'.format(
+            message, int(time.time() - since)))
+        if time.time() >= deadline:
+            return None
+        time.sleep(READY_POLL_INTERVAL)
+
+
+@when('prometheus.started')
+@when_not('prometheus.ready')
+def check_ready(timeout=0):
+    """Set prometheus.ready, and record the downtime, once it is ready.
+
+    Handlers which need a serving prometheus are gated on that state.
+    """
+    kv = hook_kv()
+    restart = kv.get('prometheus.restart') or {'stopped': time.time()}
+    metrics = wait_for_ready(restart['stopped'], timeout)
+    if metrics is None:
+        hookenv.status_set('waiting', 'Waiting for prometheus to load '
+                           'storage and resume scraping')
+        return
+    restart['ready'] = time.time()
+    restart['downtime'] = restart['ready'] - restart['stopped']
+    restart['crash-recovery'] = bool(metrics.get(
+        'prometheus_local_storage_started_dirty'))
+    kv.set('prometheus.restart', restart)
+    hookenv.log('{} ready, down for {:.1f}s{}'.format(
+        SVCNAME, restart['downtime'],
+        ' (after crash recovery)' if restart['crash-recovery'] else ''))
+    if charm_metrics_enabled():
+        schedule_charm_metrics()
+    hookenv.status_set('active', 'Ready')
+    set_state('prometheus.ready')
+
+
+# Rolling restarts: units queue restarts in their prometheus-peers settings,
+# the leader grants them in leader settings.
+def restart_peers():
+    """Other prometheus units, as of the last prometheus-peers hook."""
+    local_unit = hookenv.local_unit()
+    return [u for u in hook_kv().get('peer_units') or [] if u != local_unit]
+
+
+def restart_grants():
+    """Units currently allowed to restart."""
+    return json.loads(hookenv.leader_get('restart-granted') or '[]')
+
+
+def expired_restarts():
+    """Restart requests whose grant was revoked, by unit."""
+    return json.loads(hookenv.leader_get('restart-expired') or '{}')
+
+
+def restart_queue(rid):
+    """Unfinished restart requests, as (unit, request) in request order."""
+    requests = []
+    for unit in [hookenv.local_unit()] + hookenv.related_units(rid):
+        settings = hookenv.relation_get(unit=unit, rid=rid) or {}
+        request = settings.get('restart-request')
+        if request and request != settings.get('restart-done'):
+            requests.append((float(request), int(unit.split('/')[-1]),
+                             unit, request))
+    return [(unit, request) for _, _, unit, request in sorted(requests)]
+
+
+def coordinate_restarts():
+    """Grant restarts to at most max-parallel-restarts units (leader only).
+
+    A unit holds its grant until prometheus is ready and scraping again,
+    only then the next queued unit is allowed to restart. Grants of
+    departed units are dropped. Grants held for longer than
+    RESTART_GRANT_EXPIRY restart-ready-timeouts, e.g. by a unit that
+    crash-loops, are revoked and its request skipped.
+    """
+    if not hookenv.is_leader():
+        return
+    rids = hookenv.relation_ids(PEER_RELATION)
+    queued = restart_queue(rids[0]) if rids else []
+    requests = dict(queued)
+    expired = expired_restarts()
+    queue = [u for u, r in queued if expired.get(u) != r]
+    now = time.time()
+    granted = restart_grants()
+    granted_at = json.loads(hookenv.leader_get('restart-granted-at') or '{}')
+    config = hookenv.config()
+    expiry = RESTART_GRANT_EXPIRY * max(
+        config.get('restart-ready-timeout') or 0, RESTART_GRANT_MIN)
+    limit = max(config.get('max-parallel-restarts') or 1, 1)
+    grants = []
+    for unit in granted:
+        if unit not in queue:
+            continue
+        if now - granted_at.get(unit, now) > expiry:
+            hookenv.log('Revoking the restart grant of {}, not ready after '
+                        '{}s'.format(unit, expiry), hookenv.WARNING)
+            expired[unit] = requests[unit]
+            queue.remove(unit)
+            continue
+        grants.append(unit)
+    grants.extend([u for u in queue if u not in grants][:limit - len(grants)])
+    # forget revoked requests once they are done or replaced
+    expired = dict((u, r) for u, r in expired.items()
+                   if requests.get(u) == r)
+    if grants != granted or expired != expired_restarts():
+        hookenv.log('Restarts granted to: {}'.format(
+            ', '.join(grants) or 'none'))
+        hookenv.leader_set({
+            'restart-granted': json.dumps(grants),
+            'restart-granted-at': json.dumps(dict(
+                (u, granted_at.get(u, now)) for u in grants)),
+            'restart-expired': json.dumps(expired, sort_keys=True),
+        })
+
+
+def acquire_restart_lock():
+    """Whether this unit may restart prometheus now.
+
+    Units with peers queue with the leader instead, so that redundant
+    units never restart together.
+    """
+    rids = hookenv.relation_ids(PEER_RELATION) if restart_peers() else []
+    if not rids:
+        return True
+    kv = hook_kv()
+    local_unit = hookenv.local_unit()
+    # a revoked request goes back to the end of the queue
+    if (not is_state('prometheus.restart-queued') or
+            expired_restarts().get(local_unit) == kv.get('restart-request')):
+        request = kv.set('restart-request', '{:.6f}'.format(time.time()))
+        hookenv.relation_set(rids[0], {'restart-request': request})
+        set_state('prometheus.restart-queued')
+    coordinate_restarts()
+    return local_unit in restart_grants()
+
+
+@when('prometheus.restart-queued')
+@when('prometheus.ready')
+@when_not('prometheus.do-restart')
+def release_restart_lock():
+    for rid in hookenv.relation_ids(PEER_RELATION):
+        hookenv.relation_set(rid, {
+            'restart-done': hook_kv().get('restart-request')})
+    remove_state('prometheus.restart-queued')
+    coordinate_restarts()
+
+
+@hook('{}-relation-{{changed,departed}}'.format(PEER_RELATION),
+      'leader-elected', 'update-status')
+def update_restart_grants():
+    coordinate_restarts()
+
+
+def get_self_metrics(port=None, timeout=5):
+    """Scrape the local prometheus /metrics endpoint.
+
+    Returns a dict of {'metric{labels}': float} with samples from the text
+    exposition format, or None if the server can't be reached.
+    """
+    if port is None:
+        port = hook_kv().get('prometheus.port', '9090')
+    try:
+        return layer_prometheus.self_metrics(port, timeout)
+    except (IOError, OSError) as e:
+        hookenv.log('Could not fetch metrics of port {}: {}'.format(port, e))
+        return None
+
+
+def reload_succeeded(since, timeout=RELOAD_CHECK_TIMEOUT):
+    """Wait for prometheus to report a successful reload after `since`.
+
+    Prometheus versions not exporting the reload metrics are assumed to have
+    reloaded fine as long as they keep serving /metrics.
+    """
+    deadline = time.time() + timeout
+    while True:
+        metrics = get_self_metrics()
+        if metrics is not None:
+            ok = metrics.get('prometheus_config_last_reload_successful')
+            ts = metrics.get(
+                'prometheus_config_last_reload_success_timestamp_seconds')
+            if ok is None:
+                return True
+            if ok == 1 and (ts is None or ts >= int(since)):
+                return True
+        if time.time() >= deadline:
+            return False
+        time.sleep(1)
+
+
+@when('prometheus.do-reload')
+@when('prometheus.ready')
+@when_not('prometheus.do-restart')
+def reload_prometheus():
+    if not host.service_running(SVCNAME):
+        set_state('prometheus.do-restart')
+        return
+    hookenv.log('Reloading {}, prometheus.yml changed...'.format(SVCNAME))
+    since = time.time()
+    with timed('reload'):
+        host.service_reload(SVCNAME)
+        reloaded = reload_succeeded(since)
+    if not reloaded:
+        hookenv.log('Reload of {} failed, restarting'.format(SVCNAME),
+                    hookenv.WARNING)
+        set_state('prometheus.do-restart')
+        return
+    record_loaded_config()
+    hookenv.status_set('active', 'Ready')
+    remove_state('prometheus.do-reload')
+
+
+def write_atomic(path, content):
+    """Write content to path via a temp file + rename, skip if unchanged."""
+    try:
+        with open(path) as fh:
+            if fh.read() == content:
+                return False
+    except (IOError, OSError):
+        pass
+    dirname = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'w') as fh:
+            fh.write(content)
+        os.chmod(tmp_path, 0o644)
+        os.rename(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+    return True
+
+
+def target_file_path(kind, job_name):
+    return os.path.join(TARGETS_DIR, '{}-{}.json'.format(
+        kind, re.sub(r'[^\w.-]', '_', job_name)))
+
+
+def write_file_sd_targets(kind, jobs):
+    """Write one file_sd JSON file per job, and drop stale ones.
+
+    Returns the jobs with their 'target_groups' replaced by a 'file_sd'
+    path, so prometheus.yml only changes when jobs come and go, not on unit
+    churn.
+    """
+    if not os.path.isdir(TARGETS_DIR):
+        os.makedirs(TARGETS_DIR)
+    file_sd_jobs = []
+    for job in jobs:
+        path = target_file_path(kind, job['job_name'])
+        write_atomic(path, json.dumps(job['target_groups'], indent=2,
+                                      sort_keys=True))
+        file_sd_job = {k: v for k, v in job.items()
+                       if k != 'target_groups'}
+        file_sd_job['file_sd'] = path
+        file_sd_jobs.append(file_sd_job)
+    remove_file_sd_targets(kind, keep=[j['file_sd'] for j in file_sd_jobs])
+    return file_sd_jobs
+
+
+def remove_file_sd_targets(kind, keep=()):
+    if not os.path.isdir(TARGETS_DIR):
+        return
+    prefix = '{}-'.format(kind)
+    for fname in os.listdir(TARGETS_DIR):
+        path = os.path.join(TARGETS_DIR, fname)
+        if (fname.startswith(prefix) and fname.endswith('.json') and
+                path not in keep):
+            os.unlink(path)
+
+
+def probe_target(target, metrics_path, timeout):
+    from http.client import HTTPException
+    from urllib.error import HTTPError
+    from urllib.request import urlopen
+    url = 'http://{}{}'.format(target, metrics_path or '/metrics')
+    try:
+        urlopen(url, timeout=timeout).close()
+    except HTTPError:
+        # it answers, scrapes will fail fast rather than time out
+        return True
+    except (IOError, OSError, ValueError, HTTPException):
+        return False
+    return True
+
+
+def probe_targets(jobs):
+    """Probe all targets of jobs concurrently, returns {target: ok}.
+
+    Results are cached in unitdata for probe-cache-ttl seconds, so repeated
+    relation hooks only probe new or expired targets.
+    """
+    config = hookenv.config()
+    kv = hook_kv()
+    now = time.time()
+    ttl = config.get('probe-cache-ttl') or 0
+    cache = dict((t, r) for t, r in kv.get('probe_cache', {}).items()
+                 if now - r['time'] < ttl)
+    to_probe = {}
+    for job in jobs:
+        for target in job['targets']:
+            if target not in cache:
+                to_probe[target] = job.get('metrics_path')
+    if to_probe:
+        timeout = config.get('probe-timeout') or 2
+        workers = min(config.get('probe-workers') or 16, len(to_probe))
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = dict(
+                (target, pool.submit(probe_target, target, path, timeout))
+                for target, path in to_probe.items())
+        for target, future in futures.items():
+            cache[target] = {'ok': future.result(), 'time': now}
+    kv.set('probe_cache', cache)
+    return dict((t, r['ok']) for t, r in cache.items())
+
+
+def quarantine_unreachable(jobs):
+    """Move unreachable targets to a low-frequency <job>-unreachable job.
+    """
+    config = hookenv.config()
+    if not config.get('probe-targets'):
+        return jobs
+    results = probe_targets(jobs)
+    quarantine_interval = config.get('probe-quarantine-interval') or '5m'
+    result = []
+    for job in jobs:
+        reachable = [t for t in job['targets'] if results.get(t, True)]
+        unreachable = [t for t in job['targets'] if not results.get(t, True)]
+        result.append(dict(job, targets=reachable))
+        if unreachable:
+            hookenv.log('Quarantining unreachable {} targets: {}'.format(
+                job['job_name'], ', '.join(unreachable)), hookenv.WARNING)
+            result.append(dict(job, targets=unreachable,
+                               job_name='{}-unreachable'.format(
+                                   job['job_name']),
+                               scrape_interval=quarantine_interval))
+    return result
+
+
+def file_sd_enabled():
+    return bool(hookenv.config().get('file-sd'))
+
+
+def rendered_jobs(config):
+    """Normalized static, scrape and target jobs, as prometheus.yml has them.
+
+    Target files are (re)written here when file-sd is enabled.
+    """
+    kv = hook_kv()
+    jobs = normalize_jobs(config, kv.get('target_jobs', []),
+                          kv.get('scrape_jobs', []))
+    for kind in ('target', 'scrape'):
+        if file_sd_enabled():
+            jobs[kind] = write_file_sd_targets(kind, jobs[kind])
+        else:
+            remove_file_sd_targets(kind)
+    return jobs
 
 
 # Relations
 @when('prometheus.started')
 @when_not('target.available')
 def update_prometheus_no_targets():
-    unitdata.kv().set('target_jobs', [])
+    hook_kv().set('target_jobs', [])
     data_changed('target.related_services', [])
     set_state('prometheus.do-check-reconfig')
 
-    
+
 @when('prometheus.started')
 @when_not('scrape.available')
-def update_prometheus_no_targets():
-    unitdata.kv().set('scrape_jobs', [])
+def update_prometheus_no_scrape_targets():
+    hook_kv().set('scrape_jobs', [])
     set_state('prometheus.do-check-reconfig')
 
-    
+
 @when('prometheus.started')
 @when('target.available')
 def update_prometheus_targets(target):
-    services = target.services()
-    related_targets = []
-    for service in services:
-        targets = []
-        for unit in service['hosts']:
-            hookenv.log('{} has a unit {}:{}'.format(
-                service['service_name'],
-                unit['hostname'],
-                unit['port']))
-            targets.append('{hostname}:{port}'.format(**unit))
-        related_targets.append({'job_name': service['service_name'],
-                                'targets': targets})
+    with timed('update_prometheus_targets'):
+        services = target.services()
+        related_targets = []
+        for service in services:
+            targets = []
+            for unit in service['hosts']:
+                hookenv.log('{} has a unit {}:{}'.format(
+                    service['service_name'],
+                    unit['hostname'],
+                    unit['port']))
+                targets.append('{hostname}:{port}'.format(**unit))
+            related_targets.append({'job_name': service['service_name'],
+                                    'targets': sorted(targets)})
 
-    unitdata.kv().set('target_jobs', related_targets)
-    set_state('prometheus.do-check-reconfig')
+        # sorted, so that relation ordering alone doesn't look like a change
+        related_targets = sorted(quarantine_unreachable(related_targets),
+                                 key=lambda j: j['job_name'])
+        hook_kv().set('target_jobs', related_targets)
+        set_state('prometheus.do-check-reconfig')
 
 
 @when('prometheus.started')
 @when('scrape.available')
 def update_prometheus_scrape_targets(target):
-    targets = target.targets()
-    unitdata.kv().set('scrape_jobs', targets)
-    set_state('prometheus.do-check-reconfig')
-    
+    with timed('update_prometheus_scrape_targets'):
+        targets = [dict(job, targets=sorted(job['targets']))
+                   for job in quarantine_unreachable(target.targets())]
+        hook_kv().set('scrape_jobs', sorted(targets,
+                                            key=lambda j: j['job_name']))
+        set_state('prometheus.do-check-reconfig')
+
+
+def update_alertmanager_options():
+    config = hookenv.config()
+    runtime_args('-alertmanager.notification-queue-capacity',
+                 config.get('alertmanager-queue-capacity'))
+    runtime_args('-alertmanager.http-deadline',
+                 config.get('alertmanager-http-deadline'))
+
 
 @when('prometheus.started')
 @when_not('alertmanager-service.available')
 def update_prometheus_no_alertmanager():
     runtime_args('-alertmanager.url', None)
+    update_alertmanager_options()
     set_state('prometheus.do-check-reconfig')
 
 
 @when('prometheus.started')
 @when('alertmanager-service.available')
 def update_prometheus_alertmanager(alertmanager):
+    update_alertmanager_options()
     services = alertmanager.services()
     if not (data_changed('alertmanager-service.related_services', services)):
         return
-    # XXX: as of prometheus 0.17, it can only point to a single alertmanager,
-    #      last one from below loop will be used.
+    # send notifications to every member of (HA) alertmanager clusters,
+    # older prometheus only take a single -alertmanager.url
+    urls = set()
     for service in services:
         for unit in service['hosts']:
             hookenv.log('{} has a unit {}:{}'.format(
                 service['service_name'],
                 unit['hostname'],
                 unit['port']))
-            runtime_args('-alertmanager.url',
-                         'http://{hostname}:{port}'.format(**unit))
+            urls.add('http://{hostname}:{port}'.format(**unit))
+    urls = sorted(urls)
+    version = prometheus_version()
+    if len(urls) > 1 and (version or (0,)) < MULTI_ALERTMANAGER_VERSION:
+        hookenv.log('prometheus {} only supports one alertmanager, '
+                    'sending alerts to {}'.format(
+                        '.'.join(map(str, version or ())) or '(unknown)',
+                        urls[0]), hookenv.WARNING)
+        urls = urls[:1]
+    runtime_args('-alertmanager.url', ','.join(urls))
+    set_state('prometheus.do-check-reconfig')
+
+
+def remote_storage_args(url=None):
+    """Runtime args for remote storage at url, None values unset them."""
+    config = hookenv.config()
+    args = dict.fromkeys(REMOTE_STORAGE_FLAGS)
+    if url:
+        storage_type = config.get('remote-storage-type') or 'influxdb'
+        if storage_type not in ('influxdb', 'opentsdb'):
+            hookenv.log('Unknown remote-storage-type {}'.format(storage_type),
+                        hookenv.ERROR)
+            return args
+        args['-storage.remote.{}-url'.format(storage_type)] = url
+        if storage_type == 'influxdb':
+            args['-storage.remote.influxdb.database'] = config.get(
+                'remote-storage-database')
+            args['-storage.remote.influxdb.retention-policy'] = config.get(
+                'remote-storage-retention-policy')
+        args['-storage.remote.timeout'] = config.get('remote-storage-timeout')
+        args['-storage.local.retention'] = config.get(
+            'remote-storage-local-retention')
+    return args
+
+
+@when('prometheus.started')
+@when_not('remote-storage.available')
+def update_prometheus_no_remote_storage():
+    for key, value in remote_storage_args().items():
+        runtime_args(key, value)
+    set_state('prometheus.do-check-reconfig')
+
+
+@when('prometheus.started')
+@when('remote-storage.available')
+def update_prometheus_remote_storage(remote):
+    urls = sorted('http://{hostname}:{port}'.format(**unit)
+                  for service in remote.services()
+                  for unit in service['hosts'])
+    # prometheus sends samples to a single remote storage endpoint
+    url = urls[0] if urls else None
+    for key, value in remote_storage_args(url).items():
+        runtime_args(key, value)
+    set_state('prometheus.do-check-reconfig')
+
+
+def split_selectors(value):
+    """Split comma separated selectors, e.g. '{a="b", c="d"}, {e="f"}'.
+
+    Commas within {...} or quoted label values don't separate selectors.
+    """
+    selectors = []
+    current = []
+    depth = 0
+    quote = None
+    escaped = False
+    for char in value:
+        if quote:
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == quote:
+                quote = None
+        elif char in '"\'`':
+            quote = char
+        elif char == '{':
+            depth += 1
+        elif char == '}':
+            depth = max(depth - 1, 0)
+        elif char == ',' and not depth:
+            selectors.append(''.join(current))
+            current = []
+            continue
+        current.append(char)
+    selectors.append(''.join(current))
+    return [x.strip() for x in selectors if x.strip()]
+
+
+def federation_match():
+    return split_selectors(hookenv.config().get('federation-match') or '')
+
+
+def publish_federation_source(rid):
+    hookenv.relation_set(rid, {
+        'hostname': hookenv.unit_get('private-address'),
+        'port': hook_kv().get('prometheus.port'),
+        'match': json.dumps(federation_match()),
+    })
+
+
+@hook('federation-source-relation-joined')
+def federation_source_joined():
+    if hook_kv().get('prometheus.port'):
+        publish_federation_source(hookenv.relation_id())
+
+
+@when('prometheus.ready')
+def update_federation_source():
+    settings = [federation_match(), hook_kv().get('prometheus.port')]
+    if not data_changed('federation-source.settings', settings):
+        return
+    for rid in hookenv.relation_ids('federation-source'):
+        publish_federation_source(rid)
+
+
+@hook('federation-relation-{joined,changed,departed,broken}')
+def update_federation_jobs():
+    """Build one honor_labels /federate job per related lower tier service.
+    """
+    jobs = {}
+    for rid in hookenv.relation_ids('federation'):
+        for unit in hookenv.related_units(rid):
+            data = hookenv.relation_get(unit=unit, rid=rid) or {}
+            if not data.get('hostname') or not data.get('port'):
+                continue
+            service = unit.split('/')[0]
+            try:
+                match = json.loads(data.get('match') or '[]')
+            except ValueError as e:
+                hookenv.log('Invalid federation match[] selectors from '
+                            '{}: {}'.format(unit, e), hookenv.ERROR)
+                match = []
+            if not isinstance(match, list):
+                hookenv.log('Invalid federation match[] selectors from {}, '
+                            'expected a list'.format(unit), hookenv.ERROR)
+                match = []
+            job = jobs.setdefault(service, {
+                'job_name': 'federate-{}'.format(service),
+                'targets': [],
+                'match': match,
+            })
+            job['targets'].append('{hostname}:{port}'.format(**data))
+    federation_jobs = []
+    for service in sorted(jobs):
+        job = jobs[service]
+        if not job['match']:
+            hookenv.log('{} publishes no federation match[] selectors, '
+                        'skipping'.format(service), hookenv.WARNING)
+            continue
+        job['targets'].sort()
+        federation_jobs.append(job)
+    hook_kv().set('federation_jobs', federation_jobs)
     set_state('prometheus.do-check-reconfig')
 
 
@@ -286,13 +1700,121 @@ def update_nrpe_config(svc):
     hostname = nrpe.get_nagios_hostname()
     current_unit = nrpe.get_nagios_unit_name()
     nrpe_setup = nrpe.NRPE(hostname=hostname)
-    nrpe.add_init_service_checks(nrpe_setup, [SVCNAME], current_unit)
+    services = [SVCNAME]
+    if hook_kv().get('query-cache.port'):
+        services.append(QUERY_CACHE_SVC)
+    else:
+        nrpe_setup.remove_check(shortname=QUERY_CACHE_SVC)
+    nrpe.add_init_service_checks(nrpe_setup, services, current_unit)
+    if hookenv.config().get('nrpe-perf-checks'):
+        # the plugin reads scrape and evaluation intervals from prometheus.yml
+        fetch.apt_install('python3-yaml')
+        with open(os.path.join(hookenv.charm_dir(), 'files',
+                               'check_prometheus_perf.py'), 'rb') as fh:
+            host.mkdir(NAGIOS_PLUGINS_DIR)
+            host.write_file(os.path.join(NAGIOS_PLUGINS_DIR, PERF_CHECK),
+                            fh.read(), perms=0o755)
+        cmds = perf_check_cmds()
+        for check, description in PERF_CHECKS:
+            nrpe_setup.add_check(
+                shortname='prometheus_{}'.format(check),
+                description='{} {{{}}}'.format(description, current_unit),
+                check_cmd=cmds[check])
+    else:
+        for check, _ in PERF_CHECKS:
+            nrpe_setup.remove_check(shortname='prometheus_{}'.format(check))
     nrpe_setup.write()
 
 
+def perf_check_cmds():
+    """check_prometheus_perf command lines, keyed by check.
+
+    nrpe-perf-thresholds overrides the checks' default thresholds.
+    """
+    thresholds = yaml_map_option('nrpe-perf-thresholds')
+    kv = hook_kv()
+    max_chunks = kv.get('runtime_args', {}).get(
+        '-storage.local.max-chunks-to-persist')
+    cmds = {}
+    for check, _ in PERF_CHECKS:
+        cmd = [PERF_CHECK, check,
+               '--port', str(kv.get('prometheus.port') or 9090),
+               '--config', PROMETHEUS_YML]
+        levels = thresholds.get(check)
+        if isinstance(levels, list) and len(levels) == 2:
+            cmd.extend(['-w', str(levels[0]), '-c', str(levels[1])])
+        elif levels is not None:
+            hookenv.log('Invalid nrpe-perf-thresholds for {}, expected '
+                        '[warning, critical]'.format(check), hookenv.ERROR)
+        if check == 'persistence' and max_chunks:
+            cmd.extend(['--max-chunks-to-persist', str(max_chunks)])
+        cmds[check] = ' '.join(cmd)
+    return cmds
+
+
+def remove_query_cache(port):
+    systemd = host.init_is_systemd()
+    if systemd:
+        host.service('disable', QUERY_CACHE_SVC)
+    host.service_stop(QUERY_CACHE_SVC)
+    for path in (QUERY_CACHE_SYSTEMD, QUERY_CACHE_UPSTART, QUERY_CACHE_BIN):
+        if os.path.exists(path):
+            os.unlink(path)
+    if systemd:
+        subprocess.check_call(['systemctl', 'daemon-reload'])
+    hookenv.close_port(port)
+
+
 @when('prometheus.started')
+def configure_query_cache():
+    """Run the query_range caching proxy from files/query_cache.py.
+    """
+    config = hookenv.config()
+    kv = hook_kv()
+    with open(os.path.join(hookenv.charm_dir(), 'files',
+                           'query_cache.py'), 'rb') as fh:
+        program = fh.read()
+    options = {
+        'bin': QUERY_CACHE_BIN,
+        'user': QUERY_CACHE_USER,
+        'port': config.get('query-cache-port') or 9091,
+        'upstream': 'http://localhost:{}'.format(kv.get('prometheus.port')),
+        'memory_mb': config.get('query-cache-memory-mb') or 256,
+        'disk_mb': config.get('query-cache-disk-mb') or 0,
+        'cache_dir': QUERY_CACHE_DIR,
+        'bucket_steps': config.get('query-cache-bucket-steps') or 120,
+    }
+    enabled = bool(config.get('query-cache'))
+    if not data_changed('prometheus.query-cache', [
+            enabled, options, hashlib.sha256(program).hexdigest()]):
+        return
+    old_port = kv.get('query-cache.port')
+    if old_port:
+        remove_query_cache(old_port)
+        kv.unset('query-cache.port')
+    if not enabled:
+        return
+    host.write_file(QUERY_CACHE_BIN, program, perms=0o755)
+    host.adduser(QUERY_CACHE_USER, system_user=True)
+    host.mkdir(QUERY_CACHE_DIR, owner=QUERY_CACHE_USER,
+               group=QUERY_CACHE_USER, perms=0o750)
+    if host.init_is_systemd():
+        render(source='prometheus-query-cache.service.j2',
+               target=QUERY_CACHE_SYSTEMD, context=options)
+        subprocess.check_call(['systemctl', 'daemon-reload'])
+        host.service('enable', QUERY_CACHE_SVC)
+    else:
+        render(source='prometheus-query-cache.conf.j2',
+               target=QUERY_CACHE_UPSTART, context=options)
+    host.service_restart(QUERY_CACHE_SVC)
+    hookenv.open_port(options['port'])
+    kv.set('query-cache.port', options['port'])
+
+
+@when('prometheus.ready')
 @when('grafana-source.available')
 def provide_grafana_source(grafana):
-    kv = unitdata.kv()
-    port = kv.get('prometheus.port')
+    kv = hook_kv()
+    # the query cache, if enabled, answers everything prometheus does
+    port = kv.get('query-cache.port') or kv.get('prometheus.port')
     grafana.provide('prometheus', port, 'Juju generated source')
@@ -1,2 +1,6 @@
+import os
 import sys
 sys.path.append('.')
+# charm layer libraries (lib/charms/layer), on the path in hooks and actions
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'lib'))
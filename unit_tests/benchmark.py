@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+"""Scalability benchmark of relation processing and config generation.
+
+Drives update_prometheus_targets(), update_prometheus_scrape_targets(),
+check_reconfig_prometheus() and write_prometheus_config_yml() with
+synthetic units, and reports wall time, peak memory, unitdata size and
+rendered prometheus.yml size for each estate size. Run from the charm
+directory:
+
+    python3 -m unit_tests.benchmark [--units 10,1000] [--save-baseline]
+
+or `make benchmark`.
+
+Results are compared against unit_tests/benchmark_baseline.json: sizes
+must not grow by more than 10%, times by more than --tolerance.
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import mock
+
+from unit_tests.test_reactive_prometheus import (
+    ReactInterfaceMock, SimpleConfigMock
+)
+from reactive import prometheus as react_prom
+from charmhelpers.core import unitdata
+
+CHARM_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE = os.path.join(CHARM_DIR, 'unit_tests', 'benchmark_baseline.json')
+DEFAULT_UNITS = [10, 100, 1000, 10000, 50000]
+UNITS_PER_SERVICE = 50
+STEPS = [
+    'update_prometheus_targets',
+    'update_prometheus_scrape_targets',
+    'check_reconfig_prometheus',
+    'write_prometheus_config_yml',
+]
+SIZE_TOLERANCE = 0.1
+# timings below this many seconds are noise, don't flag them
+MIN_TIME = 0.05
+
+
+class ScrapeInterfaceMock(object):
+    def __init__(self, jobs):
+        self.jobs = jobs
+
+    def targets(self):
+        return self.jobs
+
+
+def synthetic_relations(units):
+    services = {}
+    scrape_jobs = []
+    for i in range(units):
+        service = 'svc{}'.format(i // UNITS_PER_SERVICE)
+        services.setdefault(service, []).append(
+            ('10.{}.{}.{}'.format(i // 65536, i // 256 % 256, i % 256),
+             9100))
+    for service, hostports in sorted(services.items()):
+        scrape_jobs.append({
+            'job_name': '{}-app'.format(service),
+            'metrics_path': '/metrics',
+            'targets': ['{}:8080'.format(h) for h, _ in hostports],
+        })
+    return (ReactInterfaceMock(services), ScrapeInterfaceMock(scrape_jobs))
+
+
+def default_config():
+    import yaml
+    with open(os.path.join(CHARM_DIR, 'config.yaml')) as fh:
+        options = yaml.safe_load(fh)['options']
+    return SimpleConfigMock({k: v['default'] for k, v in options.items()
+                             if v.get('default')})
+
+
+def run_steps(target, scrape):
+    timings = {}
+    for step, args in zip(STEPS, [(target,), (scrape,), (), ()]):
+        start = time.perf_counter()
+        getattr(react_prom, step)(*args)
+        timings[step] = time.perf_counter() - start
+    return timings
+
+
+def fresh_state(path):
+    os.environ['UNIT_STATE_DB'] = path
+    unitdata._KV = None
+    if os.path.exists(react_prom.PROMETHEUS_YML):
+        os.unlink(react_prom.PROMETHEUS_YML)
+
+
+def benchmark(units, workdir, repeat=1):
+    """Run all steps on fresh unitdata for the given estate size.
+
+    Timings are the best of `repeat` runs, memory is measured on a
+    separate run since tracing slows everything down.
+    """
+    results = {}
+    target, scrape = synthetic_relations(units)
+    for run in range(repeat):
+        # fresh state, so that each run renders and stores everything
+        db = os.path.join(workdir, '{}-{}.db'.format(units, run))
+        fresh_state(db)
+        timings = run_steps(target, scrape)
+        timings['total'] = sum(timings.values())
+        for step, seconds in timings.items():
+            key = '{}_seconds'.format(step)
+            results[key] = min(results.get(key, seconds), seconds)
+    unitdata.kv().flush()
+    results['unitdata_bytes'] = os.path.getsize(db)
+    results['yaml_bytes'] = os.path.getsize(react_prom.PROMETHEUS_YML)
+
+    fresh_state(os.path.join(workdir, '{}-memory.db'.format(units)))
+    tracemalloc.start()
+    run_steps(target, scrape)
+    results['peak_memory_bytes'] = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return results
+
+
+def regressions(results, baseline, tolerance):
+    found = []
+    for units, metrics in sorted(results.items(), key=lambda x: int(x[0])):
+        for name, value in sorted(metrics.items()):
+            base = baseline.get(units, {}).get(name)
+            if base is None:
+                continue
+            if name.endswith('_seconds'):
+                limit = max(base * (1 + tolerance), MIN_TIME)
+            else:
+                limit = base * (1 + SIZE_TOLERANCE)
+            if value > limit:
+                found.append('{} units: {} {:.4g} > {:.4g} (baseline {:.4g})'
+                             .format(units, name, value, limit, base))
+    return found
+
+
+def use_workdir(workdir):
+    """Point the files the charm writes at workdir."""
+    react_prom.PROMETHEUS_YML = os.path.join(workdir, 'prometheus.yml')
+    react_prom.PROMETHEUS_DEF = os.path.join(workdir, 'prometheus')
+    react_prom.CUSTOM_RULES_PATH = os.path.join(workdir, 'custom.rules')
+    react_prom.TARGETS_DIR = os.path.join(workdir, 'targets')
+    react_prom.RULES_DIR = os.path.join(workdir, 'rules')
+    react_prom.CHARM_METRICS_DIR = os.path.join(workdir, 'charm-assets')
+
+
+def hook_patches():
+    """Patches standing in for the juju hook environment."""
+    return [
+        mock.patch('reactive.prometheus.hookenv.config',
+                   return_value=default_config()),
+        mock.patch('reactive.prometheus.hookenv.unit_get',
+                   return_value='10.0.0.1'),
+        mock.patch('reactive.prometheus.hookenv.log'),
+        mock.patch('charmhelpers.core.host.log'),
+        # promtool isn't available outside of a deployed unit
+        mock.patch('reactive.prometheus.validate_config'),
+    ]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--units', default=','.join(map(str, DEFAULT_UNITS)),
+                        help='comma separated estate sizes, in units')
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='store the results as the new baseline')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='timing runs per estate size, best is kept')
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help='allowed relative slowdown (default 0.5)')
+    args = parser.parse_args(argv)
+
+    os.chdir(CHARM_DIR)
+    os.environ['CHARM_DIR'] = CHARM_DIR
+    os.environ.setdefault('JUJU_UNIT_NAME', 'prometheus/0')
+    workdir = tempfile.mkdtemp()
+    use_workdir(workdir)
+    patches = hook_patches()
+    results = {}
+    try:
+        for patch in patches:
+            patch.start()
+        # warm up template compilation and imports, not part of results
+        benchmark(1, workdir)
+        for units in [int(u) for u in args.units.split(',')]:
+            results[str(units)] = benchmark(units, workdir, args.repeat)
+            print('{:>6} units: {}'.format(units, ', '.join(
+                '{}={:.4g}'.format(k, v)
+                for k, v in sorted(results[str(units)].items()))))
+    finally:
+        for patch in patches:
+            patch.stop()
+        shutil.rmtree(workdir)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as fh:
+            json.dump(results, fh, indent=2, sort_keys=True)
+            fh.write('\n')
+        return 0
+    if not os.path.exists(args.baseline):
+        print('No baseline at {}, not checking regressions'.format(
+            args.baseline))
+        return 0
+    with open(args.baseline) as fh:
+        found = regressions(results, json.load(fh), args.tolerance)
+    for regression in found:
+        print('REGRESSION {}'.format(regression))
+    return 1 if found else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
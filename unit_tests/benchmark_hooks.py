@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+"""Startup and run time of single hooks, per hook type.
+
+Every hook is a fresh python process: the framework and the charm are
+imported, the handlers run and unitdata is committed. Each hook type is
+run in a new interpreter against unitdata prepared for the estate size,
+and the time spent importing the framework, importing the charm, running
+the handlers and committing unitdata is reported. Run from the charm
+directory:
+
+    python3 -m unit_tests.benchmark_hooks [--units 10,1000] [--save-baseline]
+
+or `make benchmark`.
+
+Results are compared against unit_tests/benchmark_hooks_baseline.json.
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+CHARM_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE = os.path.join(CHARM_DIR, 'unit_tests',
+                        'benchmark_hooks_baseline.json')
+DEFAULT_UNITS = [10, 1000, 10000]
+# handlers dispatched for each hook type on a started, related unit;
+# relation hooks see one more unit than unitdata was prepared with
+HOOKS = {
+    'update-status': [
+        'check_config',
+        'check_reconfig_prometheus',
+    ],
+    'config-changed': [
+        'check_config',
+        'check_reconfig_prometheus',
+        'write_prometheus_config_yml',
+        'write_prometheus_config_def',
+    ],
+    'target-relation-changed': [
+        'update_prometheus_targets',
+        'check_reconfig_prometheus',
+        'write_prometheus_config_yml',
+    ],
+    'scrape-relation-changed': [
+        'update_prometheus_scrape_targets',
+        'check_reconfig_prometheus',
+        'write_prometheus_config_yml',
+    ],
+}
+
+
+def run_hook(hook, units, workdir):
+    """Run one hook in this (fresh) interpreter, returns its timings."""
+    start = time.perf_counter()
+    from charmhelpers.core import hookenv, unitdata  # noqa
+    import charms.reactive  # noqa
+    framework = time.perf_counter()
+    from reactive import prometheus as react_prom
+    imported = time.perf_counter()
+
+    # setup is not part of the timings
+    import mock
+    from unit_tests import benchmark as bench
+    # importing the unit tests changes these
+    os.environ['CHARM_DIR'] = CHARM_DIR
+    os.environ['JUJU_UNIT_NAME'] = 'prometheus/0'
+    bench.use_workdir(workdir)
+    patches = bench.hook_patches() + [
+        mock.patch('reactive.prometheus.hookenv.open_port'),
+        mock.patch('reactive.prometheus.hookenv.close_port'),
+        mock.patch('reactive.prometheus.hookenv.status_set'),
+    ]
+    for patch in patches:
+        patch.start()
+    if hook == 'prepare':
+        handlers = [(step, ()) for step in bench.STEPS]
+        target, scrape = bench.synthetic_relations(units)
+    else:
+        handlers = [(name, ()) for name in HOOKS[hook]]
+        target, scrape = bench.synthetic_relations(units + 1)
+    relations = {
+        'update_prometheus_targets': (target,),
+        'update_prometheus_scrape_targets': (scrape,),
+    }
+    setup = time.perf_counter()
+
+    for name, args in handlers:
+        getattr(react_prom, name)(*relations.get(name, args))
+    handled = time.perf_counter()
+    hookenv._run_atexit()
+    unitdata.kv().flush()
+    committed = time.perf_counter()
+    for patch in patches:
+        patch.stop()
+    return {
+        'framework_import_seconds': framework - start,
+        'charm_import_seconds': imported - framework,
+        'handlers_seconds': handled - setup,
+        'commit_seconds': committed - handled,
+        'total_seconds': (committed - setup) + (imported - start),
+    }
+
+
+def spawn(hook, units, workdir, db):
+    env = dict(os.environ, UNIT_STATE_DB=db, JUJU_HOOK_NAME=hook,
+               CHARM_DIR=CHARM_DIR, JUJU_UNIT_NAME='prometheus/0')
+    env['PYTHONPATH'] = os.pathsep.join(
+        [CHARM_DIR, os.path.join(CHARM_DIR, 'lib')] +
+        [p for p in [env.get('PYTHONPATH')] if p])
+    out = subprocess.check_output(
+        [sys.executable, '-m', 'unit_tests.benchmark_hooks', '--run', hook,
+         '--units', str(units), '--workdir', workdir],
+        cwd=CHARM_DIR, env=env)
+    return json.loads(out.decode('utf-8').splitlines()[-1])
+
+
+def benchmark(units, workdir, repeat=1):
+    """Best of `repeat` runs of every hook type, on the same prepared state.
+    """
+    prepared = os.path.join(workdir, '{}.db'.format(units))
+    spawn('prepare', units, workdir, prepared)
+    results = {}
+    for hook in sorted(HOOKS):
+        for run in range(repeat):
+            db = os.path.join(workdir, '{}-{}.db'.format(units, hook))
+            shutil.copy(prepared, db)
+            timings = spawn(hook, units, workdir, db)
+            hook_results = results.setdefault(hook, {})
+            for key, seconds in timings.items():
+                hook_results[key] = min(hook_results.get(key, seconds),
+                                        seconds)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--units', default=','.join(map(str, DEFAULT_UNITS)),
+                        help='comma separated estate sizes, in units')
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='store the results as the new baseline')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs per hook type, best is kept')
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help='allowed relative slowdown (default 0.5)')
+    parser.add_argument('--run', help=argparse.SUPPRESS)
+    parser.add_argument('--workdir', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.run:
+        print(json.dumps(run_hook(args.run, int(args.units), args.workdir)))
+        return 0
+
+    from unit_tests.benchmark import regressions
+    workdir = tempfile.mkdtemp()
+    results = {}
+    try:
+        for units in [int(u) for u in args.units.split(',')]:
+            for hook, timings in sorted(
+                    benchmark(units, workdir, args.repeat).items()):
+                results.setdefault(hook, {})[str(units)] = timings
+                print('{:>6} units {}: {}'.format(units, hook, ', '.join(
+                    '{}={:.4g}'.format(k, v)
+                    for k, v in sorted(timings.items()))))
+    finally:
+        shutil.rmtree(workdir)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as fh:
+            json.dump(results, fh, indent=2, sort_keys=True)
+            fh.write('\n')
+        return 0
+    if not os.path.exists(args.baseline):
+        print('No baseline at {}, not checking regressions'.format(
+            args.baseline))
+        return 0
+    with open(args.baseline) as fh:
+        baseline = json.load(fh)
+    found = []
+    for hook in sorted(results):
+        found.extend('{} {}'.format(hook, r) for r in regressions(
+            results[hook], baseline.get(hook, {}), args.tolerance))
+    for regression in found:
+        print('REGRESSION {}'.format(regression))
+    return 1 if found else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
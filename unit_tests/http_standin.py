@@ -0,0 +1,62 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class StandInServer(object):
+    """Local HTTP server standing in for prometheus (or exporters).
+
+    routes maps a path to the response body (bytes, str, or an object to
+    be sent as JSON), or to a callable taking the parsed query string and
+    returning one. Unknown paths get a 404.
+    """
+    def __init__(self, routes=None):
+        self.routes = routes or {}
+        self.requests = []
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                standin.requests.append(self.path)
+                body = standin.routes.get(url.path)
+                if callable(body):
+                    body = body(parse_qs(url.query))
+                if body is None:
+                    self.send_error(404)
+                    return
+                if not isinstance(body, (bytes, str)):
+                    body = json.dumps(body)
+                if isinstance(body, str):
+                    body = body.encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            do_POST = do_GET
+
+            def log_message(self, *args):
+                pass
+
+        self.server = HTTPServer(('localhost', 0), Handler)
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def vector(*samples):
+    """/api/v1/query response for (labels, value) samples."""
+    return {'status': 'success', 'data': {
+        'resultType': 'vector',
+        'result': [{'metric': labels, 'value': [1467000000, str(value)]}
+                   for labels, value in samples]}}
@@ -0,0 +1,233 @@
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+import mock
+import yaml
+
+from actions import actions
+from charmhelpers.core import unitdata
+from unit_tests.http_standin import StandInServer, vector
+
+QUERIES = {
+    'topk(2, count by (__name__)({__name__=~".+"}))': vector(
+        ({'__name__': 'http_requests_total'}, 50000),
+        ({'__name__': 'up'}, 10)),
+    'topk(2, count by (__name__, job)({__name__=~".+"}))': vector(
+        ({'__name__': 'http_requests_total', 'job': 'myapp'}, 50000),
+        ({'__name__': 'up', 'job': 'myapp'}, 5)),
+    'count by (job)({__name__=~".+"})': vector(
+        ({'job': 'myapp'}, 50005),
+        ({'job': 'prometheus'}, 500),
+        ({'job': 'handmade'}, 5)),
+    'topk(1, {__name__="http_requests_total"})': vector(
+        ({'__name__': 'http_requests_total', 'job': 'myapp',
+          'instance': 'app1:80', 'path': '/a', 'code': '200'}, 1)),
+    'count(count by (code)({__name__="http_requests_total"}))': vector(
+        ({}, 5)),
+    'count(count by (path)({__name__="http_requests_total"}))': vector(
+        ({}, 20000)),
+    'topk(1, {__name__="up"})': vector(
+        ({'__name__': 'up', 'job': 'myapp', 'instance': 'app1:80'}, 1)),
+}
+
+METRICS = '''# HELP prometheus_local_storage_memory_chunks foo
+# TYPE prometheus_local_storage_memory_chunks gauge
+prometheus_local_storage_memory_chunks 1048576
+prometheus_local_storage_persistence_urgency_score 0.25
+prometheus_local_storage_rushed_mode 0
+go_goroutines 42
+'''
+
+
+def label_values(n):
+    values = ['"v\\"{}"'.format(i) for i in range(n)]
+    return '{{"status":"success","data":[{}]}}'.format(','.join(values))
+
+
+class TestCardinalityReport(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        os.environ['UNIT_STATE_DB'] = os.path.join(self.dir, '.unit-state.db')
+        unitdata._KV = None
+        self.standin = StandInServer({
+            '/api/v1/query': lambda q: QUERIES.get(q['query'][0]),
+            '/api/v1/label/path/values': label_values(20000),
+            '/api/v1/label/code/values': label_values(5),
+            '/metrics': METRICS,
+        })
+        self.standin.__enter__()
+        self.addCleanup(self.standin.__exit__)
+        kv = unitdata.kv()
+        kv.set('prometheus.port', self.standin.port)
+        kv.set('scrape_jobs', [{'job_name': 'myapp', 'targets': []}])
+
+    def test_count_array_strings(self):
+        with mock.patch('actions.actions.READ_CHUNK', 7):
+            with actions.api_get('/api/v1/label/path/values') as fh:
+                self.assertEqual(actions.count_array_strings(fh, 7), 20000)
+
+    def test_cardinality_report(self):
+        report = actions.cardinality_report(top=2, min_series=10000,
+                                            label_threshold=1000)
+        self.assertEqual(report['top-metrics'], [
+            {'name': 'http_requests_total', 'series': 50000},
+            {'name': 'up', 'series': 10}])
+        self.assertEqual(report['top-labels'], [
+            {'name': 'http_requests_total', 'label': 'path',
+             'distinct-values': 20000},
+            {'name': 'http_requests_total', 'label': 'code',
+             'distinct-values': 5}])
+        self.assertEqual(report['label-values'], [
+            {'label': 'path', 'distinct-values': 20000},
+            {'label': 'code', 'distinct-values': 5}])
+        self.assertEqual(report['jobs'], [
+            {'job': 'myapp', 'series': 50005, 'charm-rendered': True},
+            {'job': 'prometheus', 'series': 500, 'charm-rendered': True},
+            {'job': 'handmade', 'series': 5, 'charm-rendered': False}])
+        self.assertEqual(report['persistence'], {
+            'prometheus_local_storage_memory_chunks': 1048576,
+            'prometheus_local_storage_persistence_urgency_score': 0.25,
+            'prometheus_local_storage_rushed_mode': 0})
+        self.assertEqual(
+            yaml.safe_load(report['suggested-metric-relabel-configs']), {
+                'all-jobs': [{'regex': 'path', 'action': 'labeldrop'}],
+                'myapp': [{'source_labels': ['__name__'],
+                           'regex': 'http_requests_total',
+                           'action': 'drop'}]})
+
+    @mock.patch('actions.actions.hookenv.action_set')
+    @mock.patch('actions.actions.hookenv.action_get')
+    def test_cardinality_report_action(self, mock_action_get,
+                                       mock_action_set):
+        mock_action_get.return_value = {'top': 2, 'min-series': 10000,
+                                        'label-threshold': 1000}
+        actions.main(['actions/cardinality-report'])
+        results = mock_action_set.call_args[0][0]
+        self.assertEqual(results['top-metrics.1.name'], 'http_requests_total')
+        self.assertEqual(results['top-metrics.1.series'], '50000')
+        self.assertEqual(results['jobs.3.charm-rendered'], 'False')
+        self.assertEqual(
+            results['persistence.prometheus-local-storage-rushed-mode'],
+            '0.0')
+
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        os.environ['UNIT_STATE_DB'] = os.path.join(self.dir, '.unit-state.db')
+        unitdata._KV = None
+        self.datadir = os.path.join(self.dir, 'metrics')
+        self.backups = os.path.join(self.dir, 'backups')
+        os.makedirs(os.path.join(self.datadir, '00'))
+        os.makedirs(self.backups)
+        unitdata.kv().set('storage-path', self.datadir)
+        self.write('heads.db', b'heads')
+        self.write('00/a.db', b'a' * 3000)
+        self.write('00/b.db', b'b' * 10)
+
+    def write(self, name, content, mtime=1467000000):
+        path = os.path.join(self.datadir, name)
+        with open(path, 'wb') as fh:
+            fh.write(content)
+        os.utime(path, (mtime, mtime))
+
+    def members(self, path):
+        with tarfile.open(path) as tar:
+            return dict((m.name, tar.extractfile(m).read())
+                        for m in tar.getmembers())
+
+    def test_rate_limiter(self):
+        clock = [100.0]
+        sleeps = []
+        limiter = actions.RateLimiter(1000, clock=lambda: clock[0],
+                                      sleep=sleeps.append)
+        limiter.consume(500)
+        limiter.consume(1500)
+        clock[0] += 5
+        limiter.consume(1000)
+        self.assertEqual(sleeps, [0.5, 2.0])
+
+    def test_snapshot_incremental(self):
+        full = os.path.join(self.backups, 'full.tar.gz')
+        stats = actions.snapshot(self.datadir, full)
+        self.assertEqual(stats['files'], 3)
+        self.assertEqual(stats['bytes-read'], 3015)
+        self.assertEqual(self.members(full), {
+            'heads.db': b'heads', '00/a.db': b'a' * 3000,
+            '00/b.db': b'b' * 10, '.deleted': b''})
+        # only changed series files, and the checkpoint, are included
+        self.write('heads.db', b'heads2', mtime=1467000100)
+        self.write('00/b.db', b'b' * 20, mtime=1467000100)
+        self.write('00/c.db', b'c')
+        os.unlink(os.path.join(self.datadir, '00', 'a.db'))
+        incr = os.path.join(self.backups, 'incr.tar.gz')
+        stats = actions.snapshot(self.datadir, incr, incremental=True,
+                                 read_rate=1024 * 1024)
+        self.assertEqual(stats['deleted'], 1)
+        self.assertEqual(self.members(incr), {
+            'heads.db': b'heads2', '00/b.db': b'b' * 20, '00/c.db': b'c',
+            '.deleted': b'00/a.db\n'})
+        stats = actions.snapshot(self.datadir, incr, incremental=True)
+        self.assertEqual(stats['skipped'], 2)
+        self.assertEqual(sorted(self.members(incr)),
+                         ['.deleted', 'heads.db'])
+        self.assertFalse(os.path.exists(incr + '.partial'))
+
+    def test_snapshot_unreadable(self):
+        full = os.path.join(self.backups, 'full.tar.gz')
+        real_open = open
+
+        def failing_open(path, *args):
+            if path.endswith('a.db'):
+                raise IOError('Permission denied')
+            return real_open(path, *args)
+        with mock.patch('actions.actions.open', create=True,
+                        side_effect=failing_open):
+            stats = actions.snapshot(self.datadir, full)
+        self.assertEqual(stats['files'], 2)
+        # files that could not be copied are not in the manifest
+        incr = os.path.join(self.backups, 'incr.tar.gz')
+        actions.snapshot(self.datadir, incr, incremental=True)
+        self.assertEqual(sorted(self.members(incr)),
+                         ['.deleted', '00/a.db', 'heads.db'])
+
+    def test_checkpoint_timeout(self):
+        self.assertEqual(actions.checkpoint_timeout(), 420)
+        unitdata.kv().set('runtime_args', {
+            '-storage.local.checkpoint-interval': '30m0s'})
+        self.assertEqual(actions.checkpoint_timeout(), 1920)
+        self.assertEqual(actions.parse_duration('1h30m'), 5400)
+        self.assertRaises(ValueError, actions.parse_duration, '15 minutes')
+
+    def test_wait_for_checkpoint(self):
+        with mock.patch('actions.actions.CHECKPOINT_POLL', 0):
+            self.assertTrue(actions.wait_for_checkpoint(
+                self.datadir, 1467000000, 0))
+            self.assertFalse(actions.wait_for_checkpoint(
+                self.datadir, 1467000001, 0))
+
+    @mock.patch('actions.actions.lower_io_priority')
+    @mock.patch('actions.actions.hookenv.action_fail')
+    @mock.patch('actions.actions.hookenv.action_set')
+    @mock.patch('actions.actions.hookenv.action_get')
+    def test_snapshot_action(self, mock_action_get, mock_action_set,
+                             mock_action_fail, mock_lower_io_priority):
+        target = os.path.join(self.backups, 'snap.tar.gz')
+        mock_action_get.return_value = {
+            'target': target, 'checkpoint-timeout': 0, 'max-read-mb': 0}
+        actions.main(['actions/snapshot'])
+        self.assertFalse(mock_action_fail.called)
+        results = mock_action_set.call_args[0][0]
+        self.assertEqual(results['files'], '3')
+        self.assertEqual(results['target'], target)
+        mock_lower_io_priority.assert_called_once_with('idle')
+        # no checkpoint since the action started
+        mock_action_get.return_value['checkpoint-timeout'] = 1
+        with mock.patch('actions.actions.CHECKPOINT_POLL', 0):
+            actions.main(['actions/snapshot'])
+        self.assertIn('checkpoint', mock_action_fail.call_args[0][0])
@@ -0,0 +1,147 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from files import check_prometheus_perf as check
+from unit_tests.http_standin import StandInServer, vector
+
+# prometheus 1.x telemetry of a server falling behind
+METRICS_1X = '''\
+# HELP prometheus_local_storage_persistence_urgency_score A score of urgency.
+# TYPE prometheus_local_storage_persistence_urgency_score gauge
+prometheus_local_storage_persistence_urgency_score 0.85
+prometheus_local_storage_chunks_to_persist 300000
+prometheus_local_storage_max_chunks_to_persist 524288
+prometheus_local_storage_rushed_mode 1
+prometheus_evaluator_duration_seconds{quantile="0.5"} 0.5
+prometheus_evaluator_duration_seconds{quantile="0.99"} 13.5
+prometheus_engine_query_duration_seconds{slice="inner_eval",quantile="0.99"} 7
+''' + ('prometheus_engine_query_duration_seconds'
+       '{slice="queue_time",quantile="0.99"} NaN\n')
+METRICS_2X = '''\
+prometheus_rule_group_last_duration_seconds{rule_group="/a.rules;a"} 1
+prometheus_rule_group_interval_seconds{rule_group="/a.rules;a"} 15
+prometheus_engine_query_duration_seconds{slice="inner_eval",quantile="0.99"} 1
+'''
+CONFIG = '''\
+global:
+  scrape_interval: 15s
+  evaluation_interval: 15s
+scrape_configs:
+  - job_name: 'prometheus'
+  - job_name: 'collectd'
+    scrape_interval: 60s
+'''
+
+
+def queries(results):
+    """Stand-in /api/v1/query, results maps queries to their samples."""
+    def query(params):
+        return vector(*results.get(params['query'][0], []))
+    return query
+
+
+class TestCheckPrometheusPerf(unittest.TestCase):
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dirname)
+        self.config = os.path.join(self.dirname, 'prometheus.yml')
+        with open(self.config, 'w') as fh:
+            fh.write(CONFIG)
+
+    def run_check(self, standin, *args):
+        return check.run(list(args) + ['--port', str(standin.port),
+                                       '--config', self.config])
+
+    def test_parse_metrics(self):
+        self.assertEqual(check.parse_metrics(
+            '# HELP up whatever\n'
+            'up 1\n'
+            'foo{a="1",b="x \\"y\\", z"} 2.5 1467000000\n'
+            'bar{} NaN\n'
+            'baz oops\n')[:2], [
+            ('up', {}, 1.0),
+            ('foo', {'a': '1', 'b': 'x \\"y\\", z'}, 2.5)])
+
+    def test_persistence(self):
+        with StandInServer({'/metrics': METRICS_1X}) as standin:
+            status, output = self.run_check(standin, 'persistence')
+            self.assertEqual(status, check.WARNING)
+            self.assertEqual(
+                output, "WARNING: persistence_urgency=0.85 | "
+                "'persistence_urgency'=0.85;0.7;0.9 "
+                "'chunks_to_persist_ratio'=0.572205;0.7;0.9")
+            status, output = self.run_check(standin, 'persistence',
+                                            '-w', '0.9', '-c', '0.95')
+            self.assertEqual(status, check.OK)
+            self.assertTrue(output.startswith(
+                'OK: persistence within thresholds'))
+        # max-chunks-to-persist from the command line if not exported
+        metrics = METRICS_1X.replace(
+            'prometheus_local_storage_max_chunks_to_persist', 'other')
+        with StandInServer({'/metrics': metrics}) as standin:
+            status, output = self.run_check(
+                standin, 'persistence', '-w', '0.9', '-c', '0.95',
+                '--max-chunks-to-persist', '310000')
+            self.assertEqual(status, check.CRITICAL)
+            self.assertIn('chunks_to_persist_ratio=0.9677', output)
+        with StandInServer({'/metrics': METRICS_2X}) as standin:
+            self.assertEqual(self.run_check(standin, 'persistence'), (
+                check.OK, 'OK: No local storage metrics (prometheus 2.x)'))
+
+    def test_ingestion(self):
+        skipped = ('sum(increase('
+                   'prometheus_target_skipped_scrapes_total[5m]))')
+        routes = {'/metrics': METRICS_1X,
+                  '/api/v1/query': queries({skipped: [({}, 12)]})}
+        with StandInServer(routes) as standin:
+            status, output = self.run_check(standin, 'ingestion')
+            self.assertEqual(status, check.CRITICAL)
+            self.assertEqual(
+                output, "CRITICAL: Storage in rushed mode, "
+                "skipped_scrapes=12 | 'skipped_scrapes'=12;1;10 "
+                "'sample_limit_exceeded'=0;1;10")
+            self.assertEqual(sorted(r.split('?')[0] for r in standin.requests),
+                             ['/api/v1/query', '/api/v1/query', '/metrics'])
+        routes = {'/metrics': METRICS_1X.replace('0.85', '1'),
+                  '/api/v1/query': queries({})}
+        with StandInServer(routes) as standin:
+            status, output = self.run_check(standin, 'ingestion')
+            self.assertEqual(status, check.CRITICAL)
+            self.assertTrue(output.startswith('CRITICAL: Ingestion throttled'))
+
+    def test_scrape(self):
+        routes = {'/api/v1/query': queries({
+            'max by (job) (scrape_duration_seconds)': [
+                ({'job': 'prometheus'}, 0.1),
+                ({'job': 'collectd'}, 40),
+                ({'job': 'gone'}, 100)]})}
+        with StandInServer(routes) as standin:
+            status, output = self.run_check(standin, 'scrape')
+            self.assertEqual(status, check.WARNING)
+            self.assertTrue(output.startswith('WARNING: collectd=0.6667 | '))
+            self.assertNotIn('gone', output)
+
+    def test_rules(self):
+        with StandInServer({'/metrics': METRICS_1X}) as standin:
+            status, output = self.run_check(standin, 'rules')
+            self.assertEqual(status, check.CRITICAL)
+            self.assertTrue(output.startswith('CRITICAL: evaluation=0.9 | '))
+        with StandInServer({'/metrics': METRICS_2X}) as standin:
+            status, output = self.run_check(standin, 'rules')
+            self.assertEqual(status, check.OK)
+            self.assertIn("'/a.rules;a'=0.0666667;0.5;0.8", output)
+
+    def test_query(self):
+        with StandInServer({'/metrics': METRICS_1X}) as standin:
+            self.assertEqual(self.run_check(standin, 'query'), (
+                check.WARNING,
+                "WARNING: inner_eval=7 | 'inner_eval'=7;5;20"))
+
+    def test_unreachable(self):
+        with StandInServer() as standin:
+            port = standin.port
+        status, output = check.run(['query', '--port', str(port)])
+        self.assertEqual(status, check.UNKNOWN)
+        self.assertTrue(output.startswith('UNKNOWN: Could not fetch'))
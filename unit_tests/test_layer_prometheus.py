@@ -0,0 +1,32 @@
+import unittest
+
+from charms.layer import prometheus as layer_prometheus
+from unit_tests.http_standin import StandInServer
+
+
+class TestLayerPrometheus(unittest.TestCase):
+    def test_parse_duration(self):
+        parse = layer_prometheus.parse_duration
+        self.assertEqual(parse('15s'), 15)
+        self.assertEqual(parse('5m'), 300)
+        self.assertEqual(parse('15m0s'), 900)
+        self.assertEqual(parse('1h30m'), 5400)
+        self.assertEqual(parse('500ms'), 0.5)
+        self.assertEqual(parse('2d'), 172800)
+        for invalid in ('', '15', '15 minutes', '1x'):
+            self.assertRaises(ValueError, parse, invalid)
+
+    def test_parse_metrics(self):
+        lines = [b'# HELP up whatever\n', b'up 1\n',
+                 b'foo{a="1"} 2.5\n', b'bar NaN\n', b'baz oops\n']
+        metrics = layer_prometheus.parse_metrics(lines)
+        self.assertEqual(metrics['up'], 1)
+        self.assertEqual(metrics['foo{a="1"}'], 2.5)
+        self.assertNotIn('baz', metrics)
+        self.assertEqual(layer_prometheus.parse_metrics(lines, ['foo']),
+                         {'foo{a="1"}': 2.5})
+
+    def test_self_metrics(self):
+        with StandInServer({'/metrics': 'up 1\n'}) as standin:
+            self.assertEqual(
+                layer_prometheus.self_metrics(standin.port, 5), {'up': 1})
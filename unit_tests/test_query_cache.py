@@ -0,0 +1,171 @@
+import json
+import shutil
+import tempfile
+import threading
+import unittest
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
+from files import query_cache
+from unit_tests.http_standin import StandInServer
+
+# 100s into a 150s bucket, the previous one is settled
+NOW = 1467000100.0
+
+
+def matrix(params):
+    """Stand-in query_range: one series, its value is the timestamp."""
+    start, end, step = (float(params[k][0]) for k in ('start', 'end', 'step'))
+    values = []
+    t = start
+    while t <= end:
+        values.append([t, str(t)])
+        t += step
+    if params['query'][0] == 'bad(':
+        return None
+    return {'status': 'success', 'data': {'resultType': 'matrix', 'result': [
+        {'metric': {'__name__': 'up'}, 'values': values}]}}
+
+
+class TestQueryCache(unittest.TestCase):
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dirname)
+
+    def query_cache(self, standin, **kwargs):
+        cache = query_cache.LRUCache(1024 * 1024, 1024 * 1024, self.dirname)
+        return query_cache.QueryCache(
+            'http://localhost:{}'.format(standin.port), cache,
+            bucket_steps=10, settle=60, clock=lambda: NOW, **kwargs)
+
+    def upstream_ranges(self, standin):
+        ranges = []
+        for path in standin.requests:
+            params = query_cache.parse_qs(query_cache.urlparse(path).query)
+            ranges.append((float(params['start'][0]), float(params['end'][0])))
+        return ranges
+
+    def test_parse_duration(self):
+        self.assertEqual(query_cache.parse_duration('15'), 15)
+        self.assertEqual(query_cache.parse_duration('1.5'), 1.5)
+        self.assertEqual(query_cache.parse_duration('2m'), 120)
+        self.assertEqual(query_cache.parse_duration('100ms'), 0.1)
+        self.assertRaises(ValueError, query_cache.parse_duration, '2 m')
+
+    def test_query_range_buckets(self):
+        with StandInServer({query_cache.QUERY_RANGE: matrix}) as standin:
+            qc = self.query_cache(standin)
+            # an hour up to now, 15s steps: 150s buckets, unaligned start
+            start, end = NOW - 3600 + 7, NOW
+            response = qc.query_range('up', start, end, 15)
+            values = response['data']['result'][0]['values']
+            self.assertEqual([v[0] for v in values],
+                             [t for t in range(int(start), int(end) + 1)
+                              if t % 15 == 0])
+            self.assertEqual(values[0][1], str(values[0][0]))
+            # completed buckets are aligned to multiples of the bucket width
+            ranges = self.upstream_ranges(standin)
+            for bucket_start, bucket_end in ranges[:-1]:
+                self.assertEqual(bucket_start % 150, 0)
+                self.assertEqual(bucket_end - bucket_start, 135)
+            # a refresh only evaluates the open bucket
+            del standin.requests[:]
+            self.assertEqual(qc.query_range('up', start, end, 15), response)
+            self.assertEqual(self.upstream_ranges(standin),
+                             [(NOW - 100, NOW)])
+            self.assertEqual(qc.stats['hits'], len(ranges) - 1)
+
+    def test_upstream_error(self):
+        with StandInServer({query_cache.QUERY_RANGE: matrix}) as standin:
+            qc = self.query_cache(standin)
+            with self.assertRaises(query_cache.UpstreamError) as cm:
+                qc.query_range('bad(', NOW - 600, NOW, 15)
+            self.assertEqual(cm.exception.status, 404)
+
+    def test_upstream_down(self):
+        with StandInServer() as standin:
+            qc = self.query_cache(standin)
+        with self.assertRaises(query_cache.UpstreamError) as cm:
+            qc.query_range('up', NOW - 600, NOW, 15)
+        self.assertEqual(cm.exception.status, 503)
+        server = query_cache.make_server(('localhost', 0), qc)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = 'http://localhost:{}'.format(server.server_address[1])
+        with self.assertRaises(HTTPError) as cm:
+            urlopen(url + '/api/v1/label/job/values')
+        self.assertEqual(cm.exception.code, 503)
+        self.assertEqual(json.loads(cm.exception.read().decode())['status'],
+                         'error')
+
+    def test_lru_spills_to_disk(self):
+        cache = query_cache.LRUCache(10, 15, self.dirname)
+        cache.put('a', b'aaaaaa')
+        cache.put('b', b'bbbbbb')
+        # a was evicted from memory, but is still on disk
+        self.assertEqual(cache.memory_bytes, 6)
+        self.assertEqual(cache.disk_bytes, 6)
+        self.assertEqual(cache.get('a'), b'aaaaaa')
+        self.assertEqual(cache.get('b'), b'bbbbbb')
+        cache.put('c', b'cccccc')
+        cache.put('d', b'dddddd')
+        # disk only holds two entries, the oldest one is gone
+        self.assertEqual(cache.disk_bytes, 12)
+        self.assertIsNone(cache.get('a'))
+        # disk entries survive restarts
+        cache = query_cache.LRUCache(10, 15, self.dirname)
+        self.assertEqual(cache.get('c'), b'cccccc')
+
+    def test_singleflight(self):
+        flights = query_cache.SingleFlight()
+        release = threading.Event()
+        calls = []
+
+        def slow():
+            calls.append(1)
+            release.wait(5)
+            return 'result'
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(
+            flights.do('key', slow))) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        while flights.merged < 4:
+            threading.Event().wait(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(calls, [1])
+        self.assertEqual(results, ['result'] * 5)
+
+    def test_server(self):
+        routes = {query_cache.QUERY_RANGE: matrix,
+                  '/api/v1/label/job/values': {'status': 'success',
+                                               'data': ['prometheus']}}
+        with StandInServer(routes) as standin:
+            server = query_cache.make_server(('localhost', 0),
+                                             self.query_cache(standin))
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+            self.addCleanup(server.server_close)
+            self.addCleanup(server.shutdown)
+            url = 'http://localhost:{}'.format(server.server_address[1])
+            form = 'query=up&start={}&end={}&step=1m'.format(NOW - 600, NOW)
+            with urlopen(url + query_cache.QUERY_RANGE,
+                         data=form.encode()) as fh:
+                result = json.loads(fh.read().decode())['data']['result']
+            self.assertEqual(len(result[0]['values']), 10)
+            with urlopen(url + '/api/v1/label/job/values') as fh:
+                self.assertEqual(json.loads(fh.read().decode())['data'],
+                                 ['prometheus'])
+            with self.assertRaises(HTTPError) as cm:
+                urlopen(url + '/nope')
+            self.assertEqual(cm.exception.code, 404)
+            with urlopen(url + query_cache.METRICS_PATH) as fh:
+                self.assertIn(b'prometheus_query_cache_misses_total',
+                              fh.read())
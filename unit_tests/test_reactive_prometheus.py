@@ -1,18 +1,25 @@
+import json
 import os
 import mock
+import socket
+import subprocess
 import shutil
 import tempfile
 import unittest
 import yaml
 
 from reactive import prometheus as react_prom
-from charmhelpers.core import unitdata
+from charmhelpers.core import hookenv, unitdata
 from charmhelpers.core.templating import render
 from charms.reactive import bus
+from unit_tests.http_standin import StandInServer
 
 os.environ['JUJU_UNIT_NAME'] = 'prometheus'
 os.environ['CHARM_DIR'] = '..'
 
+# TestPrometheusContext mocks validate_config() out, keep the real one around
+validate_config = react_prom.validate_config
+
 fixed_scrape_config = {'job_name': 'prometheus', 'target_groups':
                        [{'targets': ['localhost:9090']}]}
 
@@ -71,6 +78,14 @@ class TestPrometheusContext(unittest.TestCase):
         react_prom.PROMETHEUS_YML = self.prom_yml
         react_prom.PROMETHEUS_DEF = self.prom_def
         react_prom.CUSTOM_RULES_PATH = self.prom_custom_rules
+        self.targets_dir = os.path.join(self.dir, 'targets')
+        react_prom.TARGETS_DIR = self.targets_dir
+        self.rules_dir = os.path.join(self.dir, 'rules')
+        react_prom.RULES_DIR = self.rules_dir
+        self.charm_metrics_dir = os.path.join(self.dir, 'charm-assets')
+        react_prom.CHARM_METRICS_DIR = self.charm_metrics_dir
+        react_prom.READAHEAD_UDEV_RULE = os.path.join(self.dir,
+                                                      'readahead.rules')
         # ugly hack, to avoid carrying global unitdata state across tests
         os.environ['UNIT_STATE_DB'] = os.path.join(self.dir, '.unit-state.db')
         unitdata._KV = None
@@ -115,7 +130,7 @@ class TestPrometheusContext(unittest.TestCase):
         mock_set_state.assert_called_once_with('prometheus.do-check-reconfig')
         react_prom.write_prometheus_config_yml()
         react_prom.write_prometheus_config_def()
-        mock_validate_config.assert_called_once_with()
+        mock_validate_config.assert_called_once_with(self.prom_yml + '.new')
         yaml_content = yaml.safe_load(open(self.prom_yml))
         exp_list = [
             fixed_scrape_config,
@@ -151,7 +166,7 @@ class TestPrometheusContext(unittest.TestCase):
         mock_set_state.assert_called_once_with('prometheus.do-check-reconfig')
         react_prom.write_prometheus_config_yml()
         react_prom.write_prometheus_config_def()
-        mock_validate_config.assert_called_once_with()
+        mock_validate_config.assert_called_once_with(self.prom_yml + '.new')
         yaml_content = yaml.safe_load(open(self.prom_yml))
         exp_dict = fixed_scrape_config
         self.assertDictEqual(yaml_content['scrape_configs'][0], exp_dict)
@@ -170,11 +185,11 @@ class TestPrometheusContext(unittest.TestCase):
         react_prom.update_prometheus_no_targets()
         react_prom.write_prometheus_config_yml()
         react_prom.write_prometheus_config_def()
-        mock_validate_config.assert_called_once_with()
+        mock_validate_config.assert_called_once_with(self.prom_yml + '.new')
         yaml_content = yaml.safe_load(open(self.prom_yml))
         exp_dict = {'job_name': 'static-targets', 'target_groups':
                     [{'labels': {'group': 'promoagents-static'},
-                      'targets': ['foo:1234', 'bar:5678']}]}
+                      'targets': ['bar:5678', 'foo:1234']}]}
 
         self.assertDictEqual(yaml_content['scrape_configs'][1], exp_dict)
 
@@ -197,17 +212,107 @@ class TestPrometheusContext(unittest.TestCase):
         srv1_hostport2 = ['foohost2', 'fooport2']
         srv1_mock = {srv1_name: [srv1_hostport1, srv1_hostport2]}
         req_mock = ReactInterfaceMock(srv1_mock)
-        react_prom.update_prometheus_alertmanager(req_mock)
+        with mock.patch('reactive.prometheus.prometheus_version',
+                        return_value=(1, 5, 2)):
+            react_prom.update_prometheus_alertmanager(req_mock)
         react_prom.write_prometheus_config_yml()
         react_prom.write_prometheus_config_def()
         # Verify etc/default/prometheus has -alertmanager.url set to
-        # last alertmanager in related services
+        # all alertmanagers in related services
         with open(self.prom_def) as fh:
             self.assertRegexpMatches(
                 fh.readline(),
-                'ARGS.*-alertmanager.url http://{0}:{1}.*'.format(
-                    *srv1_hostport2)
+                'ARGS.*-alertmanager.url http://{0}:{1},http://{2}:{3} .*'
+                .format(*(srv1_hostport1 + srv1_hostport2))
             )
+        # older versions only take a single url
+        with mock.patch('reactive.prometheus.prometheus_version',
+                        return_value=(0, 17, 0)):
+            react_prom.update_prometheus_alertmanager(req_mock)
+        self.assertIn('-alertmanager.url http://{0}:{1}'.format(
+            *srv1_hostport1), react_prom.runtime_args())
+
+    def test_alertmanager_options(self,
+                                  mock_hookenv_config,
+                                  *args):
+        config = self.def_config
+        config.update({'alertmanager-queue-capacity': 10000,
+                       'alertmanager-http-deadline': '2s'})
+        mock_hookenv_config.return_value = config
+        react_prom.update_prometheus_no_alertmanager()
+        self.assertEqual(react_prom.runtime_args(), [
+            '-alertmanager.http-deadline 2s',
+            '-alertmanager.notification-queue-capacity 10000',
+        ])
+
+    def test_perf_check_cmds(self, mock_hookenv_config, *args):
+        config = self.def_config
+        config['nrpe-perf-thresholds'] = ('scrape: [0.6, 0.9]\n'
+                                          'query: 10\n')
+        mock_hookenv_config.return_value = config
+        unitdata.kv().set('prometheus.port', 9091)
+        react_prom.runtime_args('-storage.local.max-chunks-to-persist',
+                                524288)
+        cmds = react_prom.perf_check_cmds()
+        self.assertEqual(sorted(cmds), ['ingestion', 'persistence', 'query',
+                                        'rules', 'scrape'])
+        self.assertEqual(cmds['scrape'], (
+            'check_prometheus_perf scrape --port 9091 --config {} '
+            '-w 0.6 -c 0.9'.format(react_prom.PROMETHEUS_YML)))
+        # invalid thresholds keep the check's defaults
+        self.assertNotIn('-w', cmds['query'])
+        self.assertTrue(cmds['persistence'].endswith(
+            '--max-chunks-to-persist 524288'))
+
+    @mock.patch('reactive.prometheus.host.write_file')
+    @mock.patch('reactive.prometheus.host.mkdir')
+    @mock.patch('reactive.prometheus.fetch')
+    @mock.patch('reactive.prometheus.nrpe')
+    def test_update_nrpe_config(self, mock_nrpe, mock_fetch, mock_mkdir,
+                                mock_write_file, mock_hookenv_config, *args):
+        config = self.def_config
+        mock_hookenv_config.return_value = config
+        react_prom.update_nrpe_config(mock.Mock())
+        nrpe_setup = mock_nrpe.NRPE.return_value
+        nrpe_setup.remove_check.assert_any_call(
+            shortname=react_prom.QUERY_CACHE_SVC)
+        self.assertEqual(mock_nrpe.add_init_service_checks.call_args[0][1],
+                         ['prometheus'])
+        # performance checks are opt-in
+        self.assertFalse(nrpe_setup.add_check.called)
+        nrpe_setup.remove_check.assert_any_call(
+            shortname='prometheus_persistence')
+        nrpe_setup.write.assert_called_once_with()
+        config['nrpe-perf-checks'] = True
+        react_prom.update_nrpe_config(mock.Mock())
+        mock_fetch.apt_install.assert_any_call('python3-yaml')
+        self.assertEqual(nrpe_setup.add_check.call_count, 5)
+
+    def test_hook_kv(self, *args):
+        store = unitdata.kv()
+        store.set('target_jobs', [{'job_name': 'foo', 'targets': []}])
+        kv = react_prom.hook_kv()
+        self.assertIs(react_prom.hook_kv(), kv)
+        with mock.patch.object(store, 'get', wraps=store.get) as mock_get:
+            jobs = kv.get('target_jobs')
+            self.assertIs(kv.get('target_jobs'), jobs)
+            self.assertIsNone(kv.get('missing'))
+            self.assertEqual(kv.get('missing', []), [])
+            self.assertEqual(mock_get.call_count, 2)
+        kv.set('prometheus.port', 9091)
+        self.assertEqual(store.get('prometheus.port'), 9091)
+        kv.unset('prometheus.port')
+        self.assertEqual(kv.get('prometheus.port', 9090), 9090)
+        self.assertIsNone(store.get('prometheus.port'))
+        # unchanged runtime args are not written again
+        react_prom.runtime_args('-foo', 'bar')
+        with mock.patch.object(store, 'set') as mock_set:
+            self.assertEqual(react_prom.runtime_args('-foo', 'bar'),
+                             ['-foo bar'])
+            self.assertFalse(mock_set.called)
+        # a new unitdata store, e.g. in a new hook, isn't served from cache
+        unitdata._KV = None
+        self.assertIsNot(react_prom.hook_kv(), kv)
 
     @mock.patch('reactive.prometheus.set_state')
     def test_install_packages_conditionally_called(self,
@@ -303,3 +408,1013 @@ class TestPrometheusContext(unittest.TestCase):
         mock_install_packages.called_once_with()
         mock_service_running.assert_called_with('prometheus')
         mock_service_restarted.assert_called_with('prometheus')
+
+    @mock.patch('reactive.prometheus.set_state')
+    def test_yml_change_requests_reload(self,
+                                        mock_set_state,
+                                        mock_hookenv_config,
+                                        mock_unit_get,
+                                        *args):
+        mock_hookenv_config.return_value = self.def_config
+        mock_unit_get.return_value = 'localhost'
+        react_prom.write_prometheus_config_yml()
+        mock_set_state.assert_called_once_with('prometheus.do-reload')
+
+    @mock.patch('reactive.prometheus.set_state')
+    def test_unchanged_args_skip_restart(self,
+                                         mock_set_state,
+                                         mock_hookenv_config,
+                                         mock_unit_get,
+                                         *args):
+        mock_hookenv_config.return_value = self.def_config
+        react_prom.runtime_args('-storage.local.retention', '72h0m0s')
+        react_prom.write_prometheus_config_def()
+        mock_set_state.assert_called_once_with('prometheus.do-restart')
+        # prometheus was restarted with these args
+        bus.set_state('prometheus.started')
+        unitdata.kv().set('prometheus.def-hash',
+                          react_prom.file_hash(self.prom_def))
+        mock_set_state.reset_mock()
+        react_prom.write_prometheus_config_def()
+        self.assertFalse(mock_set_state.called)
+        react_prom.runtime_args('-storage.local.retention', '48h0m0s')
+        react_prom.write_prometheus_config_def()
+        mock_set_state.assert_called_once_with('prometheus.do-restart')
+
+    @mock.patch('reactive.prometheus.remove_state')
+    @mock.patch('reactive.prometheus.set_state')
+    @mock.patch('reactive.prometheus.reload_succeeded')
+    @mock.patch('reactive.prometheus.host.service_reload')
+    def test_reload_prometheus(self,
+                               mock_service_reload,
+                               mock_reload_succeeded,
+                               mock_set_state,
+                               mock_remove_state,
+                               mock_hookenv_config,
+                               mock_unit_get,
+                               mock_validate_config,
+                               mock_data_changed,
+                               mock_service_running,
+                               *args):
+        mock_service_running.return_value = True
+        mock_reload_succeeded.return_value = True
+        react_prom.reload_prometheus()
+        mock_service_reload.assert_called_once_with('prometheus')
+        mock_remove_state.assert_called_once_with('prometheus.do-reload')
+        self.assertFalse(mock_set_state.called)
+        # Failed reload falls back to a restart
+        mock_remove_state.reset_mock()
+        mock_reload_succeeded.return_value = False
+        react_prom.reload_prometheus()
+        mock_set_state.assert_called_once_with('prometheus.do-restart')
+        self.assertFalse(mock_remove_state.called)
+
+    @mock.patch('reactive.prometheus.get_self_metrics')
+    def test_reload_succeeded(self, mock_get_self_metrics, *args):
+        mock_get_self_metrics.return_value = {
+            'prometheus_config_last_reload_successful': 1.0,
+            'prometheus_config_last_reload_success_timestamp_seconds': 200.0,
+        }
+        self.assertTrue(react_prom.reload_succeeded(100, timeout=0))
+        self.assertFalse(react_prom.reload_succeeded(300, timeout=0))
+        mock_get_self_metrics.return_value = {
+            'prometheus_config_last_reload_successful': 0.0,
+        }
+        self.assertFalse(react_prom.reload_succeeded(100, timeout=0))
+
+    def test_update_prometheus_targets_file_sd(self,
+                                               mock_hookenv_config,
+                                               mock_unit_get,
+                                               *args):
+        config = self.def_config
+        config['file-sd'] = True
+        mock_hookenv_config.return_value = config
+        mock_unit_get.return_value = 'localhost'
+        req_mock = ReactInterfaceMock({'foo': [['foohost2', 'p2'],
+                                               ['foohost1', 'p1']]})
+        react_prom.update_prometheus_targets(req_mock)
+        react_prom.write_prometheus_config_yml()
+        foo_file = os.path.join(self.targets_dir, 'target-foo.json')
+        with open(foo_file) as fh:
+            self.assertEqual(json.load(fh), [
+                {'labels': {'group': 'promoagents-juju'},
+                 'targets': ['foohost1:p1', 'foohost2:p2']}])
+        yaml_content = yaml.safe_load(open(self.prom_yml))
+        self.assertDictEqual(yaml_content['scrape_configs'][1], {
+            'job_name': 'foo',
+            'file_sd_configs': [{'names': [foo_file]}]})
+        # Unit churn only rewrites the target file, jobs stay the same
+        jobs = react_prom.rendered_jobs(config)
+        react_prom.update_prometheus_targets(
+            ReactInterfaceMock({'foo': [['foohost1', 'p1']]}))
+        self.assertEqual(react_prom.rendered_jobs(config), jobs)
+        with open(foo_file) as fh:
+            self.assertEqual(json.load(fh)[0]['targets'], ['foohost1:p1'])
+        # Departed services get their target file removed
+        react_prom.update_prometheus_targets(
+            ReactInterfaceMock({'bar': [['barhost1', 'p1']]}))
+        react_prom.rendered_jobs(config)
+        self.assertEqual(os.listdir(self.targets_dir), ['target-bar.json'])
+
+    def test_group_targets(self, *args):
+        juju = {'group': 'promoagents-juju'}
+        self.assertEqual(react_prom.group_targets([
+            (juju, ['b:1']), (None, ['c:1']), (juju, ['a:1', 'b:1']),
+        ]), [
+            {'targets': ['c:1']},
+            {'targets': ['a:1', 'b:1'], 'labels': juju},
+        ])
+
+    def test_normalize_jobs(self, mock_hookenv_config, *args):
+        config = {'static-targets': 'a:1, c:1',
+                  'target-precedence': 'static,scrape,target'}
+        mock_hookenv_config.return_value = config
+        target_jobs = [{'job_name': 'svc2', 'targets': ['b:1', 'c:1']},
+                       {'job_name': 'svc1', 'targets': ['b:1', 'a:1']},
+                       {'job_name': 'svc3', 'targets': ['a:1']}]
+        scrape_jobs = [{'job_name': 'app', 'metrics_path': '/metrics',
+                        'targets': ['d:1', 'c:1']},
+                       {'job_name': 'other', 'metrics_path': '/other',
+                        'targets': ['a:1']}]
+        jobs = react_prom.normalize_jobs(config, target_jobs, scrape_jobs)
+        # static targets win, then scrape jobs, then the first target job
+        self.assertEqual(jobs['static'], [{
+            'job_name': 'static-targets',
+            'target_groups': [{'targets': ['a:1', 'c:1'],
+                               'labels': {'group': 'promoagents-static'}}]}])
+        self.assertEqual(jobs['scrape'], [
+            {'job_name': 'app', 'metrics_path': '/metrics',
+             'target_groups': [{'targets': ['d:1']}]},
+            {'job_name': 'other', 'metrics_path': '/other',
+             'target_groups': [{'targets': ['a:1']}]}])
+        self.assertEqual(jobs['target'], [
+            {'job_name': 'svc1',
+             'target_groups': [{'targets': ['b:1'],
+                                'labels': {'group': 'promoagents-juju'}}]}])
+        # the order of relation data doesn't matter
+        self.assertEqual(react_prom.normalize_jobs(
+            config, target_jobs[::-1], scrape_jobs[::-1]), jobs)
+        # relation targets win over static ones if so configured
+        config['target-precedence'] = 'target,static'
+        jobs = react_prom.normalize_jobs(config, target_jobs, scrape_jobs)
+        self.assertEqual(
+            [(j['job_name'], j['target_groups'][0]['targets'])
+             for source in ('static', 'scrape', 'target')
+             for j in jobs[source]],
+            [('app', ['c:1', 'd:1']), ('other', ['a:1']),
+             ('svc1', ['a:1', 'b:1']), ('svc2', ['c:1'])])
+        # no precedence, no dedupe
+        config['target-precedence'] = ''
+        jobs = react_prom.normalize_jobs(config, target_jobs, scrape_jobs)
+        self.assertEqual(len(jobs['target']), 3)
+
+    def test_dedupe_rendered_targets(self,
+                                     mock_hookenv_config,
+                                     mock_unit_get,
+                                     *args):
+        config = self.def_config
+        config['static-targets'] = "foo1:9100, it's:9100"
+        mock_hookenv_config.return_value = config
+        mock_unit_get.return_value = 'localhost'
+        react_prom.update_prometheus_targets(ReactInterfaceMock(
+            {'foo': [['foo2', '9100'], ['foo1', '9100']]}))
+        react_prom.write_prometheus_config_yml()
+        with open(self.prom_yml) as fh:
+            content = fh.read()
+        self.assertIn("- targets: ['foo1:9100', 'it''s:9100']", content)
+        scrape_configs = yaml.safe_load(content)['scrape_configs']
+        self.assertEqual(
+            [(c['job_name'], c['target_groups'][0]['targets'])
+             for c in scrape_configs[1:]],
+            [('static-targets', ['foo1:9100', "it's:9100"]),
+             ('foo', ['foo2:9100'])])
+
+    @mock.patch('reactive.prometheus.host.adduser')
+    @mock.patch('reactive.prometheus.subprocess.check_call')
+    @mock.patch('reactive.prometheus.host.service')
+    @mock.patch('reactive.prometheus.host.service_stop')
+    @mock.patch('reactive.prometheus.host.mkdir')
+    @mock.patch('reactive.prometheus.host.init_is_systemd',
+                return_value=False)
+    def test_query_cache(self, mock_systemd, mock_mkdir, mock_service_stop,
+                         mock_service, mock_check_call, mock_adduser,
+                         mock_hookenv_config,
+                         mock_unit_get, mock_validate_config,
+                         mock_data_changed, mock_service_running,
+                         mock_service_restart, mock_close_port,
+                         mock_open_port, *args):
+        react_prom.QUERY_CACHE_UPSTART = os.path.join(self.dir, 'qc.conf')
+        react_prom.QUERY_CACHE_BIN = os.path.join(self.dir, 'query-cache')
+        config = self.def_config
+        config['query-cache'] = True
+        mock_hookenv_config.return_value = config
+        unitdata.kv().set('prometheus.port', 9090)
+        react_prom.configure_query_cache()
+        with open(react_prom.QUERY_CACHE_UPSTART) as fh:
+            upstart = fh.read()
+        self.assertIn('--listen :9091 --upstream http://localhost:9090',
+                      upstart)
+        self.assertIn('setuid prometheus\n', upstart)
+        mock_adduser.assert_called_once_with('prometheus', system_user=True)
+        self.assertTrue(os.access(react_prom.QUERY_CACHE_BIN, os.X_OK))
+        mock_service_restart.assert_called_once_with(
+            react_prom.QUERY_CACHE_SVC)
+        mock_open_port.assert_called_once_with(9091)
+        grafana = mock.Mock()
+        react_prom.provide_grafana_source(grafana)
+        grafana.provide.assert_called_once_with(
+            'prometheus', 9091, 'Juju generated source')
+        # disabling it gives grafana prometheus itself again
+        config['query-cache'] = False
+        react_prom.configure_query_cache()
+        mock_service_stop.assert_called_once_with(react_prom.QUERY_CACHE_SVC)
+        mock_close_port.assert_called_once_with(9091)
+        self.assertFalse(os.path.exists(react_prom.QUERY_CACHE_UPSTART))
+        self.assertFalse(os.path.exists(react_prom.QUERY_CACHE_BIN))
+        grafana.reset_mock()
+        react_prom.provide_grafana_source(grafana)
+        grafana.provide.assert_called_once_with(
+            'prometheus', 9090, 'Juju generated source')
+        # systemd units are disabled before and reloaded after removal
+        mock_systemd.return_value = True
+        react_prom.QUERY_CACHE_SYSTEMD = os.path.join(self.dir, 'qc.service')
+        config['query-cache'] = True
+        react_prom.configure_query_cache()
+        self.assertTrue(os.path.exists(react_prom.QUERY_CACHE_SYSTEMD))
+        manager = mock.Mock()
+        manager.attach_mock(mock_service, 'service')
+        manager.attach_mock(mock_service_stop, 'service_stop')
+        manager.attach_mock(mock_check_call, 'check_call')
+        config['query-cache'] = False
+        react_prom.configure_query_cache()
+        self.assertEqual(manager.mock_calls, [
+            mock.call.service('disable', react_prom.QUERY_CACHE_SVC),
+            mock.call.service_stop(react_prom.QUERY_CACHE_SVC),
+            mock.call.check_call(['systemctl', 'daemon-reload'])])
+        self.assertFalse(os.path.exists(react_prom.QUERY_CACHE_SYSTEMD))
+
+    @mock.patch('reactive.prometheus.time.sleep')
+    @mock.patch('reactive.prometheus.hookenv.status_set')
+    @mock.patch('reactive.prometheus.host.service_start')
+    def test_restart_waits_for_ready(self, mock_service_start,
+                                     mock_status_set, mock_sleep,
+                                     mock_hookenv_config, mock_unit_get,
+                                     mock_validate_config, mock_data_changed,
+                                     mock_service_running,
+                                     mock_service_restart, *args):
+        config = self.def_config
+        config['restart-ready-timeout'] = 60
+        mock_hookenv_config.return_value = config
+        checkpointing = ('prometheus_local_storage_checkpointing 1\n'
+                         'prometheus_local_storage_ingested_samples_total 9\n')
+        started = ('prometheus_local_storage_checkpointing 0\n'
+                   'prometheus_local_storage_started_dirty 1\n'
+                   'prometheus_local_storage_ingested_samples_total 0\n')
+        scraping = started.replace('total 0', 'total 150')
+        responses = [checkpointing, started, started, scraping]
+
+        def metrics(params):
+            return responses.pop(0) if len(responses) > 1 else responses[0]
+
+        with StandInServer({'/metrics': metrics}) as standin:
+            unitdata.kv().set('prometheus.port', standin.port)
+            react_prom.restart_prometheus()
+        mock_service_restart.assert_called_once_with('prometheus')
+        self.assertTrue(react_prom.is_state('prometheus.ready'))
+        self.assertEqual(
+            [c[0] for c in mock_status_set.call_args_list], [
+                ('maintenance', 'Waiting for checkpoint to finish'),
+                ('maintenance', 'Waiting for scraping to resume (0s)'),
+                ('active', 'Ready')])
+        restart = unitdata.kv().get('prometheus.restart')
+        self.assertTrue(restart['crash-recovery'])
+        self.assertEqual(restart['downtime'],
+                         restart['ready'] - restart['stopped'])
+
+    @mock.patch('reactive.prometheus.hookenv.status_set')
+    @mock.patch('reactive.prometheus.host.service_start')
+    def test_restart_not_ready(self, mock_service_start, mock_status_set,
+                               mock_hookenv_config, mock_unit_get,
+                               mock_validate_config, mock_data_changed,
+                               mock_service_running, *args):
+        config = self.def_config
+        config['restart-ready-timeout'] = 0
+        mock_hookenv_config.return_value = config
+        mock_service_running.return_value = False
+        with StandInServer() as standin:
+            # nothing is listening there anymore
+            port = standin.port
+        unitdata.kv().set('prometheus.port', port)
+        react_prom.restart_prometheus()
+        mock_service_start.assert_called_once_with('prometheus')
+        self.assertTrue(react_prom.is_state('prometheus.started'))
+        self.assertFalse(react_prom.is_state('prometheus.ready'))
+        mock_status_set.assert_called_with(
+            'waiting',
+            'Waiting for prometheus to load storage and resume scraping')
+        self.assertNotIn('downtime', unitdata.kv().get('prometheus.restart'))
+
+    @mock.patch('reactive.prometheus.check_ready')
+    @mock.patch('reactive.prometheus.wait_for_checkpoint')
+    @mock.patch('reactive.prometheus.hookenv.status_set')
+    @mock.patch('reactive.prometheus.hookenv.leader_set')
+    @mock.patch('reactive.prometheus.hookenv.leader_get')
+    @mock.patch('reactive.prometheus.hookenv.is_leader')
+    @mock.patch('reactive.prometheus.hookenv.relation_set')
+    @mock.patch('reactive.prometheus.hookenv.relation_get')
+    @mock.patch('reactive.prometheus.hookenv.related_units')
+    @mock.patch('reactive.prometheus.hookenv.relation_ids')
+    @mock.patch('reactive.prometheus.hookenv.local_unit')
+    def test_rolling_restart(self,
+                             mock_local_unit,
+                             mock_relation_ids,
+                             mock_related_units,
+                             mock_relation_get,
+                             mock_relation_set,
+                             mock_is_leader,
+                             mock_leader_get,
+                             mock_leader_set,
+                             mock_status_set,
+                             mock_wait_for_checkpoint,
+                             mock_check_ready,
+                             mock_hookenv_config,
+                             mock_unit_get,
+                             mock_validate_config,
+                             mock_data_changed,
+                             mock_service_running,
+                             mock_service_restart,
+                             *args):
+        mock_hookenv_config.return_value = self.def_config
+        mock_service_running.return_value = True
+        mock_local_unit.return_value = 'prometheus/0'
+        mock_is_leader.return_value = True
+        mock_relation_ids.return_value = ['prometheus-peers:0']
+        mock_related_units.return_value = ['prometheus/1', 'prometheus/2']
+        settings = {'prometheus/0': {},
+                    'prometheus/1': {'restart-request': '1.0'},
+                    'prometheus/2': {}}
+        leader = {'restart-granted': json.dumps(['prometheus/1'])}
+        mock_relation_get.side_effect = lambda unit, rid: settings[unit]
+        mock_relation_set.side_effect = (
+            lambda rid, values: settings['prometheus/0'].update(values))
+        mock_leader_get.side_effect = lambda key: leader.get(key)
+        mock_leader_set.side_effect = leader.update
+        unitdata.kv().set('peer_units', sorted(settings))
+
+        # prometheus/1 is still restarting, wait for it to be ready
+        react_prom.set_state('prometheus.ready')
+        react_prom.set_state('prometheus.do-restart')
+        react_prom.restart_prometheus()
+        self.assertFalse(mock_service_restart.called)
+        self.assertTrue(react_prom.is_state('prometheus.do-restart'))
+        self.assertTrue(react_prom.is_state('prometheus.ready'))
+        self.assertIn('restart-request', settings['prometheus/0'])
+        mock_status_set.assert_called_with('waiting',
+                                           'Waiting for peers to restart')
+
+        # prometheus/1 is done, prometheus/0 is next in the queue
+        settings['prometheus/1']['restart-done'] = '1.0'
+        react_prom.update_restart_grants()
+        self.assertEqual(react_prom.restart_grants(), ['prometheus/0'])
+        react_prom.restart_prometheus()
+        mock_service_restart.assert_called_once_with('prometheus')
+        self.assertFalse(react_prom.is_state('prometheus.do-restart'))
+
+        # a late request of prometheus/2 waits for prometheus/0 to be ready
+        settings['prometheus/2']['restart-request'] = '2.0'
+        react_prom.update_restart_grants()
+        self.assertEqual(react_prom.restart_grants(), ['prometheus/0'])
+        react_prom.set_state('prometheus.ready')
+        react_prom.release_restart_lock()
+        self.assertFalse(react_prom.is_state('prometheus.restart-queued'))
+        self.assertEqual(settings['prometheus/0']['restart-done'],
+                         settings['prometheus/0']['restart-request'])
+        self.assertEqual(react_prom.restart_grants(), ['prometheus/2'])
+
+        # more than one unit at a time with max-parallel-restarts
+        self.def_config['max-parallel-restarts'] = 2
+        settings['prometheus/1']['restart-request'] = '3.0'
+        react_prom.update_restart_grants()
+        self.assertEqual(react_prom.restart_grants(),
+                         ['prometheus/2', 'prometheus/1'])
+        # non-leaders leave grants alone
+        mock_is_leader.return_value = False
+        settings['prometheus/2']['restart-done'] = '2.0'
+        react_prom.update_restart_grants()
+        self.assertEqual(react_prom.restart_grants(),
+                         ['prometheus/2', 'prometheus/1'])
+
+    @mock.patch('reactive.prometheus.time.time')
+    @mock.patch('reactive.prometheus.hookenv.leader_set')
+    @mock.patch('reactive.prometheus.hookenv.leader_get')
+    @mock.patch('reactive.prometheus.hookenv.is_leader', return_value=True)
+    @mock.patch('reactive.prometheus.hookenv.relation_set')
+    @mock.patch('reactive.prometheus.hookenv.relation_get')
+    @mock.patch('reactive.prometheus.hookenv.related_units')
+    @mock.patch('reactive.prometheus.hookenv.relation_ids')
+    @mock.patch('reactive.prometheus.hookenv.local_unit')
+    def test_restart_grant_expiry(self,
+                                  mock_local_unit,
+                                  mock_relation_ids,
+                                  mock_related_units,
+                                  mock_relation_get,
+                                  mock_relation_set,
+                                  mock_is_leader,
+                                  mock_leader_get,
+                                  mock_leader_set,
+                                  mock_time,
+                                  mock_hookenv_config,
+                                  *args):
+        config = self.def_config
+        config['restart-ready-timeout'] = 100
+        mock_hookenv_config.return_value = config
+        mock_time.return_value = 1000.0
+        mock_local_unit.return_value = 'prometheus/0'
+        mock_relation_ids.return_value = ['prometheus-peers:0']
+        mock_related_units.return_value = ['prometheus/1', 'prometheus/2']
+        settings = {'prometheus/0': {},
+                    'prometheus/1': {'restart-request': '1.0'},
+                    'prometheus/2': {'restart-request': '2.0'}}
+        leader = {}
+        mock_relation_get.side_effect = lambda unit, rid: settings[unit]
+        mock_relation_set.side_effect = (
+            lambda rid, values: settings['prometheus/0'].update(values))
+        mock_leader_get.side_effect = lambda key: leader.get(key)
+        mock_leader_set.side_effect = leader.update
+        unitdata.kv().set('peer_units', sorted(settings))
+        react_prom.update_restart_grants()
+        self.assertEqual(react_prom.restart_grants(), ['prometheus/1'])
+        # prometheus/1 never gets ready, its grant expires after
+        # 3 restart-ready-timeouts and prometheus/2 goes next
+        mock_time.return_value = 1300.0
+        react_prom.update_restart_grants()
+        self.assertEqual(react_prom.restart_grants(), ['prometheus/1'])
+        mock_time.return_value = 1301.0
+        react_prom.update_restart_grants()
+        self.assertEqual(react_prom.restart_grants(), ['prometheus/2'])
+        self.assertEqual(react_prom.expired_restarts(),
+                         {'prometheus/1': '1.0'})
+        # a revoked unit queues again behind the others
+        settings['prometheus/2']['restart-done'] = '2.0'
+        settings['prometheus/0']['restart-request'] = '1200.0'
+        react_prom.update_restart_grants()
+        self.assertEqual(react_prom.restart_grants(), ['prometheus/0'])
+        settings['prometheus/1']['restart-request'] = '1301.0'
+        react_prom.update_restart_grants()
+        self.assertEqual(react_prom.expired_restarts(), {})
+        settings['prometheus/0']['restart-done'] = '1200.0'
+        react_prom.update_restart_grants()
+        self.assertEqual(react_prom.restart_grants(), ['prometheus/1'])
+
+    def test_storage_sizing(self, *args):
+        gib = 1024 ** 3
+        # Few targets on a big box: sized for the targets, not the RAM
+        flags = react_prom.storage_sizing(256 * gib, 10, 50)
+        self.assertEqual(flags['-storage.local.memory-chunks'], 1048576)
+        self.assertEqual(flags['-storage.local.max-chunks-to-persist'],
+                         524288)
+        self.assertEqual(flags[
+            '-storage.local.index-cache-size.fingerprint-to-metric'],
+            10485760)
+        # Many targets on a big box: rounded up to a power of two
+        flags = react_prom.storage_sizing(256 * gib, 1000, 50)
+        self.assertEqual(flags['-storage.local.memory-chunks'], 4194304)
+        # Many targets on a small box: capped by ram_percent
+        flags = react_prom.storage_sizing(4 * gib, 1000, 50)
+        self.assertEqual(flags['-storage.local.memory-chunks'],
+                         4 * gib // 2 // 3072)
+        self.assertLess(flags[
+            '-storage.local.index-cache-size.fingerprint-to-metric'],
+            10485760)
+
+    @mock.patch('reactive.prometheus.host.get_total_ram')
+    def test_update_storage_sizing(self,
+                                   mock_get_total_ram,
+                                   mock_hookenv_config,
+                                   *args):
+        config = self.def_config
+        mock_hookenv_config.return_value = config
+        mock_get_total_ram.return_value = 2 * 1024 ** 3
+        react_prom.update_storage_sizing()
+        self.assertFalse([a for a in react_prom.runtime_args()
+                          if a.startswith('-storage.local.memory-chunks')])
+        config['storage-auto-sizing'] = True
+        react_prom.update_storage_sizing()
+        self.assertIn('-storage.local.memory-chunks 349525',
+                      react_prom.runtime_args())
+        # Explicit memory-chunks overrides the computed value
+        config['storage-memory-chunks'] = 200000
+        react_prom.update_storage_sizing()
+        args = react_prom.runtime_args()
+        self.assertIn('-storage.local.memory-chunks 200000', args)
+        self.assertIn('-storage.local.max-chunks-to-persist 100000', args)
+
+    @mock.patch('reactive.prometheus.hookenv.hook_name')
+    @mock.patch('reactive.prometheus.set_state')
+    def test_check_reconfig_coalesced(self,
+                                      mock_set_state,
+                                      mock_hook_name,
+                                      mock_hookenv_config,
+                                      *args):
+        config = self.def_config
+        config.set_changed({'install_sources': False, 'install_keys': False})
+        mock_hookenv_config.return_value = config
+        mock_hook_name.return_value = 'target-relation-changed'
+        react_prom.check_reconfig_prometheus()
+        self.assertIn(mock.call('prometheus.do-reconfig-yml'),
+                      mock_set_state.call_args_list)
+        # Same desired state: nothing to apply
+        mock_set_state.reset_mock()
+        react_prom.check_reconfig_prometheus()
+        self.assertFalse(mock_set_state.called)
+        # New state within reconfig-min-interval: deferred
+        config['reconfig-min-interval'] = 300
+        unitdata.kv().set('target_jobs', [{'job_name': 'foo',
+                                           'targets': ['foo:1']}])
+        react_prom.check_reconfig_prometheus()
+        mock_set_state.assert_called_once_with('prometheus.reconfig-deferred')
+        # ... until update-status
+        mock_set_state.reset_mock()
+        mock_hook_name.return_value = 'update-status'
+        react_prom.check_reconfig_prometheus()
+        self.assertIn(mock.call('prometheus.do-reconfig-yml'),
+                      mock_set_state.call_args_list)
+
+    @mock.patch('reactive.prometheus.set_state')
+    def test_identical_yml_skips_validate_and_reload(self,
+                                                     mock_set_state,
+                                                     mock_hookenv_config,
+                                                     mock_unit_get,
+                                                     mock_validate_config,
+                                                     *args):
+        mock_hookenv_config.return_value = self.def_config
+        mock_unit_get.return_value = 'localhost'
+        react_prom.write_prometheus_config_yml()
+        mock_set_state.assert_called_once_with('prometheus.do-reload')
+        # the hook failed before prometheus was reloaded: the file on disk
+        # is current, but prometheus still needs to load it
+        mock_set_state.reset_mock()
+        react_prom.write_prometheus_config_yml()
+        mock_set_state.assert_called_once_with('prometheus.do-reload')
+        react_prom.record_loaded_config()
+        mock_set_state.reset_mock()
+        mock_validate_config.reset_mock()
+        react_prom.write_prometheus_config_yml()
+        self.assertFalse(mock_set_state.called)
+        self.assertFalse(mock_validate_config.called)
+        self.assertFalse(os.path.exists(self.prom_yml + '.new'))
+
+    @mock.patch('reactive.prometheus.subprocess.check_call')
+    def test_validate_config_cached(self, mock_check_call, *args):
+        with open(self.prom_yml, 'w') as fh:
+            yaml.safe_dump({'rule_files': [self.prom_custom_rules]}, fh)
+        with open(self.prom_custom_rules, 'w') as fh:
+            fh.write('BLAH')
+        validate_config()
+        validate_config()
+        self.assertEqual(mock_check_call.call_args_list, [
+            mock.call(['promtool', 'check-rules', self.prom_custom_rules]),
+            mock.call(['promtool', 'check-config', self.prom_yml]),
+        ])
+        with open(self.prom_custom_rules, 'w') as fh:
+            fh.write('BLEH')
+        validate_config()
+        self.assertEqual(mock_check_call.call_count, 4)
+
+    @mock.patch('reactive.prometheus.hookenv.local_unit')
+    @mock.patch('reactive.prometheus.hookenv.related_units')
+    @mock.patch('reactive.prometheus.hookenv.relation_ids')
+    @mock.patch('reactive.prometheus.set_state')
+    def test_sharding(self,
+                      mock_set_state,
+                      mock_relation_ids,
+                      mock_related_units,
+                      mock_local_unit,
+                      mock_hookenv_config,
+                      mock_unit_get,
+                      *args):
+        config = self.def_config
+        config.update({'sharding': True,
+                       'static-targets': 'foo:1234'})
+        mock_hookenv_config.return_value = config
+        mock_unit_get.return_value = 'localhost'
+        mock_local_unit.return_value = 'prometheus/10'
+        mock_relation_ids.return_value = ['prometheus-peers:0']
+        mock_related_units.return_value = ['prometheus/2', 'prometheus/3']
+        react_prom.update_peers()
+        mock_set_state.assert_called_once_with('prometheus.do-check-reconfig')
+        self.assertEqual(react_prom.shard_config(),
+                         {'modulus': 3, 'shards': [2]})
+        config['shard-replicas'] = 2
+        self.assertEqual(react_prom.shard_config(),
+                         {'modulus': 3, 'shards': [0, 2]})
+        react_prom.update_prometheus_targets(
+            ReactInterfaceMock({'bar': [['barhost1', 'p1']]}))
+        react_prom.write_prometheus_config_yml()
+        yaml_content = yaml.safe_load(open(self.prom_yml))
+        exp_relabel = [
+            {'source_labels': ['__address__'], 'modulus': 3,
+             'target_label': '__tmp_hash', 'action': 'hashmod'},
+            {'source_labels': ['__tmp_hash'], 'regex': '(0|2)',
+             'action': 'keep'},
+        ]
+        scrape_configs = yaml_content['scrape_configs']
+        self.assertNotIn('relabel_configs', scrape_configs[0])
+        self.assertEqual([c['job_name'] for c in scrape_configs],
+                         ['prometheus', 'static-targets', 'bar'])
+        for scrape_config in scrape_configs[1:]:
+            self.assertEqual(scrape_config['relabel_configs'], exp_relabel)
+        # Replicas covering all units disable sharding
+        config['shard-replicas'] = 3
+        self.assertIsNone(react_prom.shard_config())
+
+    @mock.patch('reactive.prometheus.hookenv.relation_get')
+    @mock.patch('reactive.prometheus.hookenv.related_units')
+    @mock.patch('reactive.prometheus.hookenv.relation_ids')
+    @mock.patch('reactive.prometheus.set_state')
+    def test_update_federation_jobs(self,
+                                    mock_set_state,
+                                    mock_relation_ids,
+                                    mock_related_units,
+                                    mock_relation_get,
+                                    mock_hookenv_config,
+                                    mock_unit_get,
+                                    *args):
+        config = self.def_config
+        config['job-settings'] = yaml.safe_dump({
+            'federate-prom-a': {'scrape_timeout': '50s',
+                                'sample_limit': 500000}})
+        mock_hookenv_config.return_value = config
+        mock_unit_get.return_value = 'localhost'
+        match = ['{__name__=~"job:.*"}', "{job='node'}"]
+        rel_data = {
+            'prom-a/0': {'hostname': 'a0', 'port': '9090',
+                         'match': json.dumps(match)},
+            'prom-a/1': {'hostname': 'a1', 'port': '9090',
+                         'match': json.dumps(match)},
+            'prom-b/0': {'hostname': 'b0', 'port': '9090'},
+            'prom-c/0': {'hostname': 'c0', 'port': '9090',
+                         'match': '{__name__=~"job:.*"}'},
+        }
+        mock_relation_ids.return_value = ['federation:1']
+        mock_related_units.return_value = sorted(rel_data)
+        mock_relation_get.side_effect = lambda unit, rid: rel_data[unit]
+        react_prom.update_federation_jobs()
+        mock_set_state.assert_called_once_with('prometheus.do-check-reconfig')
+        with mock.patch('reactive.prometheus.prometheus_version',
+                        return_value=(1, 6, 0)):
+            react_prom.write_prometheus_config_yml()
+        yaml_content = yaml.safe_load(open(self.prom_yml))
+        self.assertDictEqual(yaml_content['scrape_configs'][1], {
+            'job_name': 'federate-prom-a',
+            'scrape_interval': '60s',
+            'scrape_timeout': '50s',
+            'sample_limit': 500000,
+            'honor_labels': True,
+            'metrics_path': '/federate',
+            'params': {'match[]': match},
+            'target_groups': [{'targets': ['a0:9090', 'a1:9090']}],
+        })
+        # prom-b publishes no selectors, prom-c invalid ones (not JSON),
+        # they aren't federated
+        self.assertEqual(len(yaml_content['scrape_configs']), 2)
+
+    @mock.patch('reactive.prometheus.hookenv.relation_set')
+    @mock.patch('reactive.prometheus.hookenv.relation_ids')
+    def test_update_federation_source(self,
+                                      mock_relation_ids,
+                                      mock_relation_set,
+                                      mock_hookenv_config,
+                                      mock_unit_get,
+                                      mock_validate_config,
+                                      mock_data_changed,
+                                      *args):
+        mock_hookenv_config.return_value = self.def_config
+        mock_unit_get.return_value = 'foohost'
+        mock_relation_ids.return_value = ['federation-source:2']
+        unitdata.kv().set('prometheus.port', '9090')
+        react_prom.update_federation_source()
+        mock_relation_set.assert_called_once_with('federation-source:2', {
+            'hostname': 'foohost',
+            'port': '9090',
+            'match': json.dumps(['{__name__=~".+:.+"}']),
+        })
+        mock_relation_set.reset_mock()
+        mock_data_changed.return_value = False
+        react_prom.update_federation_source()
+        self.assertFalse(mock_relation_set.called)
+
+    def test_federation_match(self, mock_hookenv_config, *args):
+        config = self.def_config
+        config['federation-match'] = (
+            '{__name__=~"job:.+", job="node"}, '
+            '{__name__="up",instance=~"a,b|c}"},,up{job=\'x,y\'}')
+        mock_hookenv_config.return_value = config
+        self.assertEqual(react_prom.federation_match(), [
+            '{__name__=~"job:.+", job="node"}',
+            '{__name__="up",instance=~"a,b|c}"}',
+            "up{job='x,y'}",
+        ])
+
+    def test_job_settings(self,
+                          mock_hookenv_config,
+                          mock_unit_get,
+                          *args):
+        config = self.def_config
+        config.update({
+            'static-targets': 'foo:1234',
+            'job-settings': yaml.safe_dump({
+                'collectd': {'scrape_interval': '60s',
+                             'scrape_timeout': '30s'},
+                'myapp': {'sample_limit': 10000},
+                'static-targets': {'scrape_interval': '5s'},
+            }),
+        })
+        mock_hookenv_config.return_value = config
+        mock_unit_get.return_value = 'localhost'
+        react_prom.update_prometheus_targets(
+            ReactInterfaceMock({'collectd': [['host1', 'p1']]}))
+        scrape_mock = mock.Mock()
+        scrape_mock.targets.return_value = [
+            {'job_name': 'myapp', 'metrics_path': '/metrics',
+             'targets': ['app1:80'], 'scrape_interval': '10s'}]
+        react_prom.update_prometheus_scrape_targets(scrape_mock)
+        with mock.patch('reactive.prometheus.prometheus_version',
+                        return_value=(1, 6, 0)):
+            react_prom.write_prometheus_config_yml()
+        yaml_content = yaml.safe_load(open(self.prom_yml))
+        jobs = {j['job_name']: j for j in yaml_content['scrape_configs']}
+        self.assertEqual(jobs['collectd']['scrape_interval'], '60s')
+        self.assertEqual(jobs['collectd']['scrape_timeout'], '30s')
+        # relation data is kept unless overridden
+        self.assertEqual(jobs['myapp']['scrape_interval'], '10s')
+        self.assertEqual(jobs['myapp']['sample_limit'], 10000)
+        # older versions reject sample_limit
+        with mock.patch('reactive.prometheus.prometheus_version',
+                        return_value=(1, 5, 2)):
+            react_prom.write_prometheus_config_yml()
+        yaml_content = yaml.safe_load(open(self.prom_yml))
+        jobs = {j['job_name']: j for j in yaml_content['scrape_configs']}
+        self.assertNotIn('sample_limit', jobs['myapp'])
+        self.assertEqual(jobs['myapp']['scrape_interval'], '10s')
+        self.assertEqual(jobs['static-targets']['scrape_interval'], '5s')
+        self.assertNotIn('scrape_interval', jobs['prometheus'])
+
+    def test_metric_relabel_configs(self,
+                                    mock_hookenv_config,
+                                    mock_unit_get,
+                                    *args):
+        drop_go = {'source_labels': ['__name__'], 'regex': 'go_.*',
+                   'action': 'drop'}
+        drop_id = {'regex': 'request_id', 'action': 'labeldrop'}
+        keep_up = {'source_labels': ['__name__'], 'regex': 'up',
+                   'action': 'keep'}
+        config = self.def_config
+        config.update({
+            'static-targets': 'foo:1234',
+            'metric-relabel-configs': yaml.safe_dump({
+                'all-jobs': [drop_go],
+                'myapp': [drop_id],
+            }),
+        })
+        mock_hookenv_config.return_value = config
+        mock_unit_get.return_value = 'localhost'
+        scrape_mock = mock.Mock()
+        scrape_mock.targets.return_value = [
+            {'job_name': 'myapp', 'metrics_path': '/metrics',
+             'targets': ['app1:80'], 'metric_relabel_configs': [keep_up]},
+            {'job_name': 'broken', 'metrics_path': '/metrics',
+             'targets': ['app2:80'], 'metric_relabel_configs': '[{oops'}]
+        react_prom.update_prometheus_scrape_targets(scrape_mock)
+        react_prom.write_prometheus_config_yml()
+        yaml_content = yaml.safe_load(open(self.prom_yml))
+        jobs = {j['job_name']: j for j in yaml_content['scrape_configs']}
+        self.assertEqual(jobs['myapp']['metric_relabel_configs'],
+                         [keep_up, drop_id, drop_go])
+        self.assertEqual(jobs['static-targets']['metric_relabel_configs'],
+                         [drop_go])
+        # invalid rules from the relation are dropped
+        self.assertEqual(jobs['broken']['metric_relabel_configs'], [drop_go])
+        self.assertNotIn('metric_relabel_configs', jobs['prometheus'])
+
+    @mock.patch('reactive.prometheus.rules_valid')
+    def test_rule_files(self,
+                        mock_rules_valid,
+                        mock_hookenv_config,
+                        mock_unit_get,
+                        mock_validate_config,
+                        *args):
+        config = self.def_config
+        config.update({
+            'custom-rules': 'BLAH',
+            'builtin-recording-rules': True,
+            'rule-files': yaml.safe_dump({'myapp': 'a:b = sum(c)\n'}),
+        })
+        mock_hookenv_config.return_value = config
+        mock_unit_get.return_value = 'localhost'
+        mock_rules_valid.side_effect = lambda path: 'bad' not in path
+        react_prom.update_prometheus_targets(
+            ReactInterfaceMock({'foo': [['foohost1', 'p1']]}))
+        scrape_mock = mock.Mock()
+        scrape_mock.targets.return_value = [
+            {'job_name': 'app', 'metrics_path': '/metrics',
+             'targets': ['app1:80'], 'rules': 'x:y = sum(z)\n'},
+            {'job_name': 'bad', 'metrics_path': '/metrics',
+             'targets': ['bad1:80'], 'rules': 'oops'}]
+        react_prom.update_prometheus_scrape_targets(scrape_mock)
+        react_prom.write_prometheus_config_yml()
+        yaml_content = yaml.safe_load(open(self.prom_yml))
+        self.assertEqual(yaml_content['rule_files'], [
+            self.prom_custom_rules,
+            os.path.join(self.rules_dir, 'builtin-jobs.rules'),
+            os.path.join(self.rules_dir, 'config-myapp.rules'),
+            os.path.join(self.rules_dir, 'relation-app.rules'),
+        ])
+        with open(os.path.join(self.rules_dir, 'builtin-jobs.rules')) as fh:
+            builtin = fh.read()
+        self.assertIn('job:up:avg = avg(up{job="foo"}) by (job)', builtin)
+        self.assertIn('job:up:avg = avg(up{job="app"}) by (job)', builtin)
+        # Dropped rule files are removed
+        config['builtin-recording-rules'] = False
+        react_prom.write_prometheus_config_yml()
+        self.assertEqual(sorted(os.listdir(self.rules_dir)),
+                         ['config-myapp.rules', 'relation-app.rules'])
+        # Rejected rules are rolled back, prometheus never loads them
+        config.update({'custom-rules': 'BROKEN',
+                       'builtin-recording-rules': True,
+                       'rule-files': yaml.safe_dump({'myapp': 'broken'})})
+        mock_validate_config.side_effect = subprocess.CalledProcessError(
+            1, 'promtool')
+        self.assertRaises(subprocess.CalledProcessError,
+                          react_prom.write_prometheus_config_yml)
+        self.assertEqual(sorted(os.listdir(self.rules_dir)),
+                         ['config-myapp.rules', 'relation-app.rules'])
+        with open(os.path.join(self.rules_dir, 'config-myapp.rules')) as fh:
+            self.assertEqual(fh.read(), 'a:b = sum(c)\n')
+        with open(self.prom_custom_rules) as fh:
+            self.assertEqual(fh.read(), 'BLAH')
+
+    def test_update_storage_profile(self, mock_hookenv_config, *args):
+        config = self.def_config
+        mock_hookenv_config.return_value = config
+        config['storage-profile'] = 'ssd'
+        react_prom.update_storage_profile()
+        args = react_prom.runtime_args()
+        self.assertIn('-storage.local.checkpoint-interval 15m0s', args)
+        self.assertIn('-storage.local.chunk-encoding-version 1', args)
+        config['storage-profile'] = ''
+        react_prom.update_storage_profile()
+        self.assertEqual(react_prom.runtime_args(), [])
+
+    @mock.patch('reactive.prometheus.os.path.ismount')
+    @mock.patch('reactive.prometheus.host.mount')
+    @mock.patch('reactive.prometheus.host.mkdir')
+    @mock.patch('reactive.prometheus.hookenv.hook_name')
+    @mock.patch('reactive.prometheus.subprocess.check_call')
+    @mock.patch('reactive.prometheus.subprocess.check_output')
+    @mock.patch('reactive.prometheus.set_state')
+    def test_configure_block_storage(self,
+                                     mock_set_state,
+                                     mock_check_output,
+                                     mock_check_call,
+                                     mock_hook_name,
+                                     mock_mkdir,
+                                     mock_mount,
+                                     mock_ismount,
+                                     mock_hookenv_config,
+                                     *args):
+        config = self.def_config
+        config['storage-profile'] = 'nvme'
+        mock_hookenv_config.return_value = config
+        mock_hook_name.return_value = 'metrics-block-storage-attached'
+        mock_ismount.return_value = False
+
+        def check_output(cmd):
+            if cmd[0] == 'blkid':
+                if 'UUID' in cmd:
+                    return b'1234-abcd\n'
+                raise react_prom.subprocess.CalledProcessError(2, cmd)
+            return b'/dev/vdb\n'
+        mock_check_output.side_effect = check_output
+        react_prom.configure_storage()
+        self.assertEqual(mock_check_call.call_args_list, [
+            mock.call(['mkfs', '-t', 'ext4', '/dev/vdb']),
+            mock.call(['blockdev', '--setra', '128', '/dev/vdb']),
+        ])
+        # readahead is persisted for reboots
+        with open(react_prom.READAHEAD_UDEV_RULE) as fh:
+            self.assertIn('ENV{ID_FS_UUID}=="1234-abcd", '
+                          'RUN+="/sbin/blockdev --setra 128 $devnode"',
+                          fh.read())
+        # and follows storage-profile changes
+        mock_check_call.reset_mock()
+        react_prom.update_storage_profile()
+        self.assertFalse(mock_check_call.called)
+        config['storage-profile'] = 'hdd'
+        react_prom.update_storage_profile()
+        mock_check_call.assert_called_once_with(
+            ['blockdev', '--setra', '1024', '/dev/vdb'])
+        config['storage-profile'] = ''
+        react_prom.update_storage_profile()
+        self.assertFalse(os.path.exists(react_prom.READAHEAD_UDEV_RULE))
+        mock_mount.assert_called_once_with(
+            '/dev/vdb', '/srv/prometheus', options='noatime,nodiratime',
+            persist=True, filesystem='ext4')
+        self.assertIn('-storage.local.path /srv/prometheus',
+                      react_prom.runtime_args())
+
+    def test_update_prometheus_remote_storage(self,
+                                              mock_hookenv_config,
+                                              *args):
+        config = self.def_config
+        config['remote-storage-local-retention'] = '72h0m0s'
+        mock_hookenv_config.return_value = config
+        req_mock = ReactInterfaceMock({'influxdb': [['influx1', '8086'],
+                                                    ['influx0', '8086']]})
+        react_prom.update_prometheus_remote_storage(req_mock)
+        self.assertEqual(react_prom.runtime_args(), [
+            '-storage.local.retention 72h0m0s',
+            '-storage.remote.influxdb-url http://influx0:8086',
+            '-storage.remote.influxdb.database prometheus',
+            '-storage.remote.influxdb.retention-policy default',
+            '-storage.remote.timeout 30s',
+        ])
+        config['remote-storage-type'] = 'opentsdb'
+        react_prom.update_prometheus_remote_storage(req_mock)
+        self.assertEqual(react_prom.runtime_args(), [
+            '-storage.local.retention 72h0m0s',
+            '-storage.remote.opentsdb-url http://influx0:8086',
+            '-storage.remote.timeout 30s',
+        ])
+        react_prom.update_prometheus_no_remote_storage()
+        self.assertEqual(react_prom.runtime_args(), [])
+
+    def test_charm_metrics(self,
+                           mock_hookenv_config,
+                           mock_unit_get,
+                           *args):
+        config = self.def_config
+        config['charm-metrics'] = True
+        config['port'] = 9095
+        mock_hookenv_config.return_value = config
+        mock_unit_get.return_value = 'localhost'
+        react_prom.update_prometheus_targets(
+            ReactInterfaceMock({'foo': [['foohost1', 'p1'],
+                                        ['foohost2', 'p2']]}))
+        react_prom.write_prometheus_config_yml()
+        react_prom.update_charm_metrics_args()
+        self.assertIn('-web.user-assets {}'.format(self.charm_metrics_dir),
+                      react_prom.runtime_args())
+        yaml_content = yaml.safe_load(open(self.prom_yml))
+        self.assertDictEqual(yaml_content['scrape_configs'][1], {
+            'job_name': 'prometheus-charm',
+            'metrics_path': '/user/charm.prom',
+            'target_groups': [{'targets': ['localhost:9095']}]})
+        # written once, when the hook completes
+        metrics_file = os.path.join(self.charm_metrics_dir, 'charm.prom')
+        self.assertFalse(os.path.exists(metrics_file))
+        with mock.patch('reactive.prometheus.write_atomic',
+                        wraps=react_prom.write_atomic) as mock_write:
+            hookenv._run_atexit()
+        self.assertEqual(mock_write.call_count, 1)
+        with open(os.path.join(self.charm_metrics_dir, 'charm.prom')) as fh:
+            metrics = fh.read()
+        for operation in ('update_prometheus_targets', 'render',
+                          'write_prometheus_config_yml'):
+            self.assertIn('prometheus_charm_duration_seconds_count'
+                          '{{operation="{}"}} 1\n'.format(operation),
+                          metrics)
+        self.assertIn('prometheus_charm_configured_targets{job="foo"} 2\n',
+                      metrics)
+
+    @mock.patch('reactive.prometheus.time.time')
+    def test_probe_targets(self,
+                           mock_time,
+                           mock_hookenv_config,
+                           mock_unit_get,
+                           *args):
+        config = self.def_config
+        config.update({'probe-targets': True, 'probe-timeout': 1})
+        mock_hookenv_config.return_value = config
+        mock_time.return_value = 1000
+        # a port nothing listens on
+        sock = socket.socket()
+        sock.bind(('localhost', 0))
+        dead = 'localhost:{}'.format(sock.getsockname()[1])
+        sock.close()
+        with StandInServer({'/metrics': 'up 1\n'}) as up1, \
+                StandInServer({}) as up2:
+            alive = ['localhost:{}'.format(up1.port),
+                     'localhost:{}'.format(up2.port)]
+            jobs = [{'job_name': 'foo', 'targets': alive + [dead]}]
+            self.assertEqual(react_prom.quarantine_unreachable(jobs), [
+                {'job_name': 'foo', 'targets': alive},
+                {'job_name': 'foo-unreachable', 'targets': [dead],
+                 'scrape_interval': '5m'}])
+            self.assertEqual(up1.requests, ['/metrics'])
+            # cached results are not probed again until the TTL passes
+            react_prom.quarantine_unreachable(jobs)
+            self.assertEqual(len(up1.requests), 1)
+            mock_time.return_value = 1000 + 301
+            react_prom.quarantine_unreachable(jobs)
+            self.assertEqual(len(up1.requests), 2)